@@ -1,2 +1,2 @@
-from .normalize import normalize
+from .normalize import normalize, tmm_factors
 from . import diffex 
@@ -18,6 +18,8 @@ def normalize(method, E, *pargs, **kwargs):
                        logratioTrim=0.3. See the documentation of the R CalcNormFactors function for more information
                        sumTrim=0.05
                        aCutoff=-1e10
+                       factors=None Precomputed normalization factors per sample (see tmm_factors), e.g. from an earlier call
+                       chunk_size=512, n_workers=1 Number of samples per chunk, and the number of processes
               fpkm: Not yet implemented
               nonzero: Remove rows (i.e. columns) with entirely zero values.
       E: DataFrame. Expression data
@@ -37,6 +39,11 @@ def normalize(method, E, *pargs, **kwargs):
         notNullRows = np.where(np.any(D > 0, axis=1))[0]
         utils.msg.dbm("Nonzero rows, columns: %d, %d" % (len(notNullRows), len(notNullCols)))
         D = D[notNullRows,:][:,notNullCols]
+        factors = kwargs.get('factors', None)
+        if factors is not None:
+            # Precomputed factors are given for all samples
+            kwargs['factors'] = factors.loc[E.index[notNullRows]].values if isinstance(factors, pd.Series) else np.asarray(factors)[notNullRows]
+        #fi
         N = methods[method](D, *pargs, **kwargs)
         
         return pd.DataFrame(N, columns=E.columns[notNullCols], index=E.index[notNullRows])
@@ -55,70 +62,108 @@ def __normalize_cpm(E):
     t = np.log2(E + 0.5) + 6 * np.log2(10) - np.log2(E.sum(axis=1) + 1.0)[:,np.newaxis]
     return t
     
-def __normalize_tmm(E, refID=None, logratioTrim=0.3, sumTrim=0.05, aCutoff=-1e10):
-    """ TMM normalization
-        As implemented: https://rdrr.io/bioc/edgeR/src/R/calcNormFactors.R
-        However, here implemented in python
+def tmm_factors(E, refID=None, logratioTrim=0.3, sumTrim=0.05, aCutoff=-1e10, chunk_size=512, n_workers=1):
+    """
+    TMM normalization factors
+    As implemented: https://rdrr.io/bioc/edgeR/src/R/calcNormFactors.R
+    The trimmed means of all samples are computed at once, for chunks of chunk_size samples.
+    Inputs:
+      E: DataFrame, numpy array or scipy sparse matrix of counts
+         rows are samples. columns are genes
+      refID: The index of the reference sample to use. If None, the sample whose upper quartile is closest to the average is used
+      logratioTrim, sumTrim, aCutoff: See the documentation of the R calcNormFactors function
+      chunk_size: Integer. Number of samples to process at once
+      n_workers: Integer. Number of processes to use
+    Output:
+      The normalization factor per sample (a Series if E is a DataFrame), e.g. to cache and use in normalize('tmm', E, factors=...)
     """
+    index = None
+    if isinstance(E, pd.DataFrame):
+        index = E.index
+        E = E.sparse.to_coo().tocsr() if all(isinstance(t, pd.SparseDtype) for t in E.dtypes) else E.values
+    #fi
+    sparse = hasattr(E, 'toarray')
+
+    def rows(start, cols=None):
+        # A dense chunk of samples
+        chunk = E[start:start + chunk_size]
+        chunk = chunk if cols is None else chunk[:, cols]
+        return np.asarray(chunk.toarray() if sparse else chunk, dtype=np.float64)
+    #edef
+
+    starts = range(0, E.shape[0], chunk_size)
+    libSizes = np.asarray(E.sum(axis=1), dtype=np.float64).ravel()
+
     if refID is None:
-        uq  = np.apply_along_axis(lambda x: np.percentile(x, 75), axis=1, arr=E)
-        muq = np.mean(uq)
-        refID, _ = min(enumerate(np.abs(uq-muq)), key=lambda x: x[1])
+        # Genes and samples without counts are ignored, as in normalize, so that the factors do not depend on them
+        genes = np.where(np.asarray(E.sum(axis=0)).ravel() > 0)[0]
+        uq    = np.concatenate([ np.percentile(rows(start, genes), 75, axis=1) for start in starts ])
+        refID = np.argmin(np.where(libSizes > 0, np.abs(uq - np.mean(uq[libSizes > 0])), np.inf))
     #fi
-    
-    def calcNormFactors(sampleID):
-        sample = E[sampleID, :]
-        ref    = E[refID, :]
-        
-        nS = sum(sample)
-        nR = sum(ref)
 
-        logR = np.log2((sample/nS) / (ref/nR))
-        absE = (np.log2(sample/nS) + np.log2(ref/nR))/2
-        v    = (nS-sample)/(nS*sample) + (nR-sample)/(nR*sample)
-        
+    # Genes without counts in the reference never have a finite log ratio, so they are left out
+    ref   = rows(refID)[0]
+    cols  = np.where(ref > 0)[0]
+    ref   = ref[cols]
+    nR    = libSizes[refID]
+    vR    = (nR - ref) / (nR * ref)
+
+    def calcNormFactors(start):
+        sample = rows(start, cols)
+        nS     = libSizes[start:start + chunk_size][:, np.newaxis]
+
+        # The log ratios are computed as in edgeR, as the trimming depends on exact ties
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logR = np.log2((sample / nS) / (ref / nR))
+            absE = (np.log2(sample / nS) + np.log2(ref / nR)) / 2
+            v    = (nS - sample) / (nS * sample) + vR
+        #ewith
+
         fin = np.isfinite(logR) & np.isfinite(v) & (absE > aCutoff)
-        
-        logR = logR[fin]
-        absE = absE[fin]
-        v    = v[fin]
-        
-        if np.max(np.abs(logR)) < 1e-6:
-            return 0
-        #fi
-        
+        n   = fin.sum(axis=1)
+
         #taken from the original mean() function
-        n = len(logR)
-        loL = np.floor(n * logratioTrim) + 1
-        hiL = n + 1 - loL
-        loS = np.floor(n * sumTrim) + 1
-        hiS = n + 1 - loS
-        #keep <- (rank(logR) %in% loL:hiL) & (rank(absE) %in% loS:hiS)
-        #a fix from leonardo ivan almonacid cardenas, since rank() can return
-        #non-integer values when there are a lot of ties
-        
-        logRank = np.array(sstats.rankdata(logR))
-        absRank = np.array(sstats.rankdata(absE))
-        keep = (logRank>=loL) & (logRank<=hiL) & (absRank>=loS) & (absRank<=hiS)
+        loL = (np.floor(n * logratioTrim) + 1)[:, np.newaxis]
+        hiL = n[:, np.newaxis] + 1 - loL
+        loS = (np.floor(n * sumTrim) + 1)[:, np.newaxis]
+        hiS = n[:, np.newaxis] + 1 - loS
+
+        # Values that are left out are ranked after all the others, so that they do not affect the ranks of the rest
+        logRank = sstats.rankdata(np.where(fin, logR, np.inf), axis=1)
+        absRank = sstats.rankdata(np.where(fin, absE, np.inf), axis=1)
+        keep = fin & (logRank >= loL) & (logRank <= hiL) & (absRank >= loS) & (absRank <= hiS)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fNumin = logR / v
+            fDenom = 1 / v
+            f = (np.where(keep & np.isfinite(fNumin), fNumin, 0).sum(axis=1) /
+                 np.where(keep & np.isfinite(fDenom), fDenom, 0).sum(axis=1))
+        #ewith
 
-        fNumin = logR[keep]/v[keep]
-        fDenom = 1/v[keep]
-        f = sum(fNumin[np.isfinite(fNumin)]) / sum(fDenom[np.isfinite(fDenom)])
-        
         #Results will be missing if the two libraries share no features with positive counts
         #In this case, return unity
-        if not np.isfinite(f):
-            f = 0
-        #efor
+        f[~np.isfinite(f) | (np.where(fin, np.abs(logR), 0).max(axis=1, initial=0) < 1e-6)] = 0
         return f
     #edef
-    
-    f = np.array([ calcNormFactors(k) for k in range(E.shape[0])])
+
+    f = np.concatenate([ np.zeros(0) ] + utils.py.parallel_map(calcNormFactors, starts, n_workers=n_workers))
     f = np.power(2, f)
-    
+
     #f = f/np.exp(np.mean(np.log(f)))
     utils.msg.dbm("TMM NormFactors (Ref=%d) = %s" % (refID, str(f)))
-    return E / f[:,np.newaxis]
+    return f if index is None else pd.Series(f, index=index)
+#edef
+
+def __normalize_tmm(E, refID=None, logratioTrim=0.3, sumTrim=0.05, aCutoff=-1e10, factors=None, **kwargs):
+    """ TMM normalization
+        As implemented: https://rdrr.io/bioc/edgeR/src/R/calcNormFactors.R
+        However, here implemented in python (see tmm_factors)
+        factors: Precomputed normalization factors per sample. If None, they are computed with tmm_factors
+    """
+    if factors is None:
+        factors = tmm_factors(E, refID=refID, logratioTrim=logratioTrim, sumTrim=sumTrim, aCutoff=aCutoff, **kwargs)
+    #fi
+    return E / np.asarray(factors)[:,np.newaxis]
 #edef
     
 def __normalize_fpkm(E, gff):
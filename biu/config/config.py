@@ -103,6 +103,40 @@ class globalSettings(object):
     self.setSettings(download_where=dirName)
   #edef
 
+  def getDownloadWorkers(self):
+    """Get the number of files that are acquired at the same time"""
+    return self.getSetting("download_workers")
+  #edef
+
+  def setDownloadWorkers(self, n):
+    """Set the number of files that are acquired at the same time"""
+    self.setSettings(download_workers=int(n))
+  #edef
+
+  ###############################################################################
+
+  def getCacheDir(self):
+    path = self.getSetting("cache_where")
+    if path == '':
+      path = self.getWhere()
+    #fi
+    return '%s/%s' % (os.path.abspath(path), self.getSetting('cache_base'))
+  #edef
+
+  def setCacheDir(self, dirName):
+    self.setSettings(cache_where=dirName)
+  #edef
+
+  def getCacheMaxSize(self):
+    """Get the maximum size (in bytes) that each on-disk cache may occupy"""
+    return self.getSetting("cache_max_size")
+  #edef
+
+  def setCacheMaxSize(self, size):
+    """Set the maximum size (in bytes) that each on-disk cache may occupy"""
+    self.setSettings(cache_max_size=int(size))
+  #edef
+
   ###############################################################################
 
   def getPipelineOutdir(self):
@@ -3,6 +3,7 @@ from .. import formats
 from .. import utils
 
 np = utils.py.loadExternalModule('numpy')
+pd = utils.py.loadExternalModule('pandas')
 
 ###############################################################################
 
@@ -14,6 +15,7 @@ class CADD2(Dataset2):
     cadd = biu.db.CADD2()
     cadd.query(12, 500010, 500012)   # Get the CADD scores for a specific region
     cadd.region_thresh(12, 500010, 500012) # Get the 95% of CADD scores in a region.
+    cadd.score(variants)                   # Add the CADD scores to a DataFrame of variants
     """
 
     versions = { "GRCh37" : {
@@ -24,6 +26,8 @@ class CADD2(Dataset2):
 
     version = None
 
+    _fieldTypes = { "chrom" : str, "pos" : np.int64, "ref" : str, "alt" : str, "rawscore" : float, "phred" : float }
+
     def __init__(self, version=list(versions.keys())[0], *pargs, **kwargs):
         """
         Initialize the CADD data structure.
@@ -38,7 +42,7 @@ class CADD2(Dataset2):
         self._obj.add_file('scores.tsv.bgz', utils.Acquire2().curl(vData["cadd_url"]))
         self._obj.add_file('scores.tsv.bgz.tbi', utils.Acquire2().curl(vData["cadd_tab_url"]))
       
-        cadd_fields = [ "chrom", "pos", "ref", "alt", "rawscore", "phred" ]
+        cadd_fields = list(self._fieldTypes.keys())
         self._obj.register("scores", [ "scores.tsv.bgz", "scores.tsv.bgz.tbi" ],
                              lambda f: formats.Tabix(f["scores.tsv.bgz"], fieldNames=cadd_fields))
         self.version = version
@@ -99,6 +103,63 @@ class CADD2(Dataset2):
         #fi
     #edef
 
+    def _seqids(self, chroms):
+        """
+        Map chromosome names to the names used in the CADD file, e.g. 'chr12' -> '12'
+        """
+        names = set(self.scores.index.names)
+        return { c : (c[3:] if (c not in names) and c.startswith('chr') and (c[3:] in names) else c) for c in set(chroms) }
+    #edef
+
+    def _regions(self, regions):
+        """
+        Regions as a DataFrame with columns chrom (as in the CADD file), start, end
+        """
+        regions = [ (reg[0], reg[1]-1, reg[1]) if len(reg) == 2 else tuple(reg) for reg in regions ]
+        if any([ len(reg) != 3 for reg in regions ]):
+            raise ValueError("Incorrect region specified")
+        #fi
+        regions = pd.DataFrame(regions, columns=[ 'chrom', 'start', 'end' ])
+        regions['chrom'] = regions.chrom.astype(str)
+        regions['chrom'] = regions.chrom.map(self._seqids(regions.chrom.values))
+        return regions
+    #edef
+
+    def query_table(self, regions, columns=None):
+        """
+        Get the CADD scores for multiple regions, as a table.
+        
+        parameters:
+        -----------
+        regions: List of 3-tuples of (chromosome, start, end), or 2-tuples of (chromosome, pos)
+        columns: The columns to return (default: all of chrom, pos, ref, alt, rawscore, phred)
+        
+        returns:
+        a pandas DataFrame, with one row per scored variant in the regions.
+        """
+        regions = self._regions(regions)
+        return self.scores.queryTable(regions, columns=columns, dtype=self._fieldTypes)
+    #edef
+
+    def _region_rows(self, table, regions):
+        """
+        The rows of a table from query_table that are in each region.
+        The scores of each chromosome are sorted by position, so each region is a slice.
+        
+        Returns: A generator of (index of the region, rows of the region in the table)
+        """
+        regions = self._regions(regions)
+        for (c, idx) in regions.groupby('chrom', sort=False).indices.items():
+            rows = np.flatnonzero(table.chrom.values == c)
+            pos  = table.pos.values[rows]
+            lo   = np.searchsorted(pos, regions.start.values[idx], side='right')
+            hi   = np.searchsorted(pos, regions.end.values[idx], side='right')
+            for (i, l, h) in zip(idx, lo, hi):
+                yield i, rows[l:h]
+            #efor
+        #efor
+    #edef
+
     def query_regions(self, regions):
         """
         Get the CADD scores for multiple regions.
@@ -108,29 +169,62 @@ class CADD2(Dataset2):
         regions: List of 3-tuples of (chromosome, start, end), or 2-tuples of (chromosome, pos)
         
         returns:
-        a dict of cadd scores.
+        a dict of cadd scores, with keys (chromosome as it was given, pos, alt).
         """
+        regions = list(regions)
+        table   = self.query_table(regions, columns=[ 'chrom', 'pos', 'alt', 'phred' ])
+        pos     = table.pos.values.tolist()
+        alt     = table.alt.values
+        phred   = table.phred.values.tolist()
+        
         resPhred = {}
-        for reg in regions:
-            c = None
-            s = None
-            e = None
-            if len(reg) == 3:
-                c,s,e = reg
-            elif len(reg) == 2:
-                c,s = reg
-            else:
-                raise ValueError("Incorrect region specified")
-            #fi
-            
-            qres = self.scores.query(c, s, e, namedtuple=True) 
-            for res in qres:
-                resPhred[(c, int(res.pos),res.alt)] = float(res.phred)
+        for (i, rows) in self._region_rows(table, regions):
+            chrom = regions[i][0]
+            for r in rows:
+                resPhred[(chrom, pos[r], alt[r])] = phred[r]
             #efor
         #efor
         return resPhred
     #edef
 
+    def score(self, variants, chrom='chrom', pos='pos', ref='ref', alt='alt', columns=[ 'rawscore', 'phred' ]):
+        """
+        Annotate variants with their CADD scores.
+        The scores of all variants are read at once, in order of the file, and joined on (chrom, pos, ref, alt).
+        
+        parameters:
+        -----------
+        variants: pandas DataFrame with the chromosome, position (1-based), reference and alternative allele of each variant
+        chrom, pos, ref, alt: String. The names of these columns in variants
+        columns: List. The CADD columns to add (rawscore and/or phred)
+        
+        returns:
+        A copy of variants, with the CADD columns added. Variants that are not in CADD (e.g. indels) have NaN scores.
+        
+        Example usage:
+        --------------
+        cadd = biu.db.CADD2()
+        scored = cadd.score(pd.DataFrame({ 'chrom' : [ '1', '1' ], 'pos' : [ 10001, 10002 ], 'ref' : [ 'T', 'A' ], 'alt' : [ 'A', 'C' ]}))
+        """
+        keys = pd.DataFrame({ 'chrom' : variants[chrom].astype(str).values,
+                              'pos'   : variants[pos].astype(np.int64).values,
+                              'ref'   : variants[ref].astype(str).values,
+                              'alt'   : variants[alt].astype(str).values })
+        keys['chrom'] = keys.chrom.map(self._seqids(keys.chrom.values))
+        
+        positions = keys[[ 'chrom', 'pos' ]].drop_duplicates()
+        regions   = pd.DataFrame({ 'chrom' : positions.chrom.values, 'start' : positions.pos.values - 1, 'end' : positions.pos.values })
+        scores    = self.scores.queryTable(regions, columns=[ 'chrom', 'pos', 'ref', 'alt' ] + list(columns), dtype=self._fieldTypes)
+        scores    = scores.drop_duplicates([ 'chrom', 'pos', 'ref', 'alt' ])
+        
+        joined = keys.merge(scores, how='left', on=[ 'chrom', 'pos', 'ref', 'alt' ])
+        result = variants.copy()
+        for column in columns:
+            result[column] = joined[column].values
+        #efor
+        return result
+    #edef
+
     def region_thresh(self, chrom, start, end, percentile=95):
         """
         Determine the 95% threshold of CADD scores for a given region
@@ -149,17 +243,31 @@ class CADD2(Dataset2):
         return self.regions_thresh( [(chrom, start, end)], percentile )
     #edef
 
-    def regions_thresh(self, regions, percentile=95):
+    def regions_thresh(self, regions, percentile=95, per_region=False):
         """
         parameters:
         -----------
         regions: List of 3-tuples of (chromosome, start, end), or 2-tuples of (chromosome, pos)
         percentile: what percentile to use.
+        per_region: Boolean. Compute the threshold of each region separately, rather than of all regions together
         
         returns:
-        A float
+        A float, or if per_region, a numpy array with the threshold of each region (NaN for regions without scores)
         """
-        return np.percentile(np.array(list(self.query_regions(regions).values())), percentile)
+        regions = list(regions)
+        table   = self.query_table(regions, columns=[ 'chrom', 'pos', 'phred' ])
+        if not per_region:
+            return np.percentile(table.phred.values, percentile)
+        #fi
+        
+        thresholds = np.full(len(regions), np.nan)
+        phred      = table.phred.values
+        for (i, rows) in self._region_rows(table, regions):
+            if len(rows) > 0:
+                thresholds[i] = np.percentile(phred[rows], percentile)
+            #fi
+        #efor
+        return thresholds
     #edef
 
 #eclass
\ No newline at end of file
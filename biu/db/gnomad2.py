@@ -5,14 +5,119 @@ from .. import utils
 pd = utils.py.loadExternalModule("pandas")
 np = utils.py.loadExternalModule('numpy')
 
-from functools import reduce
 
 ###############################################################################
 
+def _allele_value(value, altp):
+    """
+    Get the value for an alt allele from a per-allele INFO field
+    (cyvcf2 gives a scalar if there is only one alt allele)
+    """
+    return value[altp] if hasattr(value, '__len__') else value
+#edef
+
 class VCF_gnomad(formats.VCF2):
-    def genotype_matrix(self):
+    def genotype_matrix(self, *pargs, **kwargs):
         raise NotImplementedError("This function is not available for the GNOMAD dataset.")
     #edef
+
+    @utils.decorators.class_or_instance_method
+    def summary(obj, variants=None, sub=[None,'AFR','AMR','ASJ','EAS','FIN','NFE','OTH','SAS'], n_workers=None, regions=None):
+        """
+        Make a summary of all variants in the object, from the genotype counts in the INFO fields.
+        The same as GnomadBiuVariant.summary, but the INFO fields are gathered for all variants first,
+          and the counts are computed for all variants at once.
+        When called with a list of variants, each variant is summarized by its own summary method.
+
+        parameters:
+        -----------
+        variants: list of variants. Required when used as a classmethod.
+        sub: List[String]. Which subpopulations to consider (see GnomadBiuVariant.summary)
+        n_workers: Integer. Summarize per contig (or per region) in this many processes. See VCF2.map_regions.
+        regions: list of 3-tuples (chrom, start, end). Summarize per region, in a process pool. See VCF2.map_regions.
+
+        Returns: DataFrame
+        """
+        if variants is not None:
+            S = [ v.summary(sub=sub) if isinstance(v, GnomadBiuVariant) else v.summary() for v in variants ]
+            return pd.concat(S)
+        elif not obj.is_instance:
+            raise ValueError("To use this function as a classmethod, you must specify a list of variants you wish to summarize.")
+        #fi
+
+        self = obj.self
+
+        if (n_workers is not None) or (regions is not None):
+            S = self.map_regions(lambda o: o.summary(sub=sub), regions=regions, n_workers=n_workers)
+            return pd.concat(S)
+        #fi
+
+        def gc(var, field, gcIndexes):
+            values = var.INFO.get(field)
+            return [ values[i] for i in gcIndexes ] if (values is not None) else [0, 0, 0]
+        #edef
+
+        def gather_all(var, altp, gcIndexes):
+            chrom = { 'x' : 1, 'y' : 2 }.get(var.CHROM.lower(), 0)
+            total = var.INFO.get("AN_Male") + var.INFO.get("AN_Female")
+            ac    = _allele_value(var.INFO.get("AC"), altp) if chrom == 2 else 0
+            an    = var.INFO.get("AN") if chrom == 2 else 0
+            return gc(var, "GC_Male", gcIndexes) + gc(var, "GC_Female", gcIndexes) + \
+                   [ chrom, total, ac, an, _allele_value(var.INFO.get("AF"), altp) ]
+        #edef
+
+        def gather_sub(var, altp, gcIndexes, sub_name):
+            return gc(var, "GC_%s" % sub_name, gcIndexes) + \
+                   [ var.INFO.get('AN_%s' % sub_name), _allele_value(var.INFO.get("AF_%s" % sub_name), altp) ]
+        #edef
+
+        idxs     = []
+        gathered = [ [] for sub_name in sub ]
+        for var in self._vcf.iter_variants():
+            for altp in range(len(var.ALT)):
+                gcIndexes = formats.VCF2.genotype_info_field_indexes(altp+1)
+                idxs.append(self.make_identifier(var, altp))
+                for j, sub_name in enumerate(sub):
+                    if sub_name is None:
+                        gathered[j].append(gather_all(var, altp, gcIndexes))
+                    else:
+                        gathered[j].append(gather_sub(var, altp, gcIndexes, sub_name))
+                    #fi
+                #efor
+            #efor
+        #efor
+
+        S = {}
+        for sub_name, rows in zip(sub, gathered):
+            if sub_name is None:
+                D = np.array(rows, dtype=float).reshape(len(idxs), 11)
+                gcm, gcf = D[:,0:3], D[:,3:6]
+                chrom, total, ac, an, af = [ D[:,i] for i in range(6, 11) ]
+                auto, x, y = (chrom == 0), (chrom == 1), (chrom == 2)
+
+                rr = np.where(auto, gcm[:,0] + gcf[:,0], np.where(x, gcf[:,0], 0))
+                ra = np.where(auto, gcm[:,1] + gcf[:,1], np.where(x, gcf[:,1], 0))
+                aa = np.where(auto, gcm[:,2] + gcf[:,2], np.where(x, gcf[:,2], 0))
+                r  = np.where(x, gcm[:,0], np.where(y, an - ac, 0))
+                a  = np.where(x, gcm[:,1], np.where(y, ac, 0))
+                u  = total - (2*rr + r + 2*ra + a + 2*aa)
+            else:
+                D = np.array(rows, dtype=float).reshape(len(idxs), 5)
+                rr, ra, aa, total, af = [ D[:,i] for i in range(5) ]
+                r  = np.zeros(len(idxs))
+                a  = np.zeros(len(idxs))
+                u  = total - 2*(rr + ra + aa)
+            #fi
+
+            name = 'ALL' if sub_name is None else sub_name
+            for allele, values in zip(["RR", "R", "RA", "A", "AA", "O", "AF"], [ rr, r, ra, a, aa, u, af ]):
+                S["%s_%s" % (name, allele)] = values if (allele == "AF") or np.isnan(values).any() else values.astype(int)
+            #efor
+        #efor
+
+        S = pd.DataFrame(S, index=pd.Index(idxs, name="index"))
+        return S
+    #edef
 #eclass
 
 class GnomadBiuVariant(formats.BiuVariant):
@@ -197,7 +302,7 @@ class Gnomad2(Dataset2):
         return self.vcf.filter(*args, **kwargs)
     #edef
 
-    def filter_regions(self, regions, chrom=None, start=None, end=None, *args, **kwargs):
+    def filter_regions(self, regions, chrom=None, start=None, end=None, *pargs, n_workers=None, **kwargs):
         """
         Perform a filter for several regions
         
@@ -205,12 +310,13 @@ class Gnomad2(Dataset2):
         -----------
         regions: A list of 3-tuples (chrom, start, end) for each region of interest
         chrom, start, end: Ignored
+        n_workers: int. Evaluate the regions in a pool of this many processes. See VCF2.merge
         *pargs, **kwargs: See additional arguments for VCF2.filter
         
         Returns: VCF2 object
         """
         rets = [ self.filter(c, s, e, *pargs, **kwargs) for (c,s,e) in regions ]
-        return reduce(lambda a,b: a+b, rets)
+        return rets[0].merge(rets, n_workers=n_workers)
     #edef
 
     def filter_cov(self, chrom, start, end, **kwargs):
@@ -274,6 +380,21 @@ class Gnomad2(Dataset2):
         return self.vcf.who_has(*pargs, **kwargs)
     #edef
 
+    def who_has_many(self, *pargs, **kwargs):
+        """
+        Determine who has each of a set of variants
+
+        parameters:
+        -----------
+        *pargs, **kwargs: See arguments for VCF2.who_has_many
+
+        returns:
+        --------
+        Boolean DataFrame of variants x samples, indexed by variant identifier.
+        """
+        return self.vcf.who_has_many(*pargs, **kwargs)
+    #edef
+
     def get_var(self, *pargs, **kwargs):
         """
         Get the variant record for a specific variant
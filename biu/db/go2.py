@@ -1,9 +1,15 @@
 from ..structures import Dataset2
 from .. import formats
 from .. import utils
+from .. import stats
 
+import os
 import xml.etree.ElementTree as ET
 
+pd = utils.py.loadExternalModule('pandas')
+np = utils.py.loadExternalModule('numpy')
+ssparse = utils.py.loadExternalModule('scipy.sparse')
+
 ###############################################################################
 
 class GO2(Dataset2):
@@ -46,7 +52,29 @@ class GO2(Dataset2):
             return 0
         #edef
         
+        def parseGOHierarchy(infile, outfile):
+            # The is_a and part_of relations between terms, along which annotations propagate (the true path rule)
+            xml = ET.parse(infile[0])
+            root = xml.getroot()
+            with open(outfile, 'w') as ofd:
+                ofd.write('\t'.join(['child', 'parent', 'relation']) + '\n')
+                for term in [ child for child in root if child.tag == 'term' ]:
+                    term_id = term.find('id').text
+                    for parent in term.findall('is_a'):
+                        ofd.write('\t'.join([ term_id, parent.text, 'is_a' ]) + '\n')
+                    #efor
+                    for rel in term.findall('relationship'):
+                        if rel.findtext('type') == 'part_of':
+                            ofd.write('\t'.join([ term_id, rel.findtext('to'), 'part_of' ]) + '\n')
+                        #fi
+                    #efor
+                #efor
+            #ewith
+            return 0
+        #edef
+        
         self._obj.add_file("terminfo.tsv", utils.Acquire2().curl('http://archive.geneontology.org/latest-termdb/go_daily-termdb.obo-xml.gz').gunzip().func(parseGOXML))
+        self._obj.add_file("hierarchy.tsv", utils.Acquire2().curl('http://archive.geneontology.org/latest-termdb/go_daily-termdb.obo-xml.gz').gunzip().func(parseGOHierarchy))
         
         self._obj.add_file("annots.gaf", utils.Acquire2().curl(self.versions[self._version]).gunzip())
         
@@ -55,11 +83,226 @@ class GO2(Dataset2):
                                                                                  names=['id', 'namespace', 'name', 'desc'],
                                                                                  delimiter='\t') )
         
+        def make_closure(f):
+            """
+            The transitive closure of the GO DAG.
+            It is cached next to the acquired files, and only rebuilt when they change.
+            """
+            sources = [ f[k] for k in sorted(f.keys()) ]
+            cache   = os.path.join(os.path.dirname(os.path.abspath(sources[0])), 'go_closure.npz')
+
+            if os.path.exists(cache) and (os.path.getmtime(cache) >= max([ os.path.getmtime(s) for s in sources ])):
+                utils.dbm("Loading GO closure from '%s'" % cache)
+                return self.GOClosure.load(cache)
+            #fi
+
+            utils.dbm("Building GO closure")
+            terms     = pd.read_csv(f['terminfo.tsv'], sep='\t', usecols=['id', 'namespace'])
+            hierarchy = pd.read_csv(f['hierarchy.tsv'], sep='\t')
+            closure   = self.GOClosure.build(terms.id.values, terms.namespace.values, hierarchy.child.values, hierarchy.parent.values)
+            try:
+                closure.save(cache)
+            except OSError:
+                utils.warning("Could not write the GO closure to '%s'." % cache)
+            #etry
+            return closure
+        #edef
+        
+        self._obj.register("closure", [ "terminfo.tsv", "hierarchy.tsv" ], make_closure)
+        self._enrichmentIndexes = {}
 
         self._add_str_func(lambda s: "Version: %s" % self._version)
       #edef
 
 
+    ###############################################################################
+
+    class GOClosure(object):
+        """
+        The transitive closure of the GO DAG (is_a and part_of relations), stored as sparse boolean matrices.
+        Row i of the ancestor matrix holds all ancestors of term i (including itself); the descendant matrix is its transpose.
+        """
+        
+        def __init__(self, arrays):
+            """
+            Initialize the closure from its arrays. Use GOClosure.build or GOClosure.load to make one.
+            """
+            self._arrays = arrays
+            self.terms   = pd.Index(arrays['term_ids'])
+            n = len(self.terms)
+            self.parents     = ssparse.csr_matrix((np.ones(len(arrays['parents']), dtype=np.int64), arrays['parents'], arrays['parents_indptr']), shape=(n, n))
+            self.ancestors   = ssparse.csr_matrix((np.ones(len(arrays['ancestors']), dtype=np.int64), arrays['ancestors'], arrays['ancestors_indptr']), shape=(n, n))
+            self.descendants = self.ancestors.T.tocsr()
+        #edef
+        
+        @classmethod
+        def build(cls, term_ids, namespaces, children, parents):
+            """
+            Build the closure from the terms and the (child, parent) edges of the DAG.
+            Edges to unknown terms are ignored.
+            """
+            terms    = pd.Index(term_ids)
+            children = terms.get_indexer(children)
+            parents  = terms.get_indexer(parents)
+            keep     = (children >= 0) & (parents >= 0)
+            children, parents = children[keep], parents[keep]
+            n = len(terms)
+            
+            P = ssparse.csr_matrix((np.ones(len(children), dtype=np.int64), (children, parents)), shape=(n, n))
+            P.sum_duplicates()
+            P.data[:] = 1
+            
+            # Square the reachability matrix until nothing changes; this needs log2(depth) sparse products
+            A = (ssparse.identity(n, dtype=np.int64, format='csr') + P).tocsr()
+            while True:
+                B = A @ A
+                B.data[:] = 1
+                if B.nnz == A.nnz:
+                    break
+                #fi
+                A = B
+            #ewhile
+            A.sort_indices()
+            P.sort_indices()
+            
+            # The depth of a term is the length of its longest path to a root
+            depth = np.zeros(n, dtype=np.int64)
+            for _ in range(n):
+                new = depth.copy()
+                np.maximum.at(new, children, depth[parents] + 1)
+                if (new == depth).all():
+                    break
+                #fi
+                depth = new
+            #efor
+            
+            arrays = {}
+            arrays['term_ids']         = np.asarray(term_ids).astype(str)
+            arrays['namespace']        = np.asarray(namespaces).astype(str)
+            arrays['depth']            = depth
+            arrays['parents_indptr']   = P.indptr.astype(np.int64)
+            arrays['parents']          = P.indices.astype(np.int64)
+            arrays['ancestors_indptr'] = A.indptr.astype(np.int64)
+            arrays['ancestors']        = A.indices.astype(np.int64)
+            return cls(arrays)
+        #edef
+        
+        def save(self, filename):
+            """
+            Save the closure as a (compressed) numpy archive
+            """
+            tmp = '%s.tmp.%d.npz' % (filename[:-4], os.getpid())
+            np.savez_compressed(tmp, **self._arrays)
+            os.replace(tmp, filename)
+        #edef
+        
+        @classmethod
+        def load(cls, filename):
+            """
+            Load a closure saved with save
+            """
+            with np.load(filename, allow_pickle=False) as data:
+                return cls({ k : data[k] for k in data.files })
+            #ewith
+        #edef
+        
+        @property
+        def namespace(self):
+            """
+            The namespace of each term, as a numpy array
+            """
+            return self._arrays['namespace']
+        #edef
+        
+        @property
+        def depth(self):
+            """
+            The length of the longest path from each term to a root, as a numpy array
+            """
+            return self._arrays['depth']
+        #edef
+        
+        def get_ancestors(self, term, include_self=False):
+            """
+            All terms that a term is (transitively) a child of. Empty list if the term is unknown.
+            """
+            return self._related(self.ancestors, term, include_self)
+        #edef
+        
+        def get_descendants(self, term, include_self=False):
+            """
+            All terms that are (transitively) a child of a term. Empty list if the term is unknown.
+            """
+            return self._related(self.descendants, term, include_self)
+        #edef
+        
+        def _related(self, matrix, term, include_self):
+            if term not in self.terms:
+                return []
+            #fi
+            i = self.terms.get_loc(term)
+            related = matrix.indices[matrix.indptr[i]:matrix.indptr[i+1]]
+            if not include_self:
+                related = related[related != i]
+            #fi
+            return self.terms[related].tolist()
+        #edef
+        
+        def propagate(self, objects, terms, matrix, namespace=None):
+            """
+            Propagate annotations to all ancestors of the annotated terms (the true path rule).
+            
+            parameters:
+            -----------
+            objects: list of object identifiers (rows of the matrix)
+            terms: list of term identifiers (columns of the matrix)
+            matrix: scipy.sparse matrix. The (object x term) annotations
+            namespace: String. Only return the terms of this namespace (e.g. biological_process)
+            
+            Returns:
+            --------
+            objects, terms, and the propagated (object x term) scipy.sparse.csr_matrix, without empty rows or columns.
+            Terms that are not in the ontology are kept as they are (unless a namespace is given), but are never propagated.
+            """
+            matrix  = ssparse.csr_matrix(matrix, dtype=np.int64)
+            col     = self.terms.get_indexer(terms)
+            known   = col >= 0
+            n_known = len(self.terms)
+            
+            # Map the matrix columns onto the terms of the ontology, followed by the unknown terms
+            col[~known] = n_known + np.arange((~known).sum())
+            remap  = ssparse.csr_matrix((np.ones(len(col), dtype=np.int64), (np.arange(len(col)), col)), shape=(len(col), n_known + (~known).sum()))
+            extend = ssparse.block_diag([ self.ancestors, ssparse.identity((~known).sum(), dtype=np.int64) ], format='csr')
+            
+            propagated = (matrix @ remap @ extend).tocsr()
+            propagated.data[:] = 1
+            all_terms = np.concatenate([ np.asarray(self.terms), np.asarray(terms, dtype=object)[~known] ]).astype(str)
+            
+            if namespace is not None:
+                keep = np.flatnonzero(self.namespace == namespace)
+                propagated, all_terms = propagated[:, keep], all_terms[keep]
+            #fi
+            
+            # Drop terms without annotations, and objects without terms
+            used = np.flatnonzero(np.diff(propagated.tocsc().indptr) > 0)
+            propagated = propagated[:, used].tocsr()
+            annotated  = np.flatnonzero(np.diff(propagated.indptr) > 0)
+            return np.asarray(objects)[annotated], all_terms[used], propagated[annotated]
+        #edef
+        
+        def __str__(self):
+            dstr  = "GOClosure object\n"
+            dstr += " Terms: %d\n" % len(self.terms)
+            dstr += " Relations: %d\n" % len(self._arrays['parents'])
+            dstr += " Ancestor pairs: %d\n" % self.ancestors.nnz
+            return dstr
+        #edef
+        
+        def __repr__(self):
+            return str(self)
+        #edef
+    #eclass
+
     ###############################################################################
 
     @property
@@ -100,7 +343,63 @@ class GO2(Dataset2):
         return self._gaf.get_annotated(annotID)
     #e  def
 
-    def enrich(self, your_set, pathway=None, abcd_values=False,  method=None, **kwargs):
+    def get_ancestors(self, annotID, include_self=False):
+        """
+        get_ancestors : Get all GO terms that a GO term is (transitively) a child of, via is_a or part_of relations
+        Input:
+          - annotID : GO term
+          - include_self : Boolean. Include annotID itself
+        Output:
+          - List of GO terms
+        """
+        return self.closure.get_ancestors(annotID, include_self)
+    #edef
+
+    def get_descendants(self, annotID, include_self=False):
+        """
+        get_descendants : Get all GO terms that are (transitively) a child of a GO term, via is_a or part_of relations
+        Input:
+          - annotID : GO term
+          - include_self : Boolean. Include annotID itself
+        Output:
+          - List of GO terms
+        """
+        return self.closure.get_descendants(annotID, include_self)
+    #edef
+
+    def enrichment_index(self, propagate=False, namespace=None):
+        """
+        The annotations as a stats.enrichment.EnrichmentIndex
+        
+        parameters:
+        -----------
+        propagate: Boolean. Also annotate objects with all ancestors of their GO terms (the true path rule)
+        namespace: String. Only include terms of this namespace (biological_process|molecular_function|cellular_component)
+        
+        Returns:
+        --------
+        stats.enrichment.EnrichmentIndex. Indexes are computed once per (propagate, namespace).
+        """
+        if (not propagate) and (namespace is None):
+            return self._gaf.enrichment_index
+        #fi
+        
+        if (propagate, namespace) not in self._enrichmentIndexes:
+            direct = self._gaf.enrichment_index
+            if propagate:
+                objects, terms, matrix = self.closure.propagate(direct.objects, direct.terms, direct.matrix, namespace=namespace)
+            else:
+                keep = np.flatnonzero(direct.terms.isin(self.closure.terms[self.closure.namespace == namespace]))
+                matrix    = direct.matrix[:, keep].tocsr()
+                annotated = np.flatnonzero(np.diff(matrix.indptr) > 0)
+                objects, terms, matrix = direct.objects[annotated], direct.terms[keep], matrix[annotated]
+            #fi
+            self._enrichmentIndexes[(propagate, namespace)] = stats.enrichment.EnrichmentIndex.from_matrix(objects, terms, matrix)
+        #fi
+        return self._enrichmentIndexes[(propagate, namespace)]
+    #edef
+
+    def enrich(self, your_set, pathway=None, abcd_values=False,  method=None, propagate=False, namespace=None, **kwargs):
         """
         Enrich: Check enrichment of GO pathways in a given set
   
@@ -109,12 +408,138 @@ class GO2(Dataset2):
           - pathway: List of GO terms (or single term) to test (Defaults to all terms that your objectIDs are present in)
           - abcd_values: Boolean. If True, it will return the actual element values in the contingency table, rather than just counts
           - method: Type of multiple testing correction procedure to use
+          - propagate: Boolean. Propagate annotations to the ancestors of the annotated terms
+          - namespace: String. Only test terms of this namespace
           - **kwargs: Additional arguments for multple testing procedure
   
         Outputs:
          - df : Pandas Data Frame of test results
         """
-        return self._gaf.enrich(your_set, pathway, abcd_values, method, **kwargs)
+        if (not propagate) and (namespace is None):
+            return self._gaf.enrich(your_set, pathway=pathway, method=method, table_values=abcd_values, **kwargs)
+        #fi
+        df = self.enrich_many({ 'set' : your_set }, pathway=pathway, abcd_values=abcd_values, method=method, propagate=propagate, namespace=namespace, **kwargs)
+        return df.drop(columns=['set'])
+    #edef
+
+    def enrich_many(self, your_sets, pathway=None, abcd_values=False, method=None, propagate=False, namespace=None, **kwargs):
+        """
+        Check enrichment of GO pathways in many sets at once (e.g. hundreds of differentially expressed gene lists)
+  
+        Inputs:
+          - your_sets: List[List[String]] | dict[string->List[String]]. Lists of Uniprot protein IDs to test
+          - pathway: List of GO terms (or single term) to test (Defaults to all terms that the objectIDs of each set are present in)
+          - abcd_values: Boolean. If True, it will return the actual element values in the contingency table, rather than just counts
+          - method: Type of multiple testing correction procedure to use, applied per set
+          - propagate: Boolean. Propagate annotations to the ancestors of the annotated terms
+          - namespace: String. Only test terms of this namespace
+          - **kwargs: Additional arguments for multple testing procedure
+  
+        Outputs:
+         - df : Pandas Data Frame of test results, with a column 'set' identifying the set
+        """
+        index = self.enrichment_index(propagate=propagate, namespace=namespace)
+        return index.enrich(your_sets, terms=pathway, method=method, table_values=abcd_values, **kwargs)
+    #edef
+
+    def enrich_topology(self, your_set, namespace='biological_process', algorithm='elim', cutoff=0.01, background=None, method=None, **kwargs):
+        """
+        Check enrichment of GO terms in a given set, taking the structure of the GO DAG into account
+        (Alexa et al. 2006, Grossmann et al. 2007).
+        Annotations are propagated to all ancestors, and the algorithms work on the closure of the DAG.
+  
+        Inputs:
+          - your_set: List of Uniprot protein IDs to test
+          - namespace: String. The namespace to test (biological_process|molecular_function|cellular_component)
+          - algorithm: String.
+              'elim': Terms are tested from the most specific to the most general. Objects of a term that is significant
+                      (p < cutoff) are removed from all its ancestors before they are tested.
+              'parentchild': Each term is tested against the objects annotated to any of its parents, rather than all objects.
+          - cutoff: Float. Significance threshold for the elim algorithm
+          - background: List of Uniprot protein IDs. The universe of objects (Default: all objects annotated in this namespace)
+          - method: Type of multiple testing correction procedure to use
+          - **kwargs: Additional arguments for multple testing procedure
+  
+        Outputs:
+         - df : Pandas Data Frame of test results for all terms that contain objects of your set, with columns
+                pathway, depth, method, c2statistic, oddsratio, p, table (, q)
+        """
+        index   = self.enrichment_index(propagate=True, namespace=namespace)
+        closure = self.closure
+        G       = index.matrix.T.tocsr() # term x object
+        
+        universe = np.ones(G.shape[1], dtype=np.int64) if background is None else index.objects.isin(list(background)).astype(np.int64)
+        G        = (G @ ssparse.diags(universe, dtype=np.int64)).tocsr()
+        G.eliminate_zeros()
+        
+        q = index.objects.isin(list(your_set)).astype(np.int64) * universe
+        U = int(universe.sum())
+        n = int(q.sum())
+        
+        # The terms of the index in the closure. Terms unknown to the ontology have no ancestors
+        tidx  = closure.terms.get_indexer(index.terms)
+        depth = np.where(tidx >= 0, closure.depth[tidx], 0)
+        
+        def relation(matrix):
+            # A relation of the closure, restricted to the terms of the index
+            known = np.flatnonzero(tidx >= 0)
+            R = ssparse.csr_matrix((len(tidx), len(tidx)), dtype=np.int64)
+            if len(known) > 0:
+                inv = np.full(len(closure.terms), -1, dtype=np.int64)
+                inv[tidx[known]] = np.arange(len(tidx))[known]
+                sub = matrix[tidx[known], :].tocoo()
+                col = inv[sub.col]
+                R = ssparse.csr_matrix((np.ones((col >= 0).sum(), dtype=np.int64), (known[sub.row[col >= 0]], col[col >= 0])), shape=(len(tidx), len(tidx)))
+            #fi
+            return R
+        #edef
+        
+        a = np.asarray(G @ q).ravel()
+        K = np.asarray(G.sum(axis=1)).ravel()
+        N = np.full(len(K), n, dtype=np.int64)
+        T = np.full(len(K), U, dtype=np.int64)
+        
+        if algorithm == 'elim':
+            strict  = relation(closure.ancestors)
+            strict.setdiag(0)
+            strict.eliminate_zeros()
+            removed = ssparse.csr_matrix(G.shape, dtype=np.int64)
+            p       = np.ones(len(K))
+            for level in np.unique(depth)[::-1]:
+                terms = np.flatnonzero(depth == level)
+                eff   = G[terms] - G[terms].multiply(removed[terms])
+                a[terms] = np.asarray(eff @ q).ravel()
+                K[terms] = np.asarray(eff.sum(axis=1)).ravel()
+                p[terms] = stats.enrichment.set_enrichment_tables(a[terms], K[terms] - a[terms], n - a[terms], U - n - K[terms] + a[terms]).p.values
+                sig = terms[p[terms] < cutoff]
+                if len(sig) > 0:
+                    removed = removed + strict[sig].T @ G[sig]
+                    removed.data[:] = 1
+                #fi
+            #efor
+        elif algorithm == 'parentchild':
+            parents = relation(closure.parents)
+            has_parents = np.diff(parents.indptr) > 0
+            population = (parents @ G).tocsr()
+            population.data[:] = 1
+            N = np.where(has_parents, np.asarray(population @ q).ravel(), n)
+            T = np.where(has_parents, np.asarray(population.sum(axis=1)).ravel(), U)
+        else:
+            utils.error("Unknown algorithm '%s'. Use 'elim' or 'parentchild'." % algorithm)
+            return None
+        #fi
+        
+        test = np.flatnonzero(a > 0)
+        a, b, c, d = a[test], K[test] - a[test], N[test] - a[test], T[test] - N[test] - K[test] + a[test]
+        R = stats.enrichment.set_enrichment_tables(a, b, c, d)
+        R.insert(0, 'depth', depth[test])
+        R.insert(0, 'pathway', np.asarray(index.terms)[test])
+        R['table'] = [ [[ai, bi], [ci, di]] for (ai, bi, ci, di) in zip(a.tolist(), b.tolist(), c.tolist(), d.tolist()) ]
+        
+        if method is not None:
+            R['q'] = stats.p_adjust(R.p.values, method, **kwargs)
+        #fi
+        return R
     #edef
                            
     def summary(self, your_sets):
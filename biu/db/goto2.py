@@ -302,7 +302,7 @@ class GOTO2(Dataset2):
         return self._obj[oname].filter(chrom, start, end, *pargs, **kwargs)
     #edef
     
-    def filter_regions(self, regions, chrom=None, start=None, end=None, *pargs, **kwargs):
+    def filter_regions(self, regions, chrom=None, start=None, end=None, *pargs, n_workers=None, **kwargs):
         """
         Perform a filter for several regions
         
@@ -310,12 +310,13 @@ class GOTO2(Dataset2):
         -----------
         regions: A list of 3-tuples (chrom, start, end) for each region of interest
         chrom, start, end: Ignored
+        n_workers: int. Evaluate the regions in a pool of this many processes. See VCF2.merge
         *pargs, **kwargs: See additional arguments for VCF2.filter
         
         Returns: VCF2 object
         """
         rets = [ self.filter(c, s, e, *pargs, **kwargs) for (c,s,e) in regions ]
-        return rets[0].merge(rets)
+        return rets[0].merge(rets, n_workers=n_workers)
     #edef
 
 
@@ -367,5 +368,21 @@ class GOTO2(Dataset2):
         return self._obj[oname].who_has(chrom, *pargs, **kwargs)
     #edef
 
+    def who_has_many(self, variants, *pargs, **kwargs):
+        """
+        Determine who has each of a set of variants
+
+        parameters:
+        -----------
+        variants: DataFrame with columns chrom, pos, ref, alt. The variants to look up
+        *pargs, **kwargs: See additional arguments for VCF2.who_has_many
+
+        returns:
+        --------
+        Boolean DataFrame of variants x samples (in the order of the input), indexed by variant identifier.
+        """
+        return self._who_has_many_per_chrom(variants, *pargs, **kwargs)
+    #edef
+
     
 #eclass
\ No newline at end of file
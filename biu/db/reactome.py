@@ -1,9 +1,15 @@
 from ..structures import Dataset2
+from ..structures import DiskCache
 from .. import utils
 from .. import stats
 from .. import ops
 
+import os
+import collections.abc
+
 pd = utils.py.loadExternalModule('pandas')
+np = utils.py.loadExternalModule('numpy')
+ssparse = utils.py.loadExternalModule('scipy.sparse')
 
 class Reactome(Dataset2):
     """
@@ -54,82 +60,231 @@ class Reactome(Dataset2):
                            lambda f: pd.read_csv(f['pathway_hierarchy.tsv'], sep='\t',
                                                  names=['parent', 'child']))
         
-        def make_index():
+        def make_index(f):
             """
-            Load the reactome into a useful structure
+            Load the reactome into a useful structure.
+            The index is cached next to the acquired files, and only rebuilt when they change.
             """
+            sources = [ f[k] for k in sorted(f.keys()) ]
+            key     = 'all' if self._organisms is None else DiskCache.key(*sorted(self._organisms))
+            cache   = os.path.join(os.path.dirname(os.path.abspath(sources[0])), 'reactome_index.%s.npz' % key)
 
-            from collections import namedtuple
+            if os.path.exists(cache) and (os.path.getmtime(cache) >= max([ os.path.getmtime(s) for s in sources ])):
+                utils.dbm("Loading Reactome index from '%s'" % cache)
+                return self.ReactomeIndex.load(cache)
+            #fi
 
-            pathways = {}
-            proteins = None
-            metabolites = None
-            
-            pathway_names           = self.pathway_names if self._organisms is None else self.pathway_names[self.pathway_names.organism.isin(self._organisms)]
-            pathway_protein_map     = self.pathway_protein_map if self._organisms is None else self.pathway_protein_map[self.pathway_protein_map.organism.isin(self._organisms)]
+            pathway_names          = self.pathway_names if self._organisms is None else self.pathway_names[self.pathway_names.organism.isin(self._organisms)]
+            pathway_protein_map    = self.pathway_protein_map if self._organisms is None else self.pathway_protein_map[self.pathway_protein_map.organism.isin(self._organisms)]
             pathway_metabolite_map = self.pathway_metabolite_map if self._organisms is None else self.pathway_metabolite_map[self.pathway_metabolite_map.organism.isin(self._organisms)]
 
-            print('Adding pathways')
-            for i, p in pathway_names.iterrows():
-                pathways[p.pathway] = self.ReactomePathway(p.pathway, p.description, p.organism)
-            #efor
-
-            print('Adding proteins')
-            proteins = { p : self.ReactomeNode(p, 'protein') for p in pathway_protein_map.uniprot }
-            for i, a in pathway_protein_map.iterrows():
-                if a.pathway not in pathways:
-                    pathways[a.pathway] = self.ReactomePathway(a.pathway, 'Unknown pathway', a.organism)
-                #fi
-                proteins[a.uniprot].add_pathway(pathways[a.pathway])
-                pathways[a.pathway].add_protein(proteins[a.uniprot])
-            #efor
-
-            print('Adding metabolites')
-            metabolites = { p : self.ReactomeNode(p, 'metabolite') for p in pathway_metabolite_map.chemebi }
-            for i, a in pathway_metabolite_map.iterrows():
-                if a.pathway not in pathways:
-                    pathways[a.pathway] = self.ReactomePathway(a.pathway, 'Unknown pathway', a.organism)
-                #fi
-                metabolites[a.chemebi].add_pathway(pathways[a.pathway])
-                pathways[a.pathway].add_metabolite(metabolites[a.chemebi])
+            utils.dbm("Building Reactome index")
+            index = self.ReactomeIndex.build(pathway_names, pathway_protein_map, pathway_metabolite_map, self.pathway_hierarchy)
+            try:
+                index.save(cache)
+            except OSError:
+                utils.warning("Could not write the Reactome index to '%s'." % cache)
+            #etry
+            return index
+        #edef
+        
+        self._obj.register('index', [ 'pathway_uniprot.tsv', 'pathway_chemebi.tsv', 'pathway_names.tsv', 'pathway_hierarchy.tsv' ], make_index)
+        self._obj.register('enrichment_index', [],
+                           lambda f: stats.enrichment.EnrichmentIndex.from_matrix(*self.index.protein_matrix()))
+    #edef
+    
+    ##################################################################
+    
+    class ReactomeIndex(object):
+        """
+        Compact index of the Reactome pathways, proteins and metabolites, and the relations between them.
+        Relations are stored as integer adjacency arrays (indptr, indices), like the rows of a CSR matrix.
+        ReactomePathway and ReactomeNode objects are only created when they are accessed.
+        """
+        
+        _relations = [ 'pathway_proteins', 'protein_pathways', 'pathway_metabolites', 'metabolite_pathways',
+                       'pathway_children', 'pathway_parents' ]
+        
+        def __init__(self, arrays):
+            """
+            Initialize the index from its arrays. Use ReactomeIndex.build or ReactomeIndex.load to make one.
+            """
+            self._arrays = arrays
+            self._views  = {}
+            self.pathways    = Reactome.ReactomeMap(self, 'pathway')
+            self.proteins    = Reactome.ReactomeMap(self, 'protein')
+            self.metabolites = Reactome.ReactomeMap(self, 'metabolite')
+        #edef
+        
+        @staticmethod
+        def _adjacency(source, target, n):
+            """
+            Group target by source into (indptr, indices), keeping the order in which the pairs appear.
+            """
+            order   = np.argsort(source, kind='stable')
+            indptr  = np.concatenate([ [ 0 ], np.cumsum(np.bincount(source, minlength=n)) ]).astype(np.int64)
+            return indptr, np.asarray(target, dtype=np.int64)[order]
+        #edef
+        
+        @staticmethod
+        def _compact(values):
+            """
+            Store identifiers as fixed-width strings (or numbers), so the arrays can be saved without pickling.
+            """
+            values = np.asarray(values)
+            return values.astype(str) if values.dtype == object else values
+        #edef
+        
+        @classmethod
+        def build(cls, pathway_names, pathway_protein_map, pathway_metabolite_map, pathway_hierarchy):
+            """
+            Build the index from the Reactome tables.
+            """
+            pathway_names = pathway_names.drop_duplicates('pathway', keep='last')
+            
+            # Pathways that are only mentioned in the maps
+            extra = pd.concat([ pathway_protein_map[['pathway', 'organism']], pathway_metabolite_map[['pathway', 'organism']] ]).drop_duplicates('pathway')
+            extra = extra[~extra.pathway.isin(pathway_names.pathway)]
+            
+            arrays = {}
+            arrays['pathway_ids']  = cls._compact(np.concatenate([ pathway_names.pathway.values, extra.pathway.values ]))
+            arrays['pathway_desc'] = cls._compact(np.concatenate([ pathway_names.description.values, [ 'Unknown pathway' ] * len(extra) ]).astype(object))
+            arrays['pathway_org']  = cls._compact(np.concatenate([ pathway_names.organism.values, extra.organism.values ]).astype(object))
+            pathways = pd.Index(arrays['pathway_ids'])
+            
+            for (kind, table, column) in [ ('protein', pathway_protein_map, 'uniprot'), ('metabolite', pathway_metabolite_map, 'chemebi') ]:
+                nodes = pd.unique(table[column])
+                pairs = table[[column, 'pathway']].drop_duplicates()
+                nidx  = pd.Index(nodes).get_indexer(pairs[column])
+                pidx  = pathways.get_indexer(pairs.pathway)
+                
+                arrays['%s_ids' % kind] = cls._compact(nodes)
+                arrays['pathway_%ss_indptr' % kind], arrays['pathway_%ss' % kind] = cls._adjacency(pidx, nidx, len(pathways))
+                arrays['%s_pathways_indptr' % kind], arrays['%s_pathways' % kind] = cls._adjacency(nidx, pidx, len(nodes))
             #efor
-
-            print('Adding hierarchy')
-            for i, row in self.pathway_hierarchy.iterrows():
-                if (row.parent not in pathways) or (row.child not in pathways):
-                    continue
+            
+            parents  = pathways.get_indexer(pathway_hierarchy.parent)
+            children = pathways.get_indexer(pathway_hierarchy.child)
+            keep     = (parents >= 0) & (children >= 0)
+            arrays['pathway_children_indptr'], arrays['pathway_children'] = cls._adjacency(parents[keep], children[keep], len(pathways))
+            arrays['pathway_parents_indptr'], arrays['pathway_parents']   = cls._adjacency(children[keep], parents[keep], len(pathways))
+            
+            return cls(arrays)
+        #edef
+        
+        def save(self, filename):
+            """
+            Save the index as a (compressed) numpy archive
+            """
+            tmp = '%s.tmp.%d.npz' % (filename[:-4], os.getpid())
+            np.savez_compressed(tmp, **self._arrays)
+            os.replace(tmp, filename)
+        #edef
+        
+        @classmethod
+        def load(cls, filename):
+            """
+            Load an index saved with save
+            """
+            with np.load(filename, allow_pickle=False) as data:
+                return cls({ k : data[k] for k in data.files })
+            #ewith
+        #edef
+        
+        def ids(self, kind):
+            """
+            The identifiers of all pathways/proteins/metabolites (kind), as a numpy array
+            """
+            return self._arrays['%s_ids' % kind]
+        #edef
+        
+        def related(self, relation, i):
+            """
+            The integer indexes related to the i-th object, for a relation (e.g. 'pathway_proteins')
+            """
+            indptr = self._arrays['%s_indptr' % relation]
+            return self._arrays[relation][indptr[i]:indptr[i+1]]
+        #edef
+        
+        def view(self, kind, i):
+            """
+            The ReactomePathway or ReactomeNode object of the i-th pathway/protein/metabolite (kind)
+            """
+            if (kind, i) not in self._views:
+                if kind == 'pathway':
+                    self._views[(kind, i)] = Reactome.ReactomePathway(self, i)
+                else:
+                    self._views[(kind, i)] = Reactome.ReactomeNode(self, kind, i)
                 #fi
-
-                parent = pathways[row.parent]
-                child  = pathways[row.child]
-
-                parent.add_child(child)
-                child.add_parent(parent)
-            #efor
-
-            nt = namedtuple('ReactomeIndex', ['pathways', 'proteins', 'metabolites'])
-
-            return nt(pathways, proteins, metabolites)
+            #fi
+            return self._views[(kind, i)]
         #edef
         
-        self._obj.register('index', [], lambda f: make_index())
-    #edef
+        def protein_matrix(self):
+            """
+            The protein x pathway incidence matrix
+            Returns: protein identifiers, pathway identifiers, scipy.sparse.csr_matrix
+            """
+            indptr  = self._arrays['protein_pathways_indptr']
+            indices = self._arrays['protein_pathways']
+            matrix  = ssparse.csr_matrix((np.ones(len(indices), dtype=np.int64), indices, indptr),
+                                         shape=(len(self.ids('protein')), len(self.ids('pathway'))))
+            return self.ids('protein'), self.ids('pathway'), matrix
+        #edef
+    #eclass
+    
+    ##################################################################
+    
+    class ReactomeMap(collections.abc.Mapping):
+        """
+        A read-only dictionary of identifier -> ReactomePathway/ReactomeNode object, for one kind of object in a ReactomeIndex.
+        """
+        
+        def __init__(self, index, kind):
+            self._index = index
+            self._kind  = kind
+            self._lookup = None
+        #edef
+        
+        def _position(self, identifier):
+            if self._lookup is None:
+                self._lookup = { k : i for (i, k) in enumerate(self._index.ids(self._kind).tolist()) }
+            #fi
+            return self._lookup[identifier]
+        #edef
+        
+        def __getitem__(self, identifier):
+            return self._index.view(self._kind, self._position(identifier))
+        #edef
+        
+        def __contains__(self, identifier):
+            try:
+                self._position(identifier)
+                return True
+            except (KeyError, TypeError):
+                return False
+            #etry
+        #edef
+        
+        def __iter__(self):
+            return iter(self._index.ids(self._kind).tolist())
+        #edef
+        
+        def __len__(self):
+            return len(self._index.ids(self._kind))
+        #edef
+    #eclass
     
     ##################################################################
     
     class ReactomePathway(object):
         """
         Internal representation of a reactome pathway.
-        
+        A view on a pathway in a ReactomeIndex.
         """
-        def __init__(self, identifier, description, organism):
-            self._id   = identifier
-            self._desc = description
-            self._org  = organism
-            self._proteins    = []
-            self._metabolites = []
-            self._children    = []
-            self._parents     = []
+        def __init__(self, index, i):
+            self._index = index
+            self._i     = i
         #edef
         
         @property
@@ -137,7 +292,7 @@ class Reactome(Dataset2):
             """
             Return the identifier of this pathway
             """
-            return self._id
+            return self._index.ids('pathway')[self._i].item()
         #edef
         
         @property
@@ -145,7 +300,7 @@ class Reactome(Dataset2):
             """
             Return a description of this pathway
             """
-            return self._desc
+            return self._index._arrays['pathway_desc'][self._i].item()
         #edef
         
         @property
@@ -153,7 +308,7 @@ class Reactome(Dataset2):
             """
             Return the organism of this pathway
             """
-            return self._org
+            return self._index._arrays['pathway_org'][self._i].item()
         #edef
         
         @property
@@ -161,7 +316,7 @@ class Reactome(Dataset2):
             """
             Return the proteins annotated to this object
             """
-            return self._proteins
+            return [ self._index.view('protein', j) for j in self._index.related('pathway_proteins', self._i) ]
         #edef
         
         @property
@@ -169,7 +324,7 @@ class Reactome(Dataset2):
             """
             Return the metabolites annotated to this object
             """
-            return self._metabolites
+            return [ self._index.view('metabolite', j) for j in self._index.related('pathway_metabolites', self._i) ]
         #edef
         
         @property
@@ -177,7 +332,7 @@ class Reactome(Dataset2):
             """
             Return the parent pathway(s) of this object
             """
-            return self._parents
+            return [ self._index.view('pathway', j) for j in self._index.related('pathway_parents', self._i) ]
         #edef
         
         @property
@@ -185,7 +340,7 @@ class Reactome(Dataset2):
             """
             Return the children pathways of this object
             """
-            return self._children
+            return [ self._index.view('pathway', j) for j in self._index.related('pathway_children', self._i) ]
         #edef
         
         @property
@@ -193,62 +348,27 @@ class Reactome(Dataset2):
             """
             Returns the number of (proteins, metabolites) for all the leaves in the hierarchy from this node onwards.
             """
-            nodes = [ self ]
+            nodes = [ self._i ]
             total_proteins    = 0
             total_metabolites = 0
             for node in nodes:
-                if len(node.children) == 0:
-                    total_proteins += len(node.proteins)
-                    total_metabolites += len(node.metabolites)
+                children = self._index.related('pathway_children', node)
+                if len(children) == 0:
+                    total_proteins += len(self._index.related('pathway_proteins', node))
+                    total_metabolites += len(self._index.related('pathway_metabolites', node))
                 else:
-                    nodes.extend(node.children)
+                    nodes.extend(children)
                 #fi
             #efor
             return (total_proteins, total_metabolites)
         #edef
         
-        def add_protein(self, protein):
-            """
-            Add a protein to this pathway
-            parameters:
-            -----------
-            protein: ReactomeNode object
-            """
-            if protein not in self._proteins:
-                self._proteins.append(protein)
-            #fi
+        def __eq__(self, other):
+            return isinstance(other, type(self)) and (self._index is other._index) and (self._i == other._i)
         #edef
         
-        def add_metabolite(self, metabolite):
-            """
-            Add a metabolite to this pathway
-            parameters:
-            -----------
-            metabolite: ReactomeNode object
-            """
-            if metabolite not in self._metabolites:
-                self._metabolites.append(metabolite)
-            #fi
-        #edef
-        
-        def add_child(self, pathway):
-            """
-            Add a child pathway to this pathway
-            parameters:
-            -----------
-            pathway: ReactomePathway object
-            """
-            self._children.append(pathway)
-        #edef
-        
-        def add_parent(self, pathway):
-            """
-            Add a parent pathway to this pathway
-            parameters:
-            -----------
-            pathway: ReactomePathway object
-            """
-            self._parents.append(pathway)
+        def __hash__(self):
+            return hash(('pathway', self._i))
         #edef
         
         def __str__(self):
@@ -280,11 +400,12 @@ class Reactome(Dataset2):
     class ReactomeNode(object):
         """
         A class to handle nodes (proteins/metabolites) in the reactome database
+        A view on a protein or metabolite in a ReactomeIndex.
         """
-        def __init__(self, identifier, type):
-            self._id   = identifier
-            self._type = type
-            self._pathways = []
+        def __init__(self, index, type, i):
+            self._index = index
+            self._type  = type
+            self._i     = i
         #edef
         
         @property
@@ -292,7 +413,7 @@ class Reactome(Dataset2):
             """
             Return the identifier of this object
             """
-            return self._id
+            return self._index.ids(self._type)[self._i].item()
         #edef
         
         @property
@@ -308,19 +429,15 @@ class Reactome(Dataset2):
             """
             Return a list of all pathways that this object is annotated to
             """
-            return self._pathways
+            return [ self._index.view('pathway', j) for j in self._index.related('%s_pathways' % self._type, self._i) ]
         #edef
         
-        def add_pathway(self, pathway):
-            """
-            Add a pathway to this object
-            parameters:
-            ----------
-            pathway: A ReactomePathway object
-            """
-            if pathway not in self._pathways:
-                self._pathways.append(pathway)
-            #fi
+        def __eq__(self, other):
+            return isinstance(other, type(self)) and (self._index is other._index) and (self._type == other._type) and (self._i == other._i)
+        #edef
+        
+        def __hash__(self):
+            return hash((self._type, self._i))
         #edef
         
         def __str__(self):
@@ -427,32 +544,34 @@ class Reactome(Dataset2):
         Outputs:
          - df : Pandas Data Frame of test results
         """
-        your_set = set([ str(ID) for ID in your_set if ID is not None]) & set(self.proteins)
-
-        if pathway is None:
-            pathway = set([ p.id for prot in your_set for p in self.protein[prot].pathways if prot in self.proteins ])
-        #fi
+        df = self.enrich_many({ 'set' : your_set }, background=background, pathway=pathway, method=method, table_values=True, **kwargs)
+        return df.drop(columns=['set'])
+    #edef
 
-        if background is None:
-            background = self.proteins
-        #fi
-        background = set(background)
+    def enrich_many(self, your_sets, background=None, pathway=None, method=None, table_values=False, **kwargs):
+        """
+        Check enrichment of Reactome pathways in many sets at once.
 
-        if isinstance(pathway, str):
-            pathway = [ pathway ]
-        #fi
-        R = []
-        for p in pathway:
-            pathway_genes = set([prot.id for prot in self.pathway[p].proteins ]) & background
-            res = stats.enrichment.set_enrichment(your_set, pathway_genes, background)
-            R.append((p, self.pathway[p].description, res.method, res.c2statistic, res.oddsratio, res.pvalue, res.table, res.table_values))
-        #efor
+        Inputs:
+          - your_sets: List[List[String]] | dict[string->List[String]]. Lists of Uniprot IDs to test
+          - pathway: List of pathways (or single pathway) to test in each set (Defaults to all pathways that the IDs of each set are present in)
+          - background: List of Uniprot IDs to use as background (e.g. set of all expressed genes)
+          - method: Type of multiple testing correction procedure to use, applied per set
+          - table_values: Boolean. Also return the actual elements in the contingency tables (slow for many tests)
+          - **kwargs: Additional arguments for biu.stats.p_adjust
 
-        df = pd.DataFrame(R, columns=['pathway', 'name', 'method', 'c2statistic', 'oddsratio', 'p', 'table', 'table_values'])
-        if method is not None:
-            df['q'] = stats.p_adjust(df.p.values, method, **kwargs)
+        Outputs:
+         - df : Pandas Data Frame of test results, with a column 'set' identifying the set
+        """
+        if not isinstance(your_sets, dict):
+            your_sets = { "set_%d" % (i+1) : s for (i,s) in enumerate(your_sets) }
         #fi
+        proteins  = set(self.proteins)
+        your_sets = { k : set([ str(ID) for ID in s if ID is not None ]) & proteins for (k, s) in your_sets.items() }
 
+        df = self.enrichment_index.enrich(your_sets, background=background, terms=pathway, method=method,
+                                          table_values=table_values, **kwargs)
+        df.insert(2, 'name', [ self.pathway[p].description if p in self.pathway else None for p in df.pathway ])
         return df
     #edef
     
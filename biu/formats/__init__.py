@@ -2,6 +2,7 @@ from .pedUtils import PED as PED
 
 from .fastaUtils import Fasta as Fasta
 from .gff3Utils import GFF3 as GFF3
+from .gff3Utils import GFF3Columns as GFF3Columns
 from .vcfUtils import VCF as VCF
 from .vcf2 import VCF2 as VCF2
 from .vcf2 import BiuVariant as BiuVariant
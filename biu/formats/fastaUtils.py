@@ -1,4 +1,10 @@
 import gzip
+import os
+import mmap
+import zlib
+import struct
+import bisect
+from collections import OrderedDict
 
 from .. import utils
 
@@ -6,6 +12,424 @@ from .seqUtils import Sequence
 
 ###############################################################################
 
+class BGZFReader(object):
+  """
+  Random access to the uncompressed content of a BGZF (bgzip) compressed file.
+  Block offsets are taken from the .gzi index (samtools/htslib format), which is built if it does not exist.
+  Recently used blocks are kept decompressed in memory.
+  """
+
+  __slots__ = [ '__fd', '__coffsets', '__uoffsets', '__cache', '__cacheSize' ]
+
+  #__fd = None
+  #__coffsets = None
+  #__uoffsets = None
+  #__cache = None
+  #__cacheSize = None
+
+  def __init__(self, fileName, gziFile=None, cacheSize=64):
+    gziFile = (fileName + '.gzi') if gziFile is None else gziFile
+    self.__fd = open(fileName, 'rb')
+
+    if os.path.exists(gziFile) and (os.path.getmtime(gziFile) >= os.path.getmtime(fileName)):
+      self.__coffsets, self.__uoffsets = BGZFReader.readGZI(gziFile)
+    else:
+      utils.dbm("Building BGZF index for '%s'" % fileName)
+      self.__coffsets, self.__uoffsets = BGZFReader.buildGZI(self.__fd)
+      try:
+        BGZFReader.writeGZI(gziFile, self.__coffsets, self.__uoffsets)
+      except OSError:
+        utils.warning("Could not write BGZF index to '%s'. It will be rebuilt next time." % gziFile)
+      #etry
+    #fi
+
+    self.__cache = OrderedDict()
+    self.__cacheSize = cacheSize
+  #edef
+
+  @staticmethod
+  def isBGZF(fileName):
+    """
+    Determine whether a file is BGZF compressed, from the header of the first block.
+    """
+    with open(fileName, 'rb') as fd:
+      header = fd.read(18)
+    #ewith
+    return (len(header) == 18) and (header[:4] == b'\x1f\x8b\x08\x04') and (header[12:14] == b'BC')
+  #edef
+
+  @staticmethod
+  def readGZI(gziFile):
+    with open(gziFile, 'rb') as fd:
+      data = fd.read()
+    #ewith
+    n = struct.unpack('<Q', data[:8])[0]
+    pairs = struct.unpack('<%dQ' % (2 * n), data[8:8 + 16 * n])
+    # The .gzi file omits the first block, which starts at (0, 0)
+    return [ 0 ] + list(pairs[0::2]), [ 0 ] + list(pairs[1::2])
+  #edef
+
+  @staticmethod
+  def writeGZI(gziFile, coffsets, uoffsets):
+    with open(gziFile, 'wb') as fd:
+      fd.write(struct.pack('<Q', len(coffsets) - 1))
+      for (c, u) in zip(coffsets[1:], uoffsets[1:]):
+        fd.write(struct.pack('<QQ', c, u))
+      #efor
+    #ewith
+  #edef
+
+  @staticmethod
+  def buildGZI(fd):
+    """
+    Scan the block headers of a BGZF file. Only the headers and the uncompressed sizes are read.
+    Returns: compressed and uncompressed start offsets of each (non-empty) block
+    """
+    coffsets, uoffsets = [], []
+    c, u = 0, 0
+    while True:
+      fd.seek(c)
+      header = fd.read(18)
+      if len(header) < 18:
+        break
+      #fi
+      bsize = struct.unpack('<H', header[16:18])[0] + 1
+      fd.seek(c + bsize - 4)
+      isize = struct.unpack('<I', fd.read(4))[0]
+      if isize > 0:
+        coffsets.append(c)
+        uoffsets.append(u)
+      #fi
+      c += bsize
+      u += isize
+    #ewhile
+    return coffsets, uoffsets
+  #edef
+
+  def __block(self, i):
+    if i in self.__cache:
+      self.__cache.move_to_end(i)
+      return self.__cache[i]
+    #fi
+
+    self.__fd.seek(self.__coffsets[i])
+    header = self.__fd.read(18)
+    bsize  = struct.unpack('<H', header[16:18])[0] + 1
+    data   = zlib.decompress(header + self.__fd.read(bsize - 18), 31)
+
+    self.__cache[i] = data
+    if len(self.__cache) > self.__cacheSize:
+      self.__cache.popitem(last=False)
+    #fi
+    return data
+  #edef
+
+  def read(self, start, end):
+    """
+    Read the uncompressed bytes [start, end)
+    """
+    data = []
+    while start < end:
+      i = bisect.bisect_right(self.__uoffsets, start) - 1
+      block = self.__block(i)
+      chunk = block[start - self.__uoffsets[i]:end - self.__uoffsets[i]]
+      if len(chunk) == 0:
+        break
+      #fi
+      data.append(chunk)
+      start += len(chunk)
+    #ewhile
+    return b''.join(data)
+  #edef
+
+  def __iter__(self):
+    """
+    Iterate over the lines of the uncompressed content
+    """
+    self.__fd.seek(0)
+    with gzip.GzipFile(fileobj=self.__fd, mode='rb') as fd:
+      for line in fd:
+        yield line
+      #efor
+    #ewith
+  #edef
+
+  def close(self):
+    self.__fd.close()
+  #edef
+
+#eclass
+
+###############################################################################
+
+class FastaIndex(object):
+  """
+  A read-only mapping of sequence names to sequences in a FASTA file, which are only read from disk when accessed.
+  Sequence positions are found with a samtools faidx (.fai) index, which is built next to the FASTA file if it does not exist.
+  Plain files are memory-mapped, and BGZF (bgzip) compressed files are read through their .gzi index.
+  """
+
+  __slots__ = [ '__fileName', '__seqType', '__index', '__reader', '__fullNames' ]
+
+  #__fileName = None
+  #__seqType = None
+  #__index = None
+  #__reader = None
+  #__fullNames = None
+
+  def __init__(self, fileName, seqType=Sequence.DNATYPE, faiFile=None, gziFile=None):
+    """
+    Open an indexed FASTA file.
+    parameters:
+    -----------
+    fileName: The FASTA file. Plain, or compressed with bgzip
+    seqType:  The type of the sequences in the file
+    faiFile:  The .fai index file (default: fileName + '.fai')
+    gziFile:  The .gzi index file for bgzip compressed files (default: fileName + '.gzi')
+    """
+    self.__fileName = fileName
+    self.__seqType  = seqType
+    self.__fullNames = {}
+    faiFile = (fileName + '.fai') if faiFile is None else faiFile
+
+    if BGZFReader.isBGZF(fileName):
+      self.__reader = BGZFReader(fileName, gziFile)
+    elif fileName[-2:] == 'gz':
+      raise ValueError("'%s' is gzip compressed, but not with bgzip. It cannot be indexed." % fileName)
+    else:
+      with open(fileName, 'rb') as fd:
+        self.__reader = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(fileName) > 0 else b''
+      #ewith
+    #fi
+
+    if os.path.exists(faiFile) and (os.path.getmtime(faiFile) >= os.path.getmtime(fileName)):
+      self.__index = FastaIndex.readFai(faiFile)
+    else:
+      utils.dbm("Building FASTA index for '%s'" % fileName)
+      if isinstance(self.__reader, BGZFReader):
+        self.__index = FastaIndex.buildFai(self.__reader)
+      else:
+        with open(fileName, 'rb') as fd:
+          self.__index = FastaIndex.buildFai(fd)
+        #ewith
+      #fi
+      try:
+        FastaIndex.writeFai(faiFile, self.__index)
+      except OSError:
+        utils.warning("Could not write FASTA index to '%s'. It will be rebuilt next time." % faiFile)
+      #etry
+    #fi
+  #edef
+
+  @staticmethod
+  def readFai(faiFile):
+    index = OrderedDict()
+    with open(faiFile, 'r') as fd:
+      for line in fd:
+        name, length, offset, linebases, linewidth = line.rstrip('\n').split('\t')[:5]
+        index[name] = (int(length), int(offset), int(linebases), int(linewidth))
+      #efor
+    #ewith
+    return index
+  #edef
+
+  @staticmethod
+  def writeFai(faiFile, index):
+    with open(faiFile, 'w') as fd:
+      for (name, entry) in index.items():
+        fd.write('%s\t%d\t%d\t%d\t%d\n' % ((name,) + tuple(entry)))
+      #efor
+    #ewith
+  #edef
+
+  @staticmethod
+  def buildFai(lines):
+    """
+    Build a faidx index from the lines (as bytes) of a FASTA file.
+    Returns: OrderedDict of name -> (length, offset, linebases, linewidth)
+    """
+    index  = OrderedDict()
+    offset = 0
+    name   = None
+
+    for line in lines:
+      if line[:1] == b'>':
+        if name is not None:
+          index[name] = (length, seqOffset, linebases, linewidth)
+        #fi
+        name = line[1:].strip().split(b' ')[0].decode()
+        seqOffset, length, linebases, linewidth, lastLine = offset + len(line), 0, 0, 0, False
+      elif name is not None:
+        bases = len(line.rstrip(b'\r\n'))
+        if bases > 0:
+          if lastLine:
+            raise ValueError("Sequence '%s' has lines of different lengths, and cannot be indexed." % name)
+          elif linebases == 0:
+            linebases, linewidth = bases, len(line)
+          #fi
+          lastLine = (bases < linebases) or (len(line) < linewidth)
+          length += bases
+        #fi
+      #fi
+      offset += len(line)
+    #efor
+    if name is not None:
+      index[name] = (length, seqOffset, linebases, linewidth)
+    #fi
+    return index
+  #edef
+
+  def length(self, name):
+    return self.__index[name][0]
+  #edef
+
+  def fetch(self, name, start=0, end=None):
+    """
+    Fetch the subsequence [start, end) (0-based) of a sequence, reading only the relevant part of the file.
+    """
+    length, offset, linebases, linewidth = self.__index[name]
+    end   = length if end is None else min(end, length)
+    start = max(start, 0)
+    if start >= end:
+      return ''
+    #fi
+
+    def pos(p):
+      return offset + (p // linebases) * linewidth + (p % linebases)
+    #edef
+
+    if isinstance(self.__reader, BGZFReader):
+      data = self.__reader.read(pos(start), pos(end - 1) + 1)
+    else:
+      data = self.__reader[pos(start):pos(end - 1) + 1]
+    #fi
+    return data.replace(b'\n', b'').replace(b'\r', b'').decode()
+  #edef
+
+  def fullName(self, name):
+    """
+    The full header line of a sequence (without the '>'), read from just before the sequence.
+    """
+    if name in self.__fullNames:
+      return self.__fullNames[name]
+    #fi
+
+    offset = self.__index[name][1]
+    start  = offset
+    while True:
+      start  = max(0, start - 1024)
+      header = (self.__reader.read(start, offset) if isinstance(self.__reader, BGZFReader) else self.__reader[start:offset]).rstrip(b'\r\n')
+      if (b'\n' in header) or (start == 0):
+        self.__fullNames[name] = header.split(b'\n')[-1][1:].decode().strip()
+        return self.__fullNames[name]
+      #fi
+    #ewhile
+  #edef
+
+  def __getitem__(self, name):
+    if name not in self.__index:
+      raise KeyError(name)
+    #fi
+    return IndexedSequence(name, self, self.__seqType)
+  #edef
+
+  def __contains__(self, name):
+    return name in self.__index
+  #edef
+
+  def __len__(self):
+    return len(self.__index)
+  #edef
+
+  def __iter__(self):
+    return iter(self.__index.keys())
+  #edef
+
+  def keys(self):
+    return self.__index.keys()
+  #edef
+
+  def values(self):
+    return [ self[k] for k in self.__index ]
+  #edef
+
+  def items(self):
+    return [ (k, self[k]) for k in self.__index ]
+  #edef
+
+#eclass
+
+###############################################################################
+
+class IndexedSequence(Sequence):
+  """
+  A Sequence in an indexed FASTA file (see FastaIndex).
+  Its content is read from the file on access, and slicing only reads the requested part of the file.
+  """
+
+  __slots__ = [ '__index' ]
+
+  def __init__(self, name, index, seqType=Sequence.DNATYPE):
+    Sequence.__init__(self, name, None, seqType)
+    self.__index = index
+  #edef
+
+  @property
+  def seq(self):
+    return self.__index.fetch(self.name)
+  #edef
+
+  @property
+  def fullName(self):
+    return self.__index.fullName(self.name)
+  #edef
+
+  def load(self):
+    """
+    Read the whole sequence into a Sequence object
+    """
+    return Sequence(self.name, self.seq, self.seqType, self.fullName)
+  #edef
+
+  def __str__(self):
+    return self.seq
+  #edef
+
+  def __len__(self):
+    return self.__index.length(self.name)
+  #edef
+
+  def __getitem__(self, s):
+    if isinstance(s, slice):
+      start, stop, step = s.indices(len(self))
+      if step == 1:
+        return Sequence(self.name, self.__index.fetch(self.name, start, stop), self.seqType, self.fullName)
+      #fi
+      return Sequence(self.name, self.seq[s], self.seqType, self.fullName)
+    #fi
+    s = s + len(self) if s < 0 else s
+    if (s < 0) or (s >= len(self)):
+      raise IndexError("Sequence index out of range")
+    #fi
+    return Sequence(self.name, self.__index.fetch(self.name, s, s + 1), self.seqType, self.fullName)
+  #edef
+
+  def translate(self):
+    return self.load().translate()
+  #edef
+
+  def reverseTranslate(self):
+    return self.load().reverseTranslate()
+  #edef
+
+  def revcomp(self):
+    return self.load().revcomp()
+  #edef
+
+#eclass
+
+###############################################################################
+
 class Fasta(object):
 
   __slots__ = [ '__entries', '__fileName', '__iterKeys' ]
@@ -14,10 +438,28 @@ class Fasta(object):
   #__fileName = None
   #__iterKeys = None
 
-  def __init__(self, data, seqType=Sequence.DNATYPE):
+  def __init__(self, data, seqType=Sequence.DNATYPE, indexed=False):
+    """
+    Initialize a Fasta object.
+    parameters:
+    -----------
+    data: A FASTA filename, a dictionary of sequences, or a list of sequences
+    seqType: The type of the sequences
+    indexed: When reading from a file, do not load the sequences into memory, but read them from the file when they are accessed.
+             An index (.fai) is built next to the file if it does not exist yet. Files must be uncompressed, or compressed with bgzip.
+    """
     self.__fileName = None
 
-    if isinstance(data, str):
+    if isinstance(data, str) and indexed and (data[-2:] == "gz") and not(BGZFReader.isBGZF(data)):
+      utils.warning("'%s' is not compressed with bgzip and cannot be indexed. Loading it into memory." % data)
+      indexed = False
+    #fi
+
+    if isinstance(data, str) and indexed:
+      utils.dbm("Fasta input source is indexed file")
+      self.__entries = FastaIndex(data, seqType)
+      self.__fileName = data
+    elif isinstance(data, str):
       utils.dbm("Fasta input source is file")
       self.__entries = Fasta.loadFasta(data, seqType)
       self.__fileName = data
@@ -71,10 +513,21 @@ class Fasta(object):
     return self.__entries.values()
   #edef
 
-  def __contains(self, k):
+  def __contains__(self, k):
     return (k in self.__entries)
   #edef
 
+  def __len__(self):
+    return len(self.__entries)
+  #edef
+
+  def __materialize(self):
+    # Modifications are not written to the indexed file, so move the (lazy) sequences into a dictionary
+    if isinstance(self.__entries, FastaIndex):
+      self.__entries = dict(self.__entries.items())
+    #fi
+  #edef
+
   def __iter__(self):
     self.__iterKeys = list(self.__entries.keys())
     return self
@@ -101,10 +554,12 @@ class Fasta(object):
     if not(isinstance(seq, Sequence)):
       seq = Sequence(seqID, seq, self.primaryType)
     #fi
+    self.__materialize()
     self.__entries[seqID] = seq
   #edef
 
   def update(self, d):
+    self.__materialize()
     self.__entries.update(d)
   #edef
 
@@ -125,7 +580,7 @@ class Fasta(object):
   
     current_seq = ""
     current_seq_full = ""
-    buffer_seq  = ""
+    buffer_seq  = []
    
     with utils.gzopen(fastaFile, 'rt', encoding='UTF-8') as fd: 
       for line in fd:
@@ -134,20 +589,16 @@ class Fasta(object):
           continue
         #fi
         if line[0] == '>':
-          F[current_seq] = Sequence(current_seq, buffer_seq, seqType, current_seq_full)
+          F[current_seq] = Sequence(current_seq, ''.join(buffer_seq), seqType, current_seq_full)
           current_seq = line[1:].split(' ')[0]
           current_seq_full = line[1:]
-          buffer_seq = ""
+          buffer_seq = []
         else:
-          try:
-            buffer_seq = buffer_seq + line
-          except TypeError:
-            print(type(buffer_seq))
-            
-            print(type(line))
+          buffer_seq.append(line)
         #fi
+      #efor
     #ewith
-    F[current_seq] = Sequence(current_seq, buffer_seq, seqType, current_seq_full)
+    F[current_seq] = Sequence(current_seq, ''.join(buffer_seq), seqType, current_seq_full)
     F.pop("", None)
     return F
   #edef
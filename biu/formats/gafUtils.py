@@ -1,8 +1,13 @@
 from .. import utils
 from .. import stats
 from .. import ops
+from ..structures import DiskCache
+
+import os
 
 pd = utils.py.loadExternalModule("pandas")
+np = utils.py.loadExternalModule("numpy")
+ssparse = utils.py.loadExternalModule("scipy.sparse")
 
 class GAF(object):
     """
@@ -15,37 +20,105 @@ class GAF(object):
   
     _entries = None
     _fileName = None
-    _annotIndex = None
-    _objectIndex = None
+    _readArgs = None
+    _index = None
+    _annotLookup = None
+    _objectLookup = None
+    _enrichmentIndex = None
+
+    # The arrays that make up the index: the identifiers of annotations and objects, and for both directions
+    # a CSR-style offset array into the codes of the annotated objects (or the annotations of each object)
+    _indexArrays = [ "annot_ids", "object_ids", "annot_indptr", "annot_objects", "object_indptr", "object_annots" ]
   
     def __init__(self, file_name, **kwargs):
         """
         Initialize the GAF object.
+        The annotation index is cached on disk (see structures.DiskCache), and memory-mapped when it is reused.
         
         parameters:
         -----------
         file_name: String. A path to the file
         **kwargs: Additional arguments to pd.read_csv
         """
-        self._entries = pd.read_csv(file_name, index_col=False, names=self._fieldNames, **kwargs).drop_duplicates(('go_id', 'db_o_id'))
         self._fileName = file_name
-        self._annotIndex = {}
-        self._objectIndex = {}
-  
-        for i, row in self._entries.iterrows():
-            goID = row.go_id
-            objectID = row.db_o_id
-    
-            if goID not in self._annotIndex:
-                self._annotIndex[goID] = []
-            #fi
-            if objectID not in self._objectIndex:
-                self._objectIndex[objectID] = []
+        self._readArgs = kwargs
+
+        cache = DiskCache("gaf_index")
+        key   = None
+        entry = None
+        if isinstance(file_name, str) and os.path.isfile(file_name):
+            key   = DiskCache.key(DiskCache.file_key(file_name), sorted([ (k, str(v)) for (k, v) in kwargs.items() ]))
+            entry = cache.lookup(key)
+        #fi
+
+        if entry is None:
+            utils.dbm("Constructing GAF index...")
+            self._index = self._build_index(self.entries)
+            if key is not None:
+                tmp = cache.new_entry()
+                for name in self._indexArrays:
+                    np.save(os.path.join(tmp, '%s.npy' % name), self._index[name])
+                #efor
+                cache.commit(key, tmp, meta={ "file" : file_name })
             #fi
-    
-            self._annotIndex[goID].append( (objectID, i) )
-            self._objectIndex[objectID].append( (goID, i) )
-        #efor
+        else:
+            self._index = { name : np.load(os.path.join(entry, '%s.npy' % name), mmap_mode='r') for name in self._indexArrays }
+        #fi
+    #edef
+
+    @staticmethod
+    def _build_index(entries):
+        """
+        Build the index arrays from the GAF entries.
+        Identifiers are integer coded in order of first appearance, and the codes of each annotation (object)
+        are kept in file order. Entries without an annotation or object identifier are left out.
+        """
+        entries = entries[entries.go_id.notna() & entries.db_o_id.notna()]
+        annot_codes, annot_ids = pd.factorize(entries.go_id.values)
+        object_codes, object_ids = pd.factorize(entries.db_o_id.values)
+
+        def csr(codes, n, other):
+            order  = np.argsort(codes, kind='stable')
+            indptr = np.zeros(n+1, dtype=np.int64)
+            np.cumsum(np.bincount(codes, minlength=n), out=indptr[1:])
+            return indptr, other[order].astype(np.int64)
+        #edef
+
+        annot_indptr, annot_objects = csr(annot_codes, len(annot_ids), object_codes)
+        object_indptr, object_annots = csr(object_codes, len(object_ids), annot_codes)
+
+        return { "annot_ids" : np.array([ str(a) for a in annot_ids ], dtype=str),
+                 "object_ids" : np.array([ str(o) for o in object_ids ], dtype=str),
+                 "annot_indptr" : annot_indptr,
+                 "annot_objects" : annot_objects,
+                 "object_indptr" : object_indptr,
+                 "object_annots" : object_annots }
+    #edef
+
+    @property
+    def entries(self):
+        """
+        The (deduplicated) GAF entries as a pandas DataFrame.
+        Only read from file when needed, i.e. not when the index is loaded from cache.
+        """
+        if self._entries is None:
+            self._entries = pd.read_csv(self._fileName, index_col=False, names=self._fieldNames, **self._readArgs).drop_duplicates(('go_id', 'db_o_id'))
+        #fi
+        return self._entries
+    #edef
+
+    def _annot_code(self, annot_id):
+        if self._annotLookup is None:
+            self._annotLookup = pd.Index(self._index["annot_ids"])
+        #fi
+        return self._annotLookup.get_loc(annot_id) if annot_id in self._annotLookup else None
+    #edef
+
+    def _object_code(self, object_id):
+        if self._objectLookup is None:
+            self._objectLookup = pd.Index(self._index["object_ids"])
+        #fi
+        return self._objectLookup.get_loc(object_id) if object_id in self._objectLookup else None
     #edef
   
     @property
@@ -53,7 +126,7 @@ class GAF(object):
       """
       Return the list of all annotations.
       """
-      return list(self._annotIndex.keys())
+      return self._index["annot_ids"].tolist()
     #edef
   
     @property
@@ -61,7 +134,7 @@ class GAF(object):
       """
       Return a list of all annotated objects.
       """
-      return list(self._objectIndex.keys())
+      return self._index["object_ids"].tolist()
     #edefd
   
     @utils.decorators.deprecated("getAnnots is deprecated. Use get_annots instead.")
@@ -78,11 +151,12 @@ class GAF(object):
         Return the annotations for a given object.
         Returns empty list if object is unknown.
         """
-        if object_id not in self._objectIndex:
+        i = self._object_code(object_id)
+        if i is None:
             return []
-        else:
-            return [ a[0] for a in self._objectIndex[object_id] ]
         #fi
+        indptr = self._index["object_indptr"]
+        return self._index["annot_ids"][self._index["object_annots"][indptr[i]:indptr[i+1]]].tolist()
     #edef
     
     @utils.decorators.deprecated("getAnnoted is deprecated. Use get_annots instead.")
@@ -99,14 +173,30 @@ class GAF(object):
         Return the annotations for a given object.
         Returns empty list if annotation is unknown
         """
-        if annot_id not in self._annotIndex:
+        i = self._annot_code(annot_id)
+        if i is None:
             return []
-        else:
-            return [ a[0] for a in self._annotIndex[annot_id] ]
         #fi
+        indptr = self._index["annot_indptr"]
+        return self._index["object_ids"][self._index["annot_objects"][indptr[i]:indptr[i+1]]].tolist()
+    #edef
+  
+    @property
+    def enrichment_index(self):
+        """
+        The annotations as a stats.enrichment.EnrichmentIndex, to test many sets at once.
+        """
+        if self._enrichmentIndex is None:
+            indptr  = np.asarray(self._index["object_indptr"])
+            indices = np.asarray(self._index["object_annots"])
+            matrix  = ssparse.csr_matrix((np.ones(len(indices), dtype=np.int64), indices, indptr),
+                                         shape=(len(self._index["object_ids"]), len(self._index["annot_ids"])))
+            self._enrichmentIndex = stats.enrichment.EnrichmentIndex.from_matrix(self._index["object_ids"], self._index["annot_ids"], matrix)
+        #fi
+        return self._enrichmentIndex
     #edef
   
-    def enrich(self, your_set, pathway=None, method=None, **kwargs):
+    def enrich(self, your_set, pathway=None, method=None, table_values=True, **kwargs):
         """
         Enrich: Check enrichment of GO pathways in a given set
   
@@ -114,31 +204,32 @@ class GAF(object):
           - yourSet: List of Uniprot protein IDs to test
           - pathway: List of GO terms (or single term) to test (Defaults to all terms that your objectIDs are present in)
           - method: Type of multiple testing correction procedure to use
+          - table_values: Boolean. Also return the actual elements in the contingency tables
           - **kwargs: Additional arguments for multple testing procedure
   
         Outputs:
          - df : Pandas Data Frame of test results
         """
-        if pathway is None:
-            pathway = list(set([ p for prot in your_set for p in self.get_annots(prot) ]))
-        elif isinstance(pathway, str):
-            pathway = [ pathway ]
-        #fi
+        df = self.enrich_many({ 'set' : your_set }, pathway=pathway, method=method, table_values=table_values, **kwargs)
+        return df.drop(columns=['set'])
+    #edef
   
-        R = []
-        B = self.objects
-        for p in pathway:
-            pathway_genes = self.get_annotated(p)
-            res = stats.enrichment.set_enrichment(your_set, pathway_genes, B)
-            R.append((p, res.method, res.c2statistic, res.oddsratio, res.pvalue, res.table, res.table_values))
-        #efor
+    def enrich_many(self, your_sets, pathway=None, method=None, table_values=False, **kwargs):
+        """
+        Check enrichment of GO pathways in many sets at once.
   
-        df = pd.DataFrame(R, columns=['pathway', 'method', 'c2statistic', 'oddsratio', 'p', 'table', 'table_values'])
-        if method is not None:
-            df['q'] = stats.p_adjust(df.p.values, method, **kwargs)
-        #fi
+        Inputs:
+          - your_sets: List[String] | List[List[String]] | dict[string->List[String]]
+                       A list of uniprot protein identifiers, or a list/dict of lists of uniprot identifiers
+          - pathway: List of GO terms (or single term) to test in each set (Defaults to all terms that the objects in each set are present in)
+          - method: Type of multiple testing correction procedure to use, applied per set
+          - table_values: Boolean. Also return the actual elements in the contingency tables (slow for many tests)
+          - **kwargs: Additional arguments for multple testing procedure
   
-        return df
+        Outputs:
+         - df : Pandas Data Frame of test results, with a column 'set' identifying the set
+        """
+        return self.enrichment_index.enrich(your_sets, terms=pathway, method=method, table_values=table_values, **kwargs)
     #edef
   
     def summary(self, your_sets):
@@ -241,9 +332,9 @@ class GAF(object):
         """
         dstr  = "GAF (GO Annotation File) Object\n"
         dstr += " Where: %s\n" % self._fileName
-        dstr += " # Annotations : %d\n" % self._entries.shape[0]
-        dstr += " # Objects     : %d\n" % len(self._objectIndex.keys())
-        dstr += " # GO terms    : %d\n" % len(self._annotIndex.keys())
+        dstr += " # Annotations : %d\n" % len(self._index["annot_objects"])
+        dstr += " # Objects     : %d\n" % len(self._index["object_ids"])
+        dstr += " # GO terms    : %d\n" % len(self._index["annot_ids"])
         return dstr
     #edef
     
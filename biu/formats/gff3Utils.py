@@ -1,12 +1,15 @@
 from .. import utils
+from .. import ops
+from ..structures import DiskCache
 
 import errno
 import os
+import re
 import csv
 import gzip
 from collections import namedtuple
 
-intervaltree = utils.py.loadExternalModule('intervaltree')
+np = utils.py.loadExternalModule("numpy")
 pd = utils.py.loadExternalModule("pandas")
 
 ###############################################################################
@@ -18,6 +21,27 @@ seqIDField  = lambda e: e.seqid
 
 ###############################################################################
 
+def parseAttributes(attr):
+  """
+  Parse a GFF3 attribute string (key1=value1;key2=value2;...) into a dictionary.
+  Keys without a value are given the value None.
+  """
+  def attrsplit(attr):
+    spl = attr.split('=')
+    if len(spl) == 1:
+      return (attr, None)
+    elif len(spl) > 2:
+      return (spl[0], '='.join(spl[1:]))
+    else:
+      return (spl[0], spl[1])
+    #fi
+  #edef
+
+  return dict([attrsplit(x.strip()) for x in attr.split(";") ])
+#edef
+
+###############################################################################
+
 class GFF3Entry(object):
 
   __slots__ = [ 'seqid', 'source', 'feature', 'start', 'end', 'score', 'phase', 'strand', 'attr', '__idField', '__parentField', '__nameField' ]
@@ -37,22 +61,11 @@ class GFF3Entry(object):
     self.__parentField = parentField
     self.__nameField = nameField
 
-    def attrsplit(attr):
-      spl = attr.split('=')
-      if len(spl) == 1:
-        return (attr, None)
-      elif len(spl) > 2:
-        return (spl[0], '='.join(spl[1:]))
-      else:
-        return (spl[0], spl[1])
-      #fi
-    #edef
-  
     (self.seqid, self.source, self.feature, self.start, self.end, self.score, self.strand, self.phase, attr) = row
     if isinstance(attr, dict):
       self.attr = attr
     else:
-      self.attr = dict([attrsplit(x.strip()) for x in attr.split(";") ])
+      self.attr = parseAttributes(attr)
     #fi
     self.start = int(self.start)
     self.end   = int(self.end)
@@ -118,9 +131,174 @@ class GFF3Entry(object):
 
 ###############################################################################
 
+class GFF3Columns(object):
+  """
+  Column-typed storage of GFF3 rows.
+  The repetitive string columns (seqid, source, feature, score, strand, phase) are stored as integer codes
+  into a list of categories, start and end as integer arrays, and the attribute strings are kept as they are.
+  Attributes are only parsed when an entry is accessed, or in bulk with the attribute method.
+  The object behaves like a read-only list of GFF3Entry objects, so it can be used as the entries of a GFF3 object.
+  """
+
+  __slots__ = [ '_codes', '_categories', 'start', 'end', '_attr', '__entryArgs' ]
+
+  categorical = [ 'seqid', 'source', 'feature', 'score', 'strand', 'phase' ]
+  columns     = [ 'seqid', 'source', 'feature', 'start', 'end', 'score', 'strand', 'phase', 'attr' ]
+
+  def __init__(self, codes, categories, start, end, attr, **kwargs):
+    """
+    Initialize a GFF3Columns object. Use GFF3Columns.read to read one from a file.
+    parameters:
+    -----------
+    codes:      dict of column -> integer array of category codes, for each categorical column
+    categories: dict of column -> numpy array of category strings, for each categorical column
+    start, end: integer arrays of start and end coordinates
+    attr:       numpy object array of unparsed attribute strings
+    kwargs:     arguments passed to GFF3Entry (e.g. idField, parentField, nameField)
+    """
+    self._codes      = codes
+    self._categories = categories
+    self.start       = start
+    self.end         = end
+    self._attr       = attr
+    self.__entryArgs = kwargs
+  #edef
+
+  @property
+  def defaultFields(self):
+    """
+    True if the entries use the default id, parent and name fields, and can be indexed directly from the attributes.
+    """
+    return all([ self.__entryArgs.get(k, d) is d for (k, d) in [ ('idField', idField), ('parentField', parentField), ('nameField', nameField) ] ])
+  #edef
+
+  def column(self, name):
+    """
+    Get the values of a column as a numpy array.
+    For categorical columns, the array contains references to the category strings.
+    """
+    if name in self._codes:
+      return self._categories[name][self._codes[name]]
+    elif name == 'attr':
+      return self._attr
+    #fi
+    return getattr(self, name)
+  #edef
+
+  def attribute(self, key):
+    """
+    Get the value of one attribute for all entries, without parsing all attributes.
+    Returns: numpy object array, with None for entries that do not have the attribute
+    """
+    pattern = re.compile(r'(?:^|;)\s*%s=([^;]*)' % re.escape(key))
+    values  = np.empty(len(self._attr), dtype=object)
+    values[:] = [ m.group(1).rstrip() if m is not None else None for m in map(pattern.search, self._attr) ]
+    return values
+  #edef
+
+  def take(self, indexes):
+    """
+    Select a subset of rows.
+    Returns: GFF3Columns object with the selected rows
+    """
+    indexes = np.asarray(indexes, dtype=np.int64)
+    return GFF3Columns({ c : v[indexes] for (c, v) in self._codes.items() }, self._categories,
+                       self.start[indexes], self.end[indexes], self._attr[indexes], **self.__entryArgs)
+  #edef
+
+  def row(self, i):
+    return [ self._categories['seqid'][self._codes['seqid'][i]],
+             self._categories['source'][self._codes['source'][i]],
+             self._categories['feature'][self._codes['feature'][i]],
+             int(self.start[i]),
+             int(self.end[i]),
+             self._categories['score'][self._codes['score'][i]],
+             self._categories['strand'][self._codes['strand'][i]],
+             self._categories['phase'][self._codes['phase'][i]],
+             self._attr[i] ]
+  #edef
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return self.take(np.arange(len(self))[i])
+    #fi
+    return GFF3Entry(self.row(i), **self.__entryArgs)
+  #edef
+
+  def __len__(self):
+    return len(self.start)
+  #edef
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+    #efor
+  #edef
+
+  @property
+  def dataFrame(self):
+    """
+    The rows as a pandas DataFrame with categorical string columns. The attributes are not parsed.
+    """
+    return pd.DataFrame({ c : (pd.Categorical.from_codes(self._codes[c], self._categories[c]) if c in self._codes else self.column(c)) for c in self.columns })
+  #edef
+
+  def __str__(self):
+    dstr  = "GFF3Columns object\n"
+    dstr += " Entries: %d\n" % len(self)
+    dstr += " Seqids: %d\n" % len(self._categories['seqid'])
+    dstr += " Features: %s\n" % ', '.join(self._categories['feature'])
+    return dstr
+  #edef
+
+  def __repr__(self):
+    return self.__str__()
+  #edef
+
+  @staticmethod
+  def read(filename, features=None, seqids=None, skipLines=0, maxLines=None, allowAdditionalColumns=False, **kwargs):
+    """
+    Read a GFF3 file into column-typed storage, without constructing any GFF3Entry objects.
+    parameters:
+    -----------
+    filename: The GFF3 file (can be gzipped)
+    features: Only keep entries of these feature types (case-insensitive). Default: all
+    seqids:   Only keep entries on these seqids. Default: all
+    skipLines, maxLines, allowAdditionalColumns: As in GFF3.read
+    kwargs:   arguments passed to GFF3Entry when entries are accessed
+
+    Returns: GFF3Columns object
+    """
+    columns = [ [] for c in GFF3Columns.columns ]
+    appends = [ c.append for c in columns ]
+
+    for row in GFF3._rows(filename, features=features, seqids=seqids, skipLines=skipLines, maxLines=maxLines, allowAdditionalColumns=allowAdditionalColumns):
+      for (append, v) in zip(appends, row):
+        append(v)
+      #efor
+    #efor
+    columns = dict(zip(GFF3Columns.columns, columns))
+
+    codes, categories = {}, {}
+    for c in GFF3Columns.categorical:
+      codes[c], categories[c] = pd.factorize(np.array(columns.pop(c), dtype=object))
+      codes[c] = codes[c].astype(np.intc)
+    #efor
+
+    attr = np.empty(len(columns['attr']), dtype=object)
+    attr[:] = columns.pop('attr')
+
+    return GFF3Columns(codes, { c : np.asarray(v, dtype=object) for (c, v) in categories.items() },
+                       np.array(columns['start'], dtype=np.int64), np.array(columns['end'], dtype=np.int64), attr, **kwargs)
+  #edef
+
+#eclass
+
+###############################################################################
+
 class GFF3(object):
 
-  __slots__ = [ 'entries', 'seqids', 'index', 'features', '__index', '__intervalIndex', '__fileName' ]
+  __slots__ = [ 'entries', 'seqids', 'index', 'features', '__index', '__intervalIndex', '__fileName', '__cacheKey' ]
 
   #entries = None
   #seqids = None
@@ -131,14 +309,25 @@ class GFF3(object):
   #__intervalIndex = None
   #__fileName = None
 
-  def __init__(self, data, **kwargs):
+  def __init__(self, data, columnar=False, **kwargs):
+    """
+    Initialize a GFF3 object.
+    parameters:
+    -----------
+    data: A GFF3 filename, a GFF3 object, a list of GFF3Entry objects or a GFF3Columns object
+    columnar: When reading from a file, store the entries in column-typed storage (GFF3Columns), and
+              construct GFF3Entry objects only when they are accessed. Recommended for large annotations.
+    kwargs: Arguments passed to GFF3.read (or GFF3Columns.read) and GFF3Entry
+    """
 
     self.__fileName = None
+    self.__cacheKey = None
 
     if isinstance(data, str):
       utils.dbm("GFF input source is file.")
       self.__fileName = data
-      self.entries = GFF3.read(data, **kwargs)
+      self.__cacheKey = DiskCache.key(DiskCache.file_key(data), *[ kwargs.get(k, None) for k in [ 'skipLines', 'maxLines', 'allowAdditionalColumns', 'features', 'seqids' ] ])
+      self.entries = (GFF3Columns if columnar else GFF3).read(data, **kwargs)
     elif isinstance(data, type(self)):
       utils.dbm("GFF input source is GFF3 structure")
       self.entries = data.entries
@@ -146,7 +335,11 @@ class GFF3(object):
       utils.dbm("GFF input source is list of GFF3Entries.")
       self.entries = data
     #fi
-    self.seqids  = set([ e.seqid for e in self.entries])
+    if isinstance(self.entries, GFF3Columns):
+      self.seqids = set(self.entries.column('seqid'))
+    else:
+      self.seqids = set([ e.seqid for e in self.entries])
+    #fi
     self.__index, self.features = self._index()
     self.__intervalIndex = None
   #edef
@@ -186,10 +379,20 @@ class GFF3(object):
   def _index(self):
     internal_counter = 0
 
+    if isinstance(self.entries, GFF3Columns) and self.entries.defaultFields:
+      # Extract the relevant fields in bulk, rather than constructing every entry
+      IDs     = self.entries.attribute("ID")
+      names   = self.entries.attribute("Name")
+      IDs     = np.where(np.equal(IDs, None), names, IDs)
+      parents = self.entries.attribute("Parent")
+      rows    = zip(IDs, self.entries.column('feature'), parents)
+    else:
+      rows = ( (e.id, e.feature, e.parent) for e in self.entries )
+    #fi
+
     idx = {}
     features = {}
-    for i, e in enumerate(self.entries):
-      ID = e.id
+    for i, (ID, feature, parent) in enumerate(rows):
       if ID is None:
         ID = "internal.%d" % internal_counter
         internal_counter += 1
@@ -202,16 +405,14 @@ class GFF3(object):
       #fi
 
       # Add feature to top Level index
-      feature = e.feature
       if feature != "":
         if feature not in features:
           features[feature] = []
         #fi
-        features[e.feature].append(ID)
+        features[feature].append(ID)
       #fi
 
       # Construct hierarchical structure
-      parent = e.parent
       if parent is not None:
         if parent not in idx:
           idx[parent] = [ None, [] ]
@@ -298,6 +499,11 @@ class GFF3(object):
   #edef  
 
   def __getIntervalIndex(self, features):
+    """
+    Get the interval index of entries of specific feature types.
+    For a GFF3 object read from a file, the index is stored in an on-disk cache, and memory-mapped from there later.
+    Returns: tuple (ops.regions.IntervalIndex, array mapping interval indexes to entry indexes)
+    """
     if features is None:
       features = list(self.features.keys())
     #fi
@@ -312,18 +518,33 @@ class GFF3(object):
     #fi
 
     if features not in self.__intervalIndex:
-      utils.dbm("Constructing interval index...")
-      try: 
-        from intervaltree import Interval, IntervalTree
-      
-        t = { str(seqid) : IntervalTree() for seqid in self.seqids }
-        for e in [ e for e in self.entries if e.feature.lower() in features ]:
-          t[str(e.seqid)][e.start-1:e.end] = e
-        #efor
-      except ImportError:
-        return {}
-      #etry
-      self.__intervalIndex[features] = t
+      cache = DiskCache("gff3_interval_index")
+      key   = None if self.__cacheKey is None else DiskCache.key(self.__cacheKey, features)
+      entry = None if key is None else cache.lookup(key)
+
+      if entry is None:
+        utils.dbm("Constructing interval index...")
+        if isinstance(self.entries, GFF3Columns):
+          idx = np.flatnonzero(np.isin([ f.lower() for f in self.entries.column('feature') ], features))
+          seqids, starts, ends = self.entries.column('seqid')[idx], self.entries.start[idx]-1, self.entries.end[idx]
+        else:
+          sel = [ (str(e.seqid), e.start-1, e.end, i) for (i, e) in enumerate(self.entries) if e.feature.lower() in features ]
+          seqids, starts, ends, idx = zip(*sel) if len(sel) > 0 else ([], [], [], [])
+        #fi
+        index = ops.regions.IntervalIndex(seqids, starts, ends)
+        # Map the indexes of the selected intervals back to entry indexes
+        index = (index, np.array(idx, dtype=np.int64))
+
+        if key is not None:
+          tmp = cache.new_entry()
+          index[0].save(tmp)
+          np.save(os.path.join(tmp, 'entries.npy'), index[1])
+          cache.commit(key, tmp, meta={ "file" : self.__fileName, "features" : features })
+        #fi
+      else:
+        index = (ops.regions.IntervalIndex.load(entry), np.load(os.path.join(entry, 'entries.npy'), mmap_mode='r'))
+      #fi
+      self.__intervalIndex[features] = index
     #fi
     return self.__intervalIndex[features]
   #edef
@@ -332,32 +553,47 @@ class GFF3(object):
     return self.queryRegions([(chromosome, start, stop)], features=features, raw=raw)
   #edef
 
-  def queryRegions(self, regions, features=None, raw=False):
-    R = []
-    for (c,s,e) in regions:
-      r = self.__query(c, s, e, features)
-      R.extend(r)
-    #efor
-    if raw:
-      return R
+  def queryIndexes(self, regions, features=None):
+    """
+    Find the entries that overlap with each of a set of regions, in one vectorised query.
+    parameters:
+    -----------
+    regions: list of 3-tuples (seqid, start, end). Entries overlapping [start, end) are reported
+    features: list of feature types to consider (default: all)
+
+    Returns:
+    --------
+    Two integer arrays of equal length, sorted by region and then by entry:
+      * the index of the region in regions
+      * the index of the overlapping entry in self.entries
+    """
+    if len(regions) == 0:
+      return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
     #fi
-    return GFF3(R)
+
+    seqids, starts, ends = zip(*[ (str(c), min(s, e), max(s, e)) for (c, s, e) in regions ])
+    index, entries = self.__getIntervalIndex(features)
+
+    for seqid in set(seqids):
+      if seqid not in index:
+        utils.warning("Seqid '%s' not in GFF." % seqid)
+      #fi
+    #efor
+
+    R, I = index.query(seqids, starts, ends)
+    return R, entries[I]
   #edef
 
-  def __query(self, c, s, e, features):
-    # Make a string of the seqid
-    c = str(c)
-    # reorder the coords
-    if s > e:
-      s, e = ( min(s, e), max(s, e))
+  def queryRegions(self, regions, features=None, raw=False):
+    R, I = self.queryIndexes(regions, features)
+    if isinstance(self.entries, GFF3Columns) and not(raw):
+      return GFF3(self.entries.take(I))
     #fi
-
-    relIntervalIndex = self.__getIntervalIndex(features)
-    if c not in relIntervalIndex:
-      utils.warning("Seqid '%s' not in GFF." % c)
-      return []
+    R = [ self.entries[i] for i in I ]
+    if raw:
+      return R
     #fi
-    return [ i[-1] for i in relIntervalIndex[c][s:e] ]
+    return GFF3(R)
   #edef
 
   def getID(self, ID):
@@ -370,6 +606,11 @@ class GFF3(object):
 
   @property
   def dataFrame(self):
+    if isinstance(self.entries, GFF3Columns):
+      df = self.entries.dataFrame.drop(columns=["strand"])
+      df["attr"] = [ parseAttributes(a) for a in df["attr"] ]
+      return df
+    #fi
     return pd.DataFrame([ (e.seqid, e.source, e.feature, e.start, e.end, e.score, e.phase, e.attr) for e in self.entries ],
                         columns=("seqid", "source", "feature", "start", "end", "score", "phase", "attr") )
   #edef
@@ -393,8 +634,13 @@ class GFF3(object):
 ###############################################################################
 
   @staticmethod
-  def read(filename, skipLines=0, maxLines=None, allowAdditionalColumns=False, **kwargs):
-    G = []
+  def _rows(filename, features=None, seqids=None, skipLines=0, maxLines=None, allowAdditionalColumns=False):
+    """
+    Stream the rows of a GFF3 file as lists of the 9 GFF3 fields, optionally filtered by feature type and seqid.
+    """
+    features = None if features is None else set([ f.lower() for f in ([features] if isinstance(features, str) else features) ])
+    seqids   = None if seqids is None else set([ str(s) for s in ([seqids] if isinstance(seqids, str) else seqids) ])
+
     nLines = 0
     with (gzip.open(filename, "rt") if filename[-2:] == "gz" else open(filename, "r")) as gffFile:
       gffReader = csv.reader(gffFile, delimiter="\t", quotechar='"')
@@ -411,10 +657,39 @@ class GFF3(object):
         if (ncolumns < 9) or ((ncolumns > 9) and not(allowAdditionalColumns)):
           continue
         #fi
-        G.append(GFF3Entry(row[:9], **kwargs))
+
+        if (seqids is not None) and (row[0] not in seqids):
+          continue
+        #fi
+        if (features is not None) and (row[2].lower() not in features):
+          continue
+        #fi
+        yield row[:9]
       #efor
     #ewith
-    return G
+  #edef
+
+  @staticmethod
+  def iterate(filename, features=None, seqids=None, skipLines=0, maxLines=None, allowAdditionalColumns=False, **kwargs):
+    """
+    Stream the entries of a GFF3 file, without loading the whole file.
+    parameters:
+    -----------
+    filename: The GFF3 file (can be gzipped)
+    features: Only yield entries of these feature types (case-insensitive). Default: all
+    seqids:   Only yield entries on these seqids. Default: all
+    kwargs:   arguments passed to GFF3Entry
+
+    Yields: GFF3Entry objects
+    """
+    for row in GFF3._rows(filename, features=features, seqids=seqids, skipLines=skipLines, maxLines=maxLines, allowAdditionalColumns=allowAdditionalColumns):
+      yield GFF3Entry(row, **kwargs)
+    #efor
+  #edef
+
+  @staticmethod
+  def read(filename, **kwargs):
+    return list(GFF3.iterate(filename, **kwargs))
   #edef
 
 #eclass
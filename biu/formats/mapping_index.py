@@ -1,6 +1,7 @@
 from .. import utils
 
 pd = utils.py.loadExternalModule("pandas")
+np = utils.py.loadExternalModule("numpy")
 
 class MappingIndexObject(object):
     def __init__(self, fields, values):
@@ -23,7 +24,8 @@ class MappingIndexObject(object):
         self._all_fields = [ 'all_%s' % f for f in fields ]
         self._values = values
         
-        fv = [ [ v for v in set(f) if v is not None ] for f in zip(*values) ]
+        # Unique values per field, in the order of the rows
+        fv = [ [ v for v in dict.fromkeys(f) if v is not None ] for f in zip(*values) ]
         self._all_field_values = { f : v for (f,v) in zip(self._all_fields, fv)}
         
         self._field_values = { f : v[0] if len(v) > 0 else None for (f,v) in zip(fields, fv) }
@@ -119,7 +121,7 @@ class MappingIndex(object):
     """
     
 
-    _slots_ = [ '_idx', '_key', '_file_name', '_tbl', '_names', '_empty_result' ]
+    _slots_ = [ '_idx', '_key', '_file_name', '_tbl', '_names', '_empty_result', '_keys', '_order', '_indptr', '_first' ]
 
     def __init__(self, data, key=0, **kwargs):
         """
@@ -141,27 +143,107 @@ class MappingIndex(object):
             self._tbl = pd.read_csv(self._file_name, **kwargs)
         #fi
         
-        self._idx = { k : [] for k in self._tbl[self._tbl.columns[self._key]].unique() }
-        for row in self._tbl.values:
-            self._idx[row[self._key]].append([ None if pd.isna(v) else v for v in row])
-        #efor
-        self._idx = { k : MappingIndexObject(self._tbl.columns, v) for (k,v) in self._idx.items()}
+        # The rows of each key are a slice of _order, given by the offsets in _indptr.
+        # MappingIndexObjects are only made when a key is looked up.
+        codes, keys = pd.factorize(self._tbl[self._tbl.columns[self._key]])
+        valid = codes >= 0
+        self._keys   = pd.Index(keys)
+        self._order  = np.flatnonzero(valid)[np.argsort(codes[valid], kind='stable')]
+        self._indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes[valid], minlength=len(keys)), out=self._indptr[1:])
+        self._idx   = {}
+        self._first = {}
         
         self._empty_result = MappingIndexObject(self._tbl.columns, [[ None for c in self._tbl.columns]])
     #edef
 
+    def _rows(self, i):
+        """
+        The row numbers in the table of the i-th key
+        """
+        return self._order[self._indptr[i]:self._indptr[i+1]]
+    #edef
+
     def lookup(self, key):
         """
         lookup: Lookup the value of a key
         Inputs: key :      [str] index value to retrieve
         """
         if key not in self._idx:
-            utils.msg.error("Item '%s' not in map." % key)
-            return self._empty_result
+            if key not in self._keys:
+                utils.msg.error("Item '%s' not in map." % key)
+                return self._empty_result
+            #fi
+            values = self._tbl.iloc[self._rows(self._keys.get_loc(key))].values
+            self._idx[key] = MappingIndexObject(self._tbl.columns, [ [ None if pd.isna(v) else v for v in row ] for row in values ])
         #fi
 
         return self._idx[key]
     #edef
+
+    def _field(self, field):
+        """
+        The column name of a field, given by name or by position
+        """
+        if field in self._tbl.columns:
+            return field
+        elif isinstance(field, int) and (0 <= field < len(self._tbl.columns)):
+            return self._tbl.columns[field]
+        #fi
+        raise AttributeError("Unknown field '%s'." % str(field))
+    #edef
+
+    def map_many(self, keys, field, all_values=False):
+        """
+        Map many keys at once to the values of a field.
+        
+        parameters:
+        -----------
+        keys: List|np.array|pd.Series. The keys to map
+        field: String|Integer. The field (column name or position) to map to
+        all_values: Boolean. Return a list of all values of the field for each key, rather than the first one (like mi[key].all_field)
+        
+        Returns:
+        --------
+        pd.Series with the value (or list of values) for each key, and None for unknown keys or missing values.
+        It has the index of keys if it is a pd.Series.
+        
+        Example usage:
+        --------------
+        de['symbol'] = mi.map_many(de.ensembl_gene_id, 'hgnc_symbol')
+        """
+        field  = self._field(field)
+        index  = keys.index if isinstance(keys, pd.Series) else None
+        pos    = self._keys.get_indexer(np.asarray(keys))
+        
+        if all_values:
+            # Unique non-missing values of each key, in the order of the rows
+            col = self._tbl[field].to_numpy(dtype=object)[self._order]
+            grp = np.repeat(np.arange(len(self._keys)), np.diff(self._indptr))
+            pairs = pd.DataFrame({ 'key' : grp, 'value' : col }).dropna().drop_duplicates()
+            lists = pairs.groupby('key', sort=False).value.agg(list)
+            values = np.empty(len(self._keys) + 1, dtype=object)
+            for i in range(len(values)):
+                values[i] = []
+            #efor
+            values[lists.index.values] = lists.values
+        else:
+            if field not in self._first:
+                # The first non-missing value of each key
+                col   = self._tbl[field].to_numpy(dtype=object)[self._order]
+                grp   = np.repeat(np.arange(len(self._keys)), np.diff(self._indptr))
+                valid = ~pd.isna(col)
+                grp, first = np.unique(grp[valid], return_index=True)
+                values = np.full(len(self._keys) + 1, None, dtype=object)
+                values[grp] = col[valid][first]
+                self._first[field] = values
+            #fi
+            values = self._first[field]
+        #fi
+        
+        # Unknown keys (-1) map to the last element, which is empty
+        return pd.Series(values[pos], index=index, name=field, dtype=object)
+    #edef
     
     @property
     def _table(self):
@@ -174,7 +256,14 @@ class MappingIndex(object):
         """
         Check if a key is present in the mapping
         """
-        return key in self._idx
+        return key in self._keys
+    #edef
+
+    def __len__(self):
+        """
+        The number of keys in the mapping
+        """
+        return len(self._keys)
     #edef
 
     def __getitem__(self, key):
@@ -189,14 +278,14 @@ class MappingIndex(object):
         """
         keys: Return a list of keys of the index
         """
-        return self._idx.keys()
+        return self._keys.tolist()
     #edef
 
     def values(self):
         """
         values: Return a list of values of the index
         """
-        return self._idx.values()
+        return [ self.lookup(k) for k in self._keys ]
     #edef
 
     def __str__(self):
@@ -207,7 +296,7 @@ class MappingIndex(object):
         dstr += " Filename: %s\n" % self._file_name
         dstr += " Indexed on column %s\n" % (str(self._key))
         dstr += " #Rows : %d\n" % self._tbl.shape[0]
-        dstr += " #Indexes: %d\n" % len(self._idx)
+        dstr += " #Indexes: %d\n" % len(self._keys)
         return dstr
     #edef
       
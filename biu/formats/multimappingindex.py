@@ -63,7 +63,23 @@ class MultiMappingIndex(Dataset2):
         #efor
     #edef
     
-    
+    def map_many(self, keys, key, field, all_values=False):
+        """
+        Map many identifiers of one column to another column at once.
+        
+        parameters:
+        -----------
+        keys: List|np.array|pd.Series. The identifiers to map
+        key: String. The column that the identifiers are from
+        field: String. The column to map to
+        all_values: Boolean. Return a list of all values for each identifier, rather than the first one
+        
+        Returns:
+        --------
+        pd.Series. See formats.MappingIndex.map_many
+        """
+        return getattr(self, key).map_many(keys, field, all_values=all_values)
+    #edef
     
     def __str__(self):
         """
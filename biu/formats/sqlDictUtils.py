@@ -3,40 +3,79 @@ from . import SQLite
 
 import os
 import json
+import collections
 
 class SQLDict:
   """SQLDict is designed to behave like a dictionary, except that it stores the values of the dictionary in JSON Strings in a SQLite database behind the scenes.
   To improve speed, it also caches the values that it stores and retrieves from the SQLite database during runtime.
   This allows you to keep a running dataset of values without the need to recompute stuff each time.
 
+  Writes are buffered, and written in batches of batchSize entries in a single transaction.
+  Buffered writes are visible to this object immediately, but only reach the database when the buffer is flushed:
+    when it is full, when the dictionary is iterated or counted, at flush() or close(), or when the object is deleted.
+  The read cache keeps the cacheSize most recently used values.
+
   Operations supported:
 
   Initialization:
     D = SQLite("mydict")
     D["key"] = {"a" : [ 1, 2, 3, "faf", {1: 2}], "5" : -1 }
+    D.update({ "k%d" % i : i for i in range(100000) })
     for key in D:
       print(D[key])
     if "key" in D:
       print(D["key"])
+    D.flush()
+
+  Multiple processes:
+    With shared=True, several processes can read and write the same SQLDict.
+    Every write is committed directly (unless batchSize is given), and values are not cached, so that changes made by other processes are seen.
   """
 
   _sqlDict  = None
   _fileName = None
   _cache    = None
+  _pending  = None
 
-  def __init__(self, fileName, load=False):
+  _defaultPragmas = { "journal_mode" : "WAL", "synchronous" : "NORMAL" }
+
+  def __init__(self, fileName, load=False, batchSize=None, cacheSize=100000, shared=False, pragmas=None):
+    """
+    Initialize the SQLDict
+    parameters:
+    -----------
+    fileName:  String. The SQLite database file
+    load:      Boolean. Load all values into the cache (up to cacheSize)
+    batchSize: Integer. The number of writes that are buffered before they are written in one transaction.
+               Default: 1000, or 1 if shared
+    cacheSize: Integer. The maximum number of values in the read cache (0 for no cache, None for unbounded). Default 0 if shared.
+    shared:    Boolean. The database is used by several processes at once
+    pragmas:   Dictionary. SQLite PRAGMA settings (default: { "journal_mode" : "WAL", "synchronous" : "NORMAL" })
+    """
 
     new = utils.fs.isEmpty(fileName)
     if new:
       utils.touchFile(fileName)
     #fi
 
-    self._fileName = fileName
-    self._sqlDict  = SQLite(fileName)
-    self._cache    = {}
+    self._fileName  = fileName
+    self._sqlDict   = SQLite(fileName)
+    self._cache     = collections.OrderedDict()
+    self._pending   = collections.OrderedDict()
+    self._shared    = shared
+    self._batchSize = batchSize if batchSize is not None else (1 if shared else 1000)
+    self._cacheSize = 0 if shared else cacheSize
+
+    if shared:
+      # Wait for other processes to finish their transactions, rather than failing
+      self._sqlDict.execute("PRAGMA busy_timeout=60000;")
+    #fi
+    for (pragma, value) in (self._defaultPragmas if pragmas is None else pragmas).items():
+      self._sqlDict.execute("PRAGMA %s=%s;" % (pragma, value))
+    #efor
 
     if new:
-      self._sqlDict.execute("CREATE TABLE data(id STRING PRIMARY KEY, value TEXT);")
+      self._sqlDict.execute("CREATE TABLE IF NOT EXISTS data(id STRING PRIMARY KEY, value TEXT);")
     #fi
 
     if load:
@@ -44,15 +83,88 @@ class SQLDict:
     #fi
   #edef
 
+  # Marks a buffered deletion
+  _deleted = object()
+
+  def _remember(self, key, value):
+    """
+    Put a value in the read cache, and forget the least recently used values if it is full
+    """
+    if self._cacheSize == 0:
+      return
+    #fi
+    self._cache[key] = value
+    self._cache.move_to_end(key)
+    while (self._cacheSize is not None) and (len(self._cache) > self._cacheSize):
+      self._cache.popitem(last=False)
+    #ewhile
+  #edef
+
   def _store(self, key, value):
-    self._cache[str(key)] = value
-    return self._sqlDict.execute("REPLACE INTO data(id, value) VALUES (?, ?);", [str(key), json.dumps(value)])
+    key = str(key)
+    self._remember(key, value)
+    self._pending[key] = json.dumps(value)
+    self._pending.move_to_end(key)
+    if len(self._pending) >= self._batchSize:
+      self.flush()
+    #fi
+  #edef
+
+  def flush(self):
+    """
+    Write all buffered changes to the database, in a single transaction
+    """
+    if len(self._pending) == 0:
+      return
+    #fi
+    connection = self._sqlDict._connection
+    cursor     = connection.cursor()
+    cursor.execute("BEGIN IMMEDIATE;")
+    try:
+      cursor.executemany("REPLACE INTO data(id, value) VALUES (?, ?);", [ (k, v) for (k, v) in self._pending.items() if v is not self._deleted ])
+      cursor.executemany("DELETE FROM data WHERE id IS ?;", [ (k,) for (k, v) in self._pending.items() if v is self._deleted ])
+      cursor.execute("COMMIT;")
+    except BaseException:
+      cursor.execute("ROLLBACK;")
+      raise
+    #etry
+    self._pending.clear()
+  #edef
+
+  def close(self):
+    """
+    Write all buffered changes, and close the database
+    """
+    self.flush()
+    self._sqlDict._connection.close()
+  #edef
+
+  def __enter__(self):
+    return self
+  #edef
+
+  def __exit__(self, *exc):
+    self.close()
+  #edef
+
+  def __del__(self):
+    try:
+      self.flush()
+    except Exception:
+      pass
+    #etry
   #edef
 
   def _retrieve(self, key):
     key = str(key)
 
+    if key in self._pending:
+      value = self._pending[key]
+      return None if value is self._deleted else json.loads(value)
+    #fi
+
     if key in self._cache:
+      self._cache.move_to_end(key)
       return self._cache[key]
     #fi
 
@@ -61,7 +173,7 @@ class SQLDict:
       return None
     else:
       res = json.loads(res[0][0])
-      self._cache[key] = res
+      self._remember(key, res)
       return res
     #fi
   #edef
@@ -76,15 +188,29 @@ class SQLDict:
     default: Object
         The element to return if key is not present in the sqldict
     """
-    v = self.retrieve(key)
+    v = self._retrieve(key)
     if v is None:
         return default
     #fi
     return v
   #edef
 
-  def __delete(self, key):
-    return self._sqlDict.execute("DELETE FROM data WHERE id IS ?;", [key])
+  def update(self, other=None, **kwargs):
+    """
+    as the update function of a dictionary, but written in batches of batchSize entries, each in a single transaction
+    parameters:
+    -----------
+    other: dictionary or iterable of (key, value) pairs
+    **kwargs: Additional key=value pairs
+    """
+    items = [] if other is None else (other.items() if hasattr(other, 'items') else other)
+    for (key, value) in items:
+      self._store(key, value)
+    #efor
+    for (key, value) in kwargs.items():
+      self._store(key, value)
+    #efor
+    self.flush()
   #edef
 
   def __str__(self):
@@ -95,6 +221,7 @@ class SQLDict:
   #edef
 
   def __len__(self):
+    self.flush()
     res = list(self._sqlDict.execute("SELECT COUNT(*) FROM data;"))
     if len(res) == 0:
       return 0
@@ -112,11 +239,13 @@ class SQLDict:
   #edef
 
   def __delitem__(self, key):
+    key = str(key)
     if key in self:
-      del self._cache[key]
-      return self.__delete(key)
-    else:
-      return None
+      self._cache.pop(key, None)
+      self._pending[key] = self._deleted
+      if len(self._pending) >= self._batchSize:
+        self.flush()
+      #fi
     #fi
   #edef
 
@@ -128,40 +257,38 @@ class SQLDict:
       return False
     #fi
   #edef
- 
-  def __iter__(self):
-    self._iterKeys = list(self._sqlDict.execute("SELECT id FROM data;"))
-    return self
-  #edef
 
-  def __next__(self):
-    if len(self._iterKeys) == 0:
-      raise StopIteration
-    #fi
-    v = self._iterKeys.pop()
-    return v[0]
+  def __iter__(self):
+    return iter(self.keys())
   #edef
 
   def load(self):
+    """
+    Load values into the read cache (at most cacheSize values)
+    """
+    self.flush()
     res = self._sqlDict.execute("SELECT id, value FROM data;")
     for r in res:
+      if (self._cacheSize is not None) and (len(self._cache) >= self._cacheSize):
+        break
+      #fi
       key, value = r
-      self._cache[key] = json.loads(value)
+      self._remember(key, json.loads(value))
     #efor
   #edef
 
   def keys(self):
-    self.load()
-    return self._cache.keys()
+    self.flush()
+    return [ r[0] for r in self._sqlDict.execute("SELECT id FROM data;") ]
   #edef
 
   def values(self):
-    self.load()
-    return self._cache.values()
+    return [ v for (k, v) in self.items() ]
+  #edef
+
+  def items(self):
+    self.flush()
+    return [ (k, json.loads(v)) for (k, v) in self._sqlDict.execute("SELECT id, value FROM data;") ]
   #edef
 
-  def items():
-    self.load()
-    return self._cache.items()
- 
 #eclass
@@ -1,8 +1,82 @@
 from .. import utils
+from ..structures import DiskCache
+
+import os
 
 sqlite3 = utils.py.loadExternalModule('sqlite3')
 pd      = utils.py.loadExternalModule("pandas")
 
+###############################################################################
+
+def cachedDatabase(cacheName, key, build, meta=None):
+  """
+  Get an SQLite database from a DiskCache, and build it if it is not there yet.
+  The database is built in a temporary directory and only appears in the cache once it is complete,
+    so concurrent processes never see a partial database. It is stored in WAL mode, so many processes can read it at once.
+
+  parameters:
+  -----------
+  cacheName: String. The name of the DiskCache
+  key:       String. The key of the database in the cache
+  build:     Function(sqlite3.Connection). Fills an empty database
+  meta:      Dictionary. Metadata to store with the cache entry
+
+  Returns: The path to the database file
+  """
+  cache = DiskCache(cacheName)
+  entry = cache.lookup(key)
+  if entry is None:
+    tmp = cache.new_entry()
+    try:
+      connection = sqlite3.connect(os.path.join(tmp, 'index.sqlite'))
+      connection.execute("PRAGMA journal_mode=WAL;")
+      build(connection)
+      connection.commit()
+      connection.close()
+      entry = cache.commit(key, tmp, meta=meta)
+    except BaseException:
+      cache.discard(tmp)
+      raise
+    #etry
+  #fi
+  return os.path.join(entry, 'index.sqlite')
+#edef
+
+def connectShared(fileName):
+  """
+  Open a connection to a database that may be used by several processes at once.
+  Connections cannot be shared between processes; open one per process (e.g. after unpickling).
+  """
+  connection = sqlite3.connect(fileName, timeout=60, check_same_thread=False)
+  connection.execute("PRAGMA query_only=ON;")
+  return connection
+#edef
+
+def selectIn(connection, query, values, batchSize=500):
+  """
+  Run a query with an IN clause for many values, in batches (SQLite limits the number of parameters in a query).
+
+  parameters:
+  -----------
+  connection: sqlite3.Connection
+  query:      String. A query with a single '%s' where the placeholders of the IN clause go, e.g.
+              "SELECT key, value FROM data WHERE key IN (%s);"
+  values:     List. The values for the IN clause
+  batchSize:  Integer. The number of values per query
+
+  Returns: A list of all resulting rows
+  """
+  values = list(values)
+  rows   = []
+  for i in range(0, len(values), batchSize):
+    batch = values[i:i+batchSize]
+    rows.extend(connection.execute(query % ','.join([ '?' ] * len(batch)), batch).fetchall())
+  #efor
+  return rows
+#edef
+
+###############################################################################
+
 class SQLite(object):
   _diskloc = None
   _connection = None
@@ -1,21 +1,128 @@
 from .. import utils
 
+import io
+import gzip
+import zlib
+import struct
+
 pd    = utils.py.loadExternalModule("pandas")
+np    = utils.py.loadExternalModule("numpy")
 tabix = utils.py.loadExternalModule("tabix")
 
 from collections import namedtuple
 
+###############################################################################
+
+class TabixIndex(object):
+  """
+  The contents of a tabix (.tbi) index that are needed to read regions directly from the BGZF compressed file:
+    the column configuration, the sequence names, and per sequence the linear index
+    (the virtual file offset of the first record that overlaps each 16kb window).
+  """
+
+  __slots__ = [ 'format', 'colSeq', 'colBeg', 'colEnd', 'meta', 'skip', 'names', 'linear' ]
+
+  PRESET_GENERIC = 0
+  PRESET_SAM     = 1
+  PRESET_VCF     = 2
+  ZERO_BASED     = 0x10000
+  WINDOW_SHIFT   = 14
+
+  def __init__(self, tbiFile):
+    with gzip.open(tbiFile, 'rb') as ifd:
+      data = ifd.read()
+    #ewith
+
+    magic, nRef, self.format, self.colSeq, self.colBeg, self.colEnd, meta, self.skip, lNames = struct.unpack_from('<4s8i', data, 0)
+    if magic != b'TBI\x01':
+      raise ValueError("'%s' is not a tabix index." % tbiFile)
+    #fi
+    self.meta  = chr(meta)
+    self.names = [ n.decode() for n in data[36:36+lNames].split(b'\x00')[:nRef] ]
+
+    offset = 36 + lNames
+    self.linear = {}
+    for name in self.names:
+      nBin, = struct.unpack_from('<i', data, offset)
+      offset += 4
+      for b in range(nBin):
+        nChunk, = struct.unpack_from('<i', data, offset + 4)
+        offset += 8 + 16 * nChunk
+      #efor
+      nIntv, = struct.unpack_from('<i', data, offset)
+      offset += 4
+      linear = np.frombuffer(data, dtype='<u8', count=nIntv, offset=offset).astype(np.uint64)
+      # Empty windows have offset 0; they can start reading where the previous window starts
+      linear = np.maximum.accumulate(linear) if nIntv > 0 else linear
+      self.linear[name] = linear
+      offset += 8 * nIntv
+    #efor
+  #edef
+
+  def voffset(self, seqid, start):
+    """
+    The virtual file offset from which to read all records of seqid that overlap positions >= start (0-based)
+    Returns None if the sequence is not in the index.
+    """
+    linear = self.linear.get(seqid, None)
+    if (linear is None) or (len(linear) == 0):
+      return None
+    #fi
+    return int(linear[min(start >> self.WINDOW_SHIFT, len(linear) - 1)])
+  #edef
+#eclass
+
+###############################################################################
+
+def readBGZFBlock(fd, coffset):
+  """
+  Read and decompress the BGZF block at a compressed file offset.
+  Returns: (uncompressed data, offset of the next block). The data is empty at the end of the file.
+  """
+  fd.seek(coffset)
+  header = fd.read(18)
+  if len(header) < 18:
+    return b'', coffset
+  #fi
+  bsize = struct.unpack('<H', header[16:18])[0] + 1
+  block = fd.read(bsize - 18)
+  return zlib.decompress(block[:-8], -15), coffset + bsize
+#edef
+
+###############################################################################
+
 class Tabix(object):
 
-  def __init__(self, fileName, fieldNames=None):
+  def __init__(self, fileName, fieldNames=None, tbiFile=None):
     self.__fieldNames = fieldNames
     self.__fileName   = fileName
-    self.__resource   = tabix.open(fileName)
+    self.__tbiFile    = (fileName + '.tbi') if tbiFile is None else tbiFile
+    self.__resource   = None
+    self.__index      = None
     if self.__fieldNames is not None:
       self.__namedtuple = namedtuple("tabixTsv", fieldNames)
     #fi
   #edef
 
+  @property
+  def _resource(self):
+    if self.__resource is None:
+      self.__resource = tabix.open(self.__fileName)
+    #fi
+    return self.__resource
+  #edef
+
+  @property
+  def index(self):
+    """
+    The TabixIndex of the file
+    """
+    if self.__index is None:
+      self.__index = TabixIndex(self.__tbiFile)
+    #fi
+    return self.__index
+  #edef
+
   def __str__(self):
     dstr =  "Tabix object\n"
     dstr += " Where: %s\n" % self.__fileName
@@ -28,12 +135,12 @@ class Tabix(object):
 
   def __safeTabixWrapper(self, chrom, start, end):
     try:
-      return self.__resource.query(str(chrom), int(start), int(end))
+      return self._resource.query(str(chrom), int(start), int(end))
     except Exception as e:
       utils.msg.error(e)
       return []
     #etry
-  #edef 
+  #edef
 
   def query(self, seqid, start, end, **kwargs):
     return self.queryRegions([(seqid, start, end)], **kwargs)
@@ -49,4 +156,225 @@ class Tabix(object):
       return res
     #fi
   #edef
+
+  #############################################################################
+
+  @staticmethod
+  def mergeRegions(regions, gap=0):
+    """
+    Sort regions and merge the ones that overlap, or are at most gap apart.
+
+    parameters:
+    -----------
+    regions: List of (seqid, start, end) tuples, or a pandas DataFrame with these as its first three columns
+    gap: Integer. Merge regions that are at most this far apart
+
+    Returns: A pandas DataFrame with columns seqid, start, end, sorted by seqid and start
+    """
+    if not isinstance(regions, pd.DataFrame):
+      regions = pd.DataFrame(list(regions))
+    #fi
+    if regions.shape[0] == 0:
+      return pd.DataFrame({ 'seqid' : np.array([], dtype=str), 'start' : np.array([], dtype=np.int64), 'end' : np.array([], dtype=np.int64) })
+    #fi
+    regions = pd.DataFrame({ 'seqid' : regions.iloc[:, 0].astype(str).values,
+                             'start' : regions.iloc[:, 1].astype(np.int64).values,
+                             'end'   : regions.iloc[:, 2].astype(np.int64).values })
+    regions = regions.sort_values(['seqid', 'start'], kind='stable').reset_index(drop=True)
+
+    # A region starts a new block if it starts after the end of all previous regions on the same sequence
+    reach  = regions.groupby('seqid', sort=False).end.cummax().values
+    seqids = regions.seqid.values
+    new    = np.ones(regions.shape[0], dtype=bool)
+    new[1:] = (seqids[1:] != seqids[:-1]) | (regions.start.values[1:] > reach[:-1] + gap)
+
+    return pd.DataFrame({ 'seqid' : seqids[new],
+                          'start' : regions.start.values[new],
+                          'end'   : np.maximum.reduceat(regions.end.values, np.flatnonzero(new)) })
+  #edef
+
+  def __recordSpan(self, table, names):
+    """
+    The 0-based, half-open span of each record in a parsed table, following the tabix column configuration
+    """
+    idx = self.index
+    beg = table[names[idx.colBeg-1]].values.astype(np.int64)
+    if not (idx.format & idx.ZERO_BASED):
+      beg = beg - 1
+    #fi
+    if (idx.format & 0xffff) == idx.PRESET_VCF:
+      end = beg + table[names[3]].str.len().values.astype(np.int64)
+    elif (idx.colEnd > 0) and (idx.colEnd != idx.colBeg):
+      end = table[names[idx.colEnd-1]].values.astype(np.int64)
+    else:
+      end = beg + 1
+    #fi
+    return beg, end
+  #edef
+
+  def __skipTo(self, buf, seqid, start):
+    """
+    The offset in buf of the first line of a record of seqid that starts at or after start (0-based).
+    Lines are sorted, so this is a binary search over the line starts, which avoids parsing records before start.
+    """
+    idx    = self.index
+    meta   = idx.meta.encode()
+    seqCol = idx.colSeq - 1
+    begCol = idx.colBeg - 1
+    shift  = 0 if (idx.format & idx.ZERO_BASED) else 1
+
+    def before(lineStart):
+      line = buf[lineStart:buf.find(b'\n', lineStart)].split(b'\t')
+      if (line[0][:1] == meta) or (len(line) <= max(seqCol, begCol)):
+        return True
+      #fi
+      return (line[seqCol].decode() == seqid) and (int(line[begCol]) - shift < start)
+    #edef
+
+    lo, hi = 0, len(buf)
+    while lo < hi:
+      lineStart = buf.rfind(b'\n', lo, (lo + hi) // 2) + 1
+      lineStart = max(lineStart, lo)
+      if before(lineStart):
+        lo = buf.find(b'\n', lineStart) + 1
+      else:
+        hi = lineStart
+      #fi
+    #ewhile
+    return lo
+  #edef
+
+  def __readStretch(self, fd, seqid, voffset, until, readAhead):
+    """
+    Read records of seqid from a virtual file offset, until a record starts at or after until, and at least readAhead bytes are read.
+    Returns: (the bytes of the complete lines that were read, the start of the last record that was read, or None if all records of seqid were read)
+    """
+    idx     = self.index
+    meta    = idx.meta.encode()
+    seqCol  = idx.colSeq - 1
+    begCol  = idx.colBeg - 1
+    coffset = voffset >> 16
+    block, coffset = readBGZFBlock(fd, coffset)
+    block   = block[voffset & 0xffff:]
+    data    = []
+    size    = 0
+    partial = b'' # The incomplete line at the end of the data
+    while len(block) > 0:
+      data.append(block)
+      size += len(block)
+
+      # Check the last complete line
+      text = partial + block
+      last = text.rfind(b'\n')
+      if last < 0:
+        partial = text
+      else:
+        line    = text[text.rfind(b'\n', 0, last)+1:last].split(b'\t')
+        partial = text[last+1:]
+        if (line[0][:1] != meta) and (len(line) > max(seqCol, begCol)):
+          if line[seqCol].decode() != seqid:
+            buf = b''.join(data)
+            return buf[:len(buf)-len(partial)], None
+          #fi
+          lastBeg = int(line[begCol]) - (0 if (idx.format & idx.ZERO_BASED) else 1)
+          if (lastBeg >= until) and (size >= readAhead):
+            buf = b''.join(data)
+            return buf[:len(buf)-len(partial)], lastBeg
+          #fi
+        #fi
+      #fi
+      block, coffset = readBGZFBlock(fd, coffset)
+    #ewhile
+    return b''.join(data), None
+  #edef
+
+  def queryTable(self, regions, columns=None, dtype=None, readAhead=1 << 20):
+    """
+    Query many regions at once, and parse the records into a pandas DataFrame.
+    The regions are sorted and merged, and the records of the merged regions are read in stretches of consecutive records,
+      directly from the BGZF compressed file (using the .tbi index), and parsed by pandas.
+    Each record is returned once per merged region that it overlaps.
+    Like query, regions are 0-based and half-open, and records that overlap them are returned.
+
+    parameters:
+    -----------
+    regions: List of (seqid, start, end) tuples, or a pandas DataFrame with these as its first three columns
+    columns: List of column names (the fieldNames, or column numbers if there are no fieldNames) to return. Default: all columns
+    dtype: Type or dictionary of column -> type, for pandas.read_csv. Columns that are not given are inferred
+    readAhead: Integer. Read at least this many (uncompressed) bytes at once, so that nearby regions are read together
+
+    Returns: A pandas DataFrame with the records, in the order of the file
+    """
+    idx    = self.index
+    blocks = self.mergeRegions(regions)
+    nCols  = None
+    # Records of one position (no end column), for which the records that overlap a region all start in it
+    points = ((idx.format & 0xffff) != idx.PRESET_VCF) and (idx.colEnd in [ 0, idx.colBeg ])
+
+    results = []
+    with open(self.__fileName, 'rb') as fd:
+      for seqid in [ s for s in idx.names if s in set(blocks.seqid.values) ]:
+        sel    = (blocks.seqid.values == seqid)
+        starts = blocks.start.values[sel]
+        ends   = blocks.end.values[sel]
+        i = 0
+        while i < len(starts):
+          voffset = idx.voffset(seqid, int(starts[i]))
+          if voffset is None:
+            break
+          #fi
+          buf, lastBeg = self.__readStretch(fd, seqid, voffset, int(ends[i]), readAhead)
+
+          # The blocks whose records are all in this stretch
+          j = len(starts) if lastBeg is None else max(i+1, np.searchsorted(ends, lastBeg, side='right'))
+
+          if nCols is None:
+            first = next(( l for l in buf.split(b'\n', 64) if (len(l) > 0) and (l[:1] != idx.meta.encode()) ), None)
+            if first is None:
+              i = j
+              continue
+            #fi
+            nCols = len(first.split(b'\t'))
+            names = list(self.__fieldNames) if self.__fieldNames is not None else list(range(nCols))
+            names = names + list(range(len(names), nCols))
+            need  = names if columns is None else list(columns)
+            use   = sorted(set([ names.index(c) for c in need ] + [ idx.colSeq-1, idx.colBeg-1 ] +
+                               ([ idx.colEnd-1 ] if idx.colEnd > 0 else []) + ([ 3 ] if (idx.format & 0xffff) == idx.PRESET_VCF else [])))
+            types = dict(dtype) if isinstance(dtype, dict) else ({} if dtype is None else { n : dtype for n in need })
+            types[names[idx.colSeq-1]] = str
+          #fi
+
+          if points:
+            # Skip the records of the window before the first region
+            buf = buf[self.__skipTo(buf, seqid, int(starts[i])):]
+          #fi
+          if len(buf.strip()) == 0:
+            i = j
+            continue
+          #fi
+          table = pd.read_csv(io.BytesIO(buf), sep='\t', header=None, names=names[:nCols], usecols=[ names[u] for u in use ],
+                              dtype=types, comment=idx.meta, engine='c')
+          table = table[table[names[idx.colSeq-1]].values == seqid]
+          beg, end = self.__recordSpan(table, names)
+
+          # Select the records overlapping each block; records are sorted by start
+          span = int((end - beg).max()) if len(beg) > 0 else 0
+          lo   = np.searchsorted(beg, starts[i:j] - span, side='left')
+          hi   = np.searchsorted(beg, ends[i:j], side='left')
+          rows = np.repeat(lo - np.cumsum(np.concatenate([[0], (hi - lo)[:-1]])), hi - lo) + np.arange((hi - lo).sum())
+          rows = rows[end[rows] > np.repeat(starts[i:j], hi - lo)]
+          results.append(table.iloc[rows][need])
+          i = j
+        #ewhile
+      #efor
+    #ewith
+
+    if len(results) == 0:
+      if nCols is None:
+        need = list(columns) if columns is not None else ([] if self.__fieldNames is None else list(self.__fieldNames))
+      #fi
+      return pd.DataFrame(columns=need)
+    #fi
+    return pd.concat(results, ignore_index=True)
+  #edef
 #eclass
@@ -1,47 +1,127 @@
 from .. import utils
+from ..structures import DiskCache
+from . import sqliteUtils
 
 import csv
+import json
 from collections import namedtuple
 
 pd = utils.py.loadExternalModule("pandas")
+sqlite3 = utils.py.loadExternalModule('sqlite3')
 
 class TSVIndex(object):
+  """
+  Index a TSV file on one (or more) of its columns.
+  The rows are stored in an SQLite database in a DiskCache (see sqliteUtils.cachedDatabase), which is rebuilt only when the file changes.
+  Opening an existing index takes constant time, and it can be read by several processes at once.
+  """
 
-  __slots__ = [ '__idx', '__lst', '__key', '__fileName', '__tbl', '__names', '__emptyResult' ]
+  __slots__ = [ '__db', '__dbFile', '__key', '__keyExpr', '__fileName', '__tbl', '__names', '__nColumns', '__emptyResult', '__rowType' ]
 
   def __init__(self, fileName, key=0, names=None, header=False, **kwargs):
-    self.__idx = {}
-    self.__lst = []
+    """
+    Initialize the TSVIndex object.
+
+    parameters:
+    -----------
+    fileName: The path to the relevant file
+    key:      Integer|Tuple[Integer]. The column(s) to index on. Keys of multiple columns are joined with ','
+    names:    The names of the fields. If given, rows are returned as named tuples
+    header:   Is there a header in the file?
+    **kwargs: Additional arguments to csv.reader
+    """
     self.__fileName = fileName
     self.__tbl = None
     self.__names = names
-    self.__emptyResult = None
-    if isinstance(key, int):
-      self.__key = tuple([key])
-    #fi
+    self.__key = tuple([key]) if isinstance(key, int) else tuple(key)
+
+    def build(connection):
+      with open(fileName, 'r') as csvfile:
+        reader = csv.reader(csvfile, **kwargs)
+        if header: # If there was a header, we can skip it.
+          next(reader, None)
+        #fi
+        first = next(reader, None)
+        nColumns = len(names) if names is not None else (0 if first is None else len(first))
+        columns = [ 'c%d' % i for i in range(nColumns) ]
+        connection.execute("CREATE TABLE rows(%s);" % ', '.join([ '%s TEXT' % c for c in columns ]))
+        connection.execute("CREATE TABLE meta(nColumns INTEGER);")
+        connection.execute("INSERT INTO meta VALUES (?);", [ nColumns ])
+
+        insert = "INSERT INTO rows VALUES (%s);" % ','.join([ '?' ] * nColumns)
+        rows = [] if first is None else [ first ]
+        for row in reader:
+          rows.append(row)
+          if len(rows) >= 10000:
+            connection.executemany(insert, [ self.__dbRow(r, nColumns) for r in rows ])
+            rows = []
+          #fi
+        #efor
+        connection.executemany(insert, [ self.__dbRow(r, nColumns) for r in rows ])
+      #ewith
+    #edef
+
+    key = DiskCache.key(DiskCache.file_key(fileName), names, header, json.dumps(kwargs, sort_keys=True, default=str))
+    self.__dbFile = sqliteUtils.cachedDatabase("tsv_index", key, build, meta={ "file" : fileName })
+
+    # The key expression matches the way keys were made from the raw rows, where missing values were empty strings
+    self.__keyExpr = " || ',' || ".join([ "IFNULL(c%d, '')" % i for i in self.__key ])
+    with sqlite3.connect(self.__dbFile, timeout=60) as connection:
+      connection.execute("CREATE INDEX IF NOT EXISTS idx_%s ON rows(%s);" % ('_'.join([ str(i) for i in self.__key ]), self.__keyExpr))
+    #ewith
+    connection.close()
+
+    self.__db = None
+    self.__nColumns = self.__connection.execute("SELECT nColumns FROM meta;").fetchone()[0]
 
-    
     if names is not None:
-      namedTupleObject = namedtuple('TSVIndexRow', names)
-      self.__emptyResult = [namedTupleObject(*([None] * len(names)))]
+      self.__rowType = namedtuple('TSVIndexRow', names)
+      self.__emptyResult = [self.__rowType(*([None] * len(names)))]
+    else:
+      self.__rowType = None
+      self.__emptyResult = [None] * self.__nColumns
     #fi
+  #edef
 
-    itemKey = lambda item: ','.join([ item[i] for i in self.__key])
-
-    with open(fileName, 'r') as csvfile:
-      reader = csv.reader(csvfile, **kwargs)
-      if header: # If there was a header, we can skip it.
-        next(reader)
-      #fi
-      for i, row in enumerate(reader):
-         noneRow = [ value if (value != '') else None for value in row ]
-         self.__lst.append( namedTupleObject(*noneRow) if names is not None else noneRow )
-         self.__idx[itemKey(row)] = self.__idx.get(itemKey(row), []) + [ i ]
-      #efor
-      if self.__emptyResult is None:
-        self.__emptyResult = [None] * len(row)
-      #fi
-    #ewith
+  @staticmethod
+  def __dbRow(row, nColumns):
+    """
+    The values of a row as they are stored: empty values are missing, and rows are padded to the number of columns
+    """
+    row = [ value if (value != '') else None for value in row[:nColumns] ]
+    return row + [ None ] * (nColumns - len(row))
+  #edef
+
+  @property
+  def __connection(self):
+    # Connections cannot be pickled, so each process opens its own
+    if self.__db is None:
+      self.__db = sqliteUtils.connectShared(self.__dbFile)
+    #fi
+    return self.__db
+  #edef
+
+  def __getstate__(self):
+    return { s : getattr(self, '_TSVIndex%s' % s) for s in self.__slots__ if s not in [ '__db', '__tbl', '__rowType', '__emptyResult' ] }
+  #edef
+
+  def __setstate__(self, state):
+    for (s, v) in state.items():
+      setattr(self, '_TSVIndex%s' % s, v)
+    #efor
+    self.__db = None
+    self.__tbl = None
+    if self.__names is not None:
+      self.__rowType = namedtuple('TSVIndexRow', self.__names)
+      self.__emptyResult = [self.__rowType(*([None] * len(self.__names)))]
+    else:
+      self.__rowType = None
+      self.__emptyResult = [None] * self.__nColumns
+    #fi
+  #edef
+
+  def __row(self, row):
+    return self.__rowType(*row) if self.__rowType is not None else list(row)
   #edef
 
   @property
@@ -50,7 +130,7 @@ class TSVIndex(object):
     table: Get a pandas dataframe of the rows
     """
     if self.__tbl is None:
-      self.__tbl = pd.DataFrame(self.__lst, columns=self.__names)
+      self.__tbl = pd.DataFrame(self.values(), columns=self.__names)
     #fi
     return self.__tbl
   #edef
@@ -61,20 +141,40 @@ class TSVIndex(object):
     Inputs: key :      [str] index value to retrieve
             singleton: [bool] Only return one value (the first we find)
     """
-    if key not in self.__idx:
+    rows = self.__connection.execute("SELECT * FROM rows WHERE %s = ? ORDER BY rowid;" % self.__keyExpr, [ key ]).fetchall()
+    if len(rows) == 0:
       utils.msg.error("Item '%s' not in map." % key)
       return self.__emptyResult
     #fi
 
     if singleton:
-      return self.__lst[self.__idx[key][0]]
+      return self.__row(rows[0])
     #fi
 
-    return [ self.__lst[i] for i in self.__idx[key] ]
+    return [ self.__row(r) for r in rows ]
+  #edef
+
+  def lookup_many(self, keys, singleton=False):
+    """
+    lookup_many: Lookup the values of many keys at once, with batched queries
+    Inputs: keys :      [list of str] index values to retrieve
+            singleton: [bool] Only return one value per key (the first we find)
+    Output: A list with the result of lookup for each key. Unknown keys give the empty result (without an error message)
+    """
+    keys = list(keys)
+    found = {}
+    for row in sqliteUtils.selectIn(self.__connection, "SELECT %s, * FROM rows WHERE %s IN (%%s) ORDER BY rowid;" % (self.__keyExpr, self.__keyExpr), set(keys)):
+      found.setdefault(row[0], []).append(self.__row(row[1:]))
+    #efor
+
+    if singleton:
+      return [ found[k][0] if k in found else self.__emptyResult for k in keys ]
+    #fi
+    return [ found.get(k, self.__emptyResult) for k in keys ]
   #edef
 
   def __contains__(self, key):
-    return key in self.__idx
+    return self.__connection.execute("SELECT 1 FROM rows WHERE %s = ? LIMIT 1;" % self.__keyExpr, [ key ]).fetchone() is not None
   #edef
 
   def __getitem__(self, key):
@@ -82,35 +182,39 @@ class TSVIndex(object):
   #edef
 
   def __iter__(self):
-    return self.__lst.__iter__()
+    return ( self.__row(r) for r in self.__connection.execute("SELECT * FROM rows ORDER BY rowid;") )
+  #edef
+
+  def __len__(self):
+    return self.__connection.execute("SELECT COUNT(*) FROM rows;").fetchone()[0]
   #edef
 
   def keys(self):
     """
     keys: Return a list of keys of the index
     """
-    return self.__idx.keys()
+    return [ r[0] for r in self.__connection.execute("SELECT %s FROM rows GROUP BY %s ORDER BY MIN(rowid);" % (self.__keyExpr, self.__keyExpr)) ]
   #edef
 
   def values(self):
     """
     values: Return a list of values of the index
     """
-    return self.__lst
+    return list(iter(self))
   #edef
 
   def __str__(self):
     dstr = "Indexed TSV Object\n"
     dstr += " Filename: %s\n" % self.__fileName
     dstr += " Indexed on column %s\n" % (str(self.__key))
-    dstr += " #Rows : %d\n" % len(self.__lst)
-    dstr += " #Indexes: %d\n" % len(self.__idx)
+    dstr += " #Rows : %d\n" % len(self)
+    dstr += " #Indexes: %d\n" % self.__connection.execute("SELECT COUNT(DISTINCT %s) FROM rows;" % self.__keyExpr).fetchone()[0]
     return dstr
   #edef
-    
+
   def __repr__(self):
     return str(self)
   #edef
 
 #eclass
-          
+
@@ -1,55 +1,68 @@
 from .. import utils
-import os
+from ..structures import DiskCache
+from . import sqliteUtils
 
 import csv
 import json
 
+sqlite3 = utils.py.loadExternalModule('sqlite3')
+
 class TSVMap(object):
-  __mapping = None
-  __mappingR = None
+  """
+  A mapping between the values of two columns of a TSV file, in both directions.
+  The mapping is stored in an SQLite database, which is opened in constant time and can be read by several processes at once.
+  If pickle is True, the database is kept in a DiskCache (see sqliteUtils.cachedDatabase) and reused until the file changes.
+  """
   def __init__(self, tsvFile, mapFrom=0, mapTo=1, pickle=True, overwritePickle=False, **kwargs):
-    self.__mapping  = {}
-    self.__mappingR = {}
     self.__fileName = tsvFile
     self.__mapFrom  = mapFrom
     self.__mapTo    = mapTo
     self.__pickle   = pickle
+    self.__inverted = False
+    self.__db       = None
 
-    mapPickleFile  = tsvFile + '.tsvMap.pkl'
-    mapRPickleFile = tsvFile + '.tsvMap.r.pkl'
-
-    if pickle and not(overwritePickle) and os.path.exists(mapPickleFile) and os.path.exists(mapRPickleFile):
-      utils.msg.dbm("Loading the index from pickle")
-      with open(mapPickleFile, 'r') as ifd:
-        self.__mapping  = json.load(ifd)
-      with open(mapRPickleFile, 'r') as ifd:
-        self.__mappingR = json.load(ifd)
-    else:
+    def build(connection):
       utils.msg.dbm("Generating the index")
+      connection.execute("CREATE TABLE map(i INTEGER, f TEXT, t TEXT);")
       with open(tsvFile, 'r') as ifd:
-        for i, row in enumerate(csv.reader(ifd, **kwargs)):
-          fromValue = str(row[mapFrom])
-          toValue   = str(row[mapTo])
-          if fromValue not in self.__mapping:
-            self.__mapping[fromValue] = []
-          #fi
-          if toValue not in self.__mappingR:
-            self.__mappingR[toValue] = []
-          #fi
-          self.__mapping[fromValue].append((toValue, i))
-          self.__mappingR[toValue].append((fromValue, i))
-        #efor
+        rows = ( (i, str(row[mapFrom]), str(row[mapTo])) for (i, row) in enumerate(csv.reader(ifd, **kwargs)) )
+        connection.executemany("INSERT INTO map VALUES (?, ?, ?);", rows)
       #ewith
-      if pickle:
-        utils.msg.dbm("Pickling the index")
-        with open(mapPickleFile, 'w') as ofd:
-          json.dump(self.__mapping, ofd)
-        #ewith
-        with open(mapRPickleFile, 'w') as ofd:
-          json.dump(self.__mappingR, ofd)
-        #ewith
+      connection.execute("CREATE INDEX idx_map_f ON map(f);")
+      connection.execute("CREATE INDEX idx_map_t ON map(t);")
+    #edef
+
+    if pickle:
+      key = DiskCache.key(DiskCache.file_key(tsvFile), mapFrom, mapTo, json.dumps(kwargs, sort_keys=True, default=str))
+      cache = DiskCache("tsv_map")
+      if overwritePickle and (key in cache):
+        cache.discard(cache.lookup(key))
       #fi
+      utils.msg.dbm("Loading the index")
+      self.__dbFile = sqliteUtils.cachedDatabase("tsv_map", key, build, meta={ "file" : tsvFile })
+    else:
+      self.__dbFile = None
+      self.__db     = sqlite3.connect(':memory:', check_same_thread=False)
+      build(self.__db)
+    #fi
+  #edef
+
+  @property
+  def __connection(self):
+    # Connections cannot be pickled, so each process opens its own
+    if self.__db is None:
+      self.__db = sqliteUtils.connectShared(self.__dbFile)
+    #fi
+    return self.__db
+  #edef
+
+  def __getstate__(self):
+    if self.__dbFile is None:
+      raise TypeError("A TSVMap with pickle=False is kept in memory, and cannot be shared with other processes.")
     #fi
+    state = dict(self.__dict__)
+    state['_TSVMap__db'] = None
+    return state
   #edef
 
   def __str__(self):
@@ -58,13 +71,13 @@ class TSVMap(object):
     """
     dstr = "TSVMap object\n"
     dstr += " Filename: %s\n" % self.__fileName
-    dstr += " %d -> %d\n" % (self.__mapFrom, self.__mapTo)
+    dstr += " %d -> %d\n" % ((self.__mapTo, self.__mapFrom) if self.__inverted else (self.__mapFrom, self.__mapTo))
     dstr += " Pickled: %s\n" % ('Yes' if self.__pickle else 'No')
     dstr += " From entries: %d\n" % len(self.fromKeys)
     dstr += " To entries: %d\n" % len(self.toKeys)
     return dstr
   #edef
-    
+
   def __repr__(self):
     """
     String representation of object.
@@ -72,16 +85,22 @@ class TSVMap(object):
     return str(self)
   #edef
 
+  def __columns(self, inverse):
+    # (key column, value column) of the map table
+    return ('t', 'f') if (inverse != self.__inverted) else ('f', 't')
+  #edef
+
   def __lookup(self, key, inverse, withEntry):
-    mapping = self.__mappingR if inverse else self.__mapping
-    if key not in mapping:
+    keyCol, valueCol = self.__columns(inverse)
+    rows = self.__connection.execute("SELECT %s, i FROM map WHERE %s = ? ORDER BY i;" % (valueCol, keyCol), [ str(key) ]).fetchall()
+    if len(rows) == 0:
       utils.msg.error("'%s' not in map" % key)
       return []
     else:
       if withEntry:
-        return mapping[key]
+        return rows
       else:
-        return [ v[0] for v in mapping[key] ]
+        return [ v[0] for v in rows ]
       #fi
     #fi
   #edef
@@ -97,20 +116,42 @@ class TSVMap(object):
     return self.__lookup(key, True, withEntry=withEntry)
   #edef
 
+  def lookup_many(self, keys, inverse=False, withEntry=False):
+    """
+    Lookup many keys at once, with batched queries.
+    parameters:
+    -----------
+    keys:      List of keys
+    inverse:   Boolean. Map in the inverse direction (like inverse)
+    withEntry: Boolean. Also return the row number of each mapping
+
+    Returns: A list with the result of lookup for each key. Unknown keys give an empty list (without an error message)
+    """
+    keys = [ str(k) for k in keys ]
+    keyCol, valueCol = self.__columns(inverse)
+    found = {}
+    for (k, v, i) in sqliteUtils.selectIn(self.__connection, "SELECT %s, %s, i FROM map WHERE %s IN (%%s) ORDER BY i;" % (keyCol, valueCol, keyCol), set(keys)):
+      found.setdefault(k, []).append((v, i) if withEntry else v)
+    #efor
+    return [ found.get(k, []) for k in keys ]
+  #edef
+
+  def __keys(self, column):
+    return [ r[0] for r in self.__connection.execute("SELECT %s FROM map GROUP BY %s ORDER BY MIN(i);" % (column, column)) ]
+  #edef
+
   @property
   def fromKeys(self):
-    return list(self.__mapping.keys())
+    return self.__keys(self.__columns(False)[0])
   #edef
 
   @property
   def toKeys(self):
-    return list(self.__mappingR.keys())
+    return self.__keys(self.__columns(True)[0])
   #edef
 
   def invert(self):
-    mapping = self._mapping
-    self.mapping = self._mappingR
-    self.mappingR = mapping
+    self.__inverted = not self.__inverted
   #edef
 
 #eclass
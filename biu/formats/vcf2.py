@@ -1,10 +1,12 @@
 import os
 
 from .. import utils
+from ..structures import DiskCache
 
 cyvcf2 = utils.py.loadExternalModule('cyvcf2')
 np     = utils.py.loadExternalModule('numpy')
 pd     = utils.py.loadExternalModule('pandas')
+ssparse = utils.py.loadExternalModule('scipy.sparse')
 
 class MyOwnVariant(object):
     def __init__(self, data):
@@ -25,7 +27,8 @@ class MyOwnVariant(object):
 
             self._FILTER = None if self._FILTER[0].lower() in ['.', 'pass'] else self._FILTER
 
-            self._INFO   = dict([ x.split('=') for x in fields[7].split(';') ])
+            # Flag fields (without a value) are set to True
+            self._INFO   = dict([ (x.split('=', 1) + [True])[:2] for x in fields[7].split(';') ]) if fields[7] != '.' else {}
             if len(fields) > 8:
                 self._FORMAT  = fields[8].split(':')
                 self._samples = dict(zip(self._FORMAT, zip(*[p.split(':') for p in fields[9:] ])))
@@ -287,7 +290,8 @@ class MyOwnVariant(object):
     #edef
     
     def __str__(self):
-        info = ';'.join('%s=%s' % (k,v) for (k,v) in self._INFO.items())
+        info = ';'.join(k if (v is True) else '%s=%s' % (k,v) for (k,v) in self._INFO.items())
+        info = '.' if info == '' else info
         people = '\t'.join([ ':'.join(x) for x in zip(*[self._samples[k] for k in self._FORMAT])])
         return '\t'.join([self.CHROM, str(self.POS), self._ID, self._REF, ','.join(self.ALT),
                          self._QUAL, '.' if self._FILTER is None else ','.join(self._FILTER),
@@ -454,6 +458,7 @@ class BiuVariant(object):
         """
         Make a summary of the variants at this variant
         ASSUMES A MONOPLOID/DIPLOID ORGANISM!
+        Samples with a missing or polyploid genotype are counted as Other (O).
         parameters:
         self: BiuVariant Variant object
         altpos: Integer, List[Integer]
@@ -462,40 +467,15 @@ class BiuVariant(object):
         Returns: DataFrame
         """
         
-        counts  = []
-        idxs = []
-        
         if altpos is None:
             altpos = list(range(len(self.ALT)))
         elif isinstance(altpos, int):
             altpos = [altpos]
         #fi
         
-        for i in altpos:
-            alt = self.ALT[i]
-            ident = self.make_identifier(i)
-            pos = i+1
-
-            #                   RR, RA, AA, R, A, O
-            v_count = np.array([ 0,  0,  0, 0, 0, 0])
-            n_genotypes = len(self.genotypes)
-
-            for gt in self.genotypes:
-                if len(gt) == 2: # Monoploid!
-                    v_count[3+(gt[0]==pos)] += 1
-                elif len(gt) == 3: # Diploid
-                    v_count[(gt[0]==pos)+(gt[1]==pos)] += 1
-                else: #Polyploid! Don't count this sample!
-                    pass
-                #fi
-            #efor
-
-            # Set the Other count
-            v_count[-1] = n_genotypes - sum(v_count)
-
-            counts.append(v_count)
-            idxs.append(ident)
-        #efor
+        codes  = _genotype_codes(_genotype_alleles(self), len(self.ALT))[altpos]
+        counts = np.stack([ (codes == k).sum(axis=1) for k in range(len(_SUMMARY_CODES)) ], axis=1)
+        idxs   = [ self.make_identifier(i) for i in altpos ]
 
         return pd.DataFrame(counts, index=idxs, columns=['RR','RA','AA','R','A', 'O'])
     #edef
@@ -503,6 +483,85 @@ class BiuVariant(object):
 
 ###################################################################
 
+def _genotype_alleles(var):
+    """
+    Get the called alleles of each sample in a variant as an integer array.
+    Reads the cyvcf2 genotype array directly, without building python genotype lists.
+    
+    parameters:
+    var: cyvcf2.Variant, MyOwnVariant or BiuVariant object
+    
+    Returns: numpy int16 array of shape (n_samples, ploidy). Missing alleles are negative.
+    """
+    if isinstance(var, BiuVariant):
+        var = var._var
+    #fi
+    
+    if isinstance(var, MyOwnVariant):
+        gts    = var.genotypes
+        ploidy = max([ len(gt) - 1 for gt in gts ] + [0])
+        alleles = np.full((len(gts), ploidy), -2, dtype=np.int16)
+        for i, gt in enumerate(gts):
+            alleles[i,:len(gt)-1] = gt[:-1]
+        #efor
+        return alleles
+    #fi
+    
+    return var.genotype.array()[:,:-1]
+#edef
+
+# The genotype categories counted in variant summaries
+_SUMMARY_CODES = [ 'RR', 'RA', 'AA', 'R', 'A', 'O' ]
+
+def _genotype_codes(alleles, n_alts):
+    """
+    Categorize the genotype of each sample, for each alternative allele.
+    
+    parameters:
+    alleles: Integer array of shape (n_samples, ploidy), as given by _genotype_alleles
+    n_alts: Integer. The number of alternative alleles of the variant
+    
+    Returns: int8 array of shape (n_alts, n_samples) with indexes into _SUMMARY_CODES:
+             0: RR, 1: RA, 2: AA (diploid), 3: R, 4: A (monoploid), 5: O (missing or polyploid)
+    """
+    ploidy  = (alleles != -2).sum(axis=1)
+    missing = (alleles == -1).any(axis=1)
+    copies  = (alleles[None,:,:] == np.arange(1, n_alts+1)[:,None,None]).sum(axis=2)
+    
+    codes = np.full(copies.shape, 5, dtype=np.int8)
+    codes[:, ploidy == 2] = copies[:, ploidy == 2]
+    codes[:, ploidy == 1] = 3 + copies[:, ploidy == 1]
+    codes[:, missing]     = 5
+    return codes
+#edef
+
+def _match_allele(var, ref, alt):
+    """
+    Determine which allele in a variant record corresponds to the alternative allele of a queried variant.
+    
+    parameters:
+    var: Variant record
+    ref: String. Reference allele of the queried variant
+    alt: String. Alternative allele of the queried variant
+    
+    Returns: Integer index of the allele (with 0 the REF allele), or None if the record does not describe the variant.
+             In the case of an allele switch, this is the index of the queried reference allele.
+    """
+    ref = ref.upper()
+    alt = alt.upper()
+    
+    alleles = [ var.REF.upper() ] + [ a.upper() for a in var.ALT ]
+    
+    if (alleles[0] == ref) and (alt in alleles[1:]):
+        return alleles.index(alt)
+    elif (alleles[0] == alt) and (ref in alleles[1:]):
+        return alleles.index(ref)
+    #fi
+    return None
+#edef
+
+###################################################################
+
 class VCF_filter(object):
     """
     A structure to describe a VCF filtering step.
@@ -545,35 +604,42 @@ class VCF2(object):
     There are five different filters, and the internal representation changes depending on the filter.
     These transitions are explained below.
      * filter_samples   (Only retrieve records for a specific set of samples)
-        VCF_cyvcf2       -> VCF_cyvcf2
+        VCF_cyvcf2       -> VCF_cyvcf2 (Raises Exception if other filters have already been applied)
         VCF_records      -> Raises Exception (You can't select samples at this stage)
 
      * filter_region    (Retrieve records for a specific region)
-        VCF_cyvcf2       -> VCF_records
+        VCF_cyvcf2       -> VCF_cyvcf2 (lazy)
         VCF_records      -> VCF_records
         
      * filter_filter    (Retrieve records that do not pass certain filters)
-        VCF_cyvcf2       -> VCF_records
+        VCF_cyvcf2       -> VCF_cyvcf2 (lazy)
         VCF_records      -> VCF_records
         
      * filter_n_alleles (Retrieve only records that have at most a certain number of alternative alleles)
-        VCF_cyvcf2       -> VCF_records
+        VCF_cyvcf2       -> VCF_cyvcf2 (lazy)
         VCF_records      -> VCF_records
 
      * filter_vartypes  (Retrieve only records of a specific type)
-        VCF_cyvcf2       -> VCF_records
+        VCF_cyvcf2       -> VCF_cyvcf2 (lazy)
         VCF_records      -> VCF_records
+        
+     Filters on a VCF_cyvcf2 object are not evaluated until the variants are iterated over,
+       or a terminal operation (genotype_matrix, summary, who_has, ...) is performed.
+       The first region is pushed down to a tabix query, and all other filters are evaluated together
+       in a single streaming pass, so chained filters on a large file run in constant memory.
+       Accessing the records property (or to_records()) materializes the records in memory.
      
      Typical usage:
      
      x = VCF2('my.vcf.tgz')               # Internal representation: VCF_cyvcf2
-     x = x.filter(12, 50012321, 50042321) # Internal representation: VCF_records
-     x = x.filter(samples=[a,b,c,d])      # Internal representation: VCF_records
+     x = x.filter(12, 50012321, 50042321) # Internal representation: VCF_cyvcf2 (lazy)
+     x = x.filter(samples=[a,b,c,d])      # Raises Exception
      
      x = VCF2('my.vcf.tgz')               # Internal representation: VCF_cyvcf2
      x = x.filter(samples=[a,b,c,d])      # Internal representation: VCF_cyvcf2
-     x = x.filter(12, 50012321, 50042321) # Internal representation: VCF_records
-     x = x.filter(12, 50012321, 50032321) # Internal representation: VCF_records
+     x = x.filter(12, 50012321, 50042321) # Internal representation: VCF_cyvcf2 (lazy)
+     x = x.filter(12, 50012321, 50032321) # Internal representation: VCF_cyvcf2 (lazy)
+     x.to_records()                       # Internal representation: VCF_records
     
     """
     
@@ -797,11 +863,39 @@ class VCF2(object):
             rel_pos = ref_pos
         #fi
 
-        person_has = [ (a1 == rel_pos) or (a2 == rel_pos) for (a1,a2, phased) in var.genotypes ]
+        person_has = (_genotype_alleles(var) == rel_pos).any(axis=1)
 
         return np.array(self.samples)[person_has]
     #edef
     
+    def who_has_many(self, variants, max_gap=10000):
+        """
+        Determine who has each of a set of variants.
+        
+        The variants are sorted and merged into as few tabix range queries as possible,
+          and the carriers of each variant are determined directly from its genotype array.
+        
+        parameters:
+        -----------
+        variants: DataFrame with columns chrom, pos, ref, alt. The variants to look up
+        max_gap:  int. Variants on the same chromosome that are closer than this are retrieved in one query
+        
+        returns:
+        --------
+        Boolean DataFrame of variants x samples (in the order of the input), indexed by variant identifier.
+        Variants that do not exist have no carriers.
+        """
+        samples  = self.samples
+        carriers = np.zeros((len(variants), len(samples)), dtype=bool)
+        
+        for (i, var, allele) in self._match_variants(variants, max_gap):
+            carriers[i] = (_genotype_alleles(var) == allele).any(axis=1)
+        #efor
+        
+        idxs = [ '%s-%d-%s-%s' % (str(c), int(p), r, a) for (c, p, r, a) in variants[['chrom', 'pos', 'ref', 'alt']].values ]
+        return pd.DataFrame(carriers, index=idxs, columns=samples)
+    #edef
+    
     def get_var(self, chrom, pos, ref, alt):
         """
         Get the variant record for a specific variant
@@ -839,54 +933,393 @@ class VCF2(object):
         return None
     #edef
     
-    def genotype_matrix(self):
+    def get_vars(self, variants, max_gap=10000):
+        """
+        Get the variant records for a set of variants
+        
+        parameters:
+        -----------
+        variants: DataFrame with columns chrom, pos, ref, alt. The variants to look up
+        max_gap:  int. Variants on the same chromosome that are closer than this are retrieved in one query
+        
+        returns:
+        --------
+        A list (in the order of the input) of variant records if the variant exists. Otherwise None
+        """
+        found = [ None ] * len(variants)
+        for (i, var, allele) in self._match_variants(variants, max_gap):
+            found[i] = self._vcf._wrap(var)
+        #efor
+        return found
+    #edef
+    
+    def _match_variants(self, variants, max_gap):
+        """
+        Find the records that correspond to a set of variants, with as few region queries as possible.
+        
+        parameters:
+        -----------
+        variants: DataFrame with columns chrom, pos, ref, alt.
+        max_gap:  int. Variants on the same chromosome that are closer than this are retrieved in one query
+        
+        yields:
+        -------
+        3-tuples of (row number in variants, variant record, index of the queried alt allele in the record)
+        """
+        chroms = variants.chrom.astype(str).values
+        pos    = variants.pos.astype(int).values
+        refs   = variants.ref.values
+        alts   = variants.alt.values
+        
+        lookup = {}
+        for i, key in enumerate(zip(chroms, pos)):
+            lookup.setdefault(key, []).append(i)
+        #efor
+        
+        regions = []
+        for chrom in sorted(set(chroms)):
+            cpos   = np.unique(pos[chroms == chrom])
+            breaks = np.flatnonzero(np.diff(cpos) > max_gap) + 1
+            starts = cpos[np.concatenate([[0], breaks])]
+            ends   = cpos[np.concatenate([breaks - 1, [len(cpos) - 1]])]
+            regions.extend([ (chrom, s, e) for (s, e) in zip(starts, ends) ])
+        #efor
+        
+        for var in self._vcf.iter_variants(regions=regions):
+            for i in lookup.get((str(var.CHROM), var.POS), []):
+                allele = _match_allele(var, refs[i], alts[i])
+                if allele is not None:
+                    yield (i, var, allele)
+                #fi
+            #efor
+        #efor
+    #edef
+    
+    def genotype_matrix(self, sparse=False, mmap=None, chunk_size=10000, n_workers=None, regions=None, cache=False):
         """
         Create a genotype matrix for each variant in the object
         
+        The matrix is filled directly from the genotype arrays, in blocks of chunk_size variants,
+        without constructing intermediate variant records.
+        
+        parameters:
+        -----------
+        sparse: Boolean. Return a sparse DataFrame, built from a CSR matrix
+        mmap: String. Path of a file to write the matrix to. The result is memory-mapped from this file.
+        chunk_size: Integer. The number of (variant, alt allele) rows in each block
+        n_workers: Integer. Build the matrix per contig (or per region) in this many processes. See map_regions.
+        regions: list of 3-tuples (chrom, start, end). Build the matrix per region, in a process pool. See map_regions.
+        cache: Boolean. Store the matrix in an on-disk cache (see biu.structures.DiskCache), keyed by the file and the
+               filter_stack. Repeated requests memory-map the cached arrays instead of reading the VCF file again.
+               Objects that have been filtered with functions (e.g. samples_format) are never cached.
+        
+        Returns:
+        --------
+        DataFrame of int8 alt allele counts, with samples as rows and variant identifiers as columns.
+        
         NOTE:
-        For a polyploid organism, the gt counts will be (e.g. for )
+        For a polyploid organism, the gt counts will be the number of copies of the alt allele (e.g. 0-4 for tetraploid)
         
         """
-        self.to_records()
+        if sparse and (mmap is not None):
+            raise ValueError("Cannot produce a sparse and a memory-mapped genotype matrix at the same time.")
+        #fi
         
-        gts  = []
-        idxs = []
-
-        for var in self.records:
-            for i, alt in enumerate(var.ALT):
-                ident = self.make_identifier(var, i)
-                pos = i+1
-                var_gts = [ sum([a == pos for a in gt[:-1] ]) for gt in var.genotypes ]
-                gts.append(var_gts)
-                idxs.append(ident)
+        if cache:
+            if mmap is not None:
+                raise ValueError("Cannot produce a cached genotype matrix in a user-specified file.")
+            #fi
+            return self._cached_genotype_matrix(sparse, chunk_size, n_workers, regions)
+        #fi
+        
+        if (n_workers is not None) or (regions is not None):
+            if mmap is not None:
+                raise ValueError("Cannot produce a memory-mapped genotype matrix in parallel.")
+            #fi
+            G = self.map_regions(lambda o: o.genotype_matrix(sparse=sparse, chunk_size=chunk_size),
+                                 regions=regions, n_workers=n_workers)
+            return pd.concat(G, axis=1)
+        #fi
+        
+        samples   = self.samples
+        n_samples = len(samples)
+        
+        idxs   = []
+        blocks = []
+        block  = np.zeros((chunk_size, n_samples), dtype=np.int8)
+        n_rows = 0
+        n_total = 0
+        
+        out = open(mmap, 'wb') if mmap is not None else None
+        
+        def flush(n_rows):
+            if n_rows == 0:
+                return
+            elif sparse:
+                blocks.append(ssparse.csr_matrix(block[:n_rows]))
+            elif out is not None:
+                block[:n_rows].tofile(out)
+            else:
+                blocks.append(block[:n_rows].copy())
+            #fi
+        #edef
+        
+        try:
+            for var in self._vcf.iter_variants():
+                alleles = _genotype_alleles(var)
+                for i, alt in enumerate(var.ALT):
+                    if n_rows == chunk_size:
+                        flush(n_rows)
+                        n_rows = 0
+                    #fi
+                    block[n_rows] = (alleles == (i+1)).sum(axis=1)
+                    idxs.append(self.make_identifier(var, i))
+                    n_rows  += 1
+                    n_total += 1
+                #efor
             #efor
+            flush(n_rows)
+        finally:
+            if out is not None:
+                out.close()
+            #fi
+        #etry
+        
+        if n_total == 0:
+            return pd.DataFrame(np.zeros((n_samples, 0), dtype=np.int8), index=samples, columns=idxs)
+        elif sparse:
+            M = ssparse.vstack(blocks, format='csr')
+            return pd.DataFrame.sparse.from_spmatrix(M.T, index=samples, columns=idxs)
+        elif mmap is not None:
+            M = np.memmap(mmap, dtype=np.int8, mode='r', shape=(n_total, n_samples))
+            return pd.DataFrame(M.T, index=samples, columns=idxs, copy=False)
+        #fi
+        
+        return pd.DataFrame(np.concatenate(blocks).T, index=samples, columns=idxs)
+    #edef
+    
+    def cache_key(self, *parts):
+        """
+        Make a key that identifies the data in this object, for use in a DiskCache.
+        The key is based on the location, size and modification time of the file, the selected samples and the filter_stack.
+        
+        parameters:
+        -----------
+        *parts: Additional values that should be part of the key (e.g. parameters of the cached computation)
+        
+        Returns: String key, or None if the object cannot be identified
+            (if it is not backed by a file, or if it has been filtered with a function)
+        """
+        if not isinstance(self._vcf, VCF2_cyvcf2):
+            return None
+        #fi
+        
+        for filt in self._filter_stack:
+            if any([ callable(p) for p in filt.params ]):
+                return None
+            #fi
         #efor
-
-        return pd.DataFrame(gts, index=idxs, columns=self.samples).transpose()
+        
+        return DiskCache.key(DiskCache.file_key(self._vcf._file), list(self.samples),
+                             [ str(f) for f in self._filter_stack ], *parts)
+    #edef
+    
+    def _cached_genotype_matrix(self, sparse, chunk_size, n_workers, regions):
+        """
+        Retrieve a genotype matrix from the cache, computing and storing it if it is not there yet.
+        
+        The matrix is stored with variants as rows: as raw int8 data (genotypes.bin) when dense,
+          or as the arrays of a CSR matrix when sparse. Both are memory-mapped when loaded.
+        """
+        key = self.cache_key('genotype_matrix', sparse, regions)
+        if key is None:
+            utils.dbm("This VCF2 object cannot be cached. Computing the genotype matrix directly.")
+            return self.genotype_matrix(sparse=sparse, chunk_size=chunk_size, n_workers=n_workers, regions=regions)
+        #fi
+        
+        cache = DiskCache("vcf2_genotype_matrix")
+        entry = cache.lookup(key)
+        
+        if entry is None:
+            tmp = cache.new_entry()
+            try:
+                if sparse or (n_workers is not None) or (regions is not None):
+                    G = self.genotype_matrix(sparse=sparse, chunk_size=chunk_size, n_workers=n_workers, regions=regions)
+                else:
+                    G = self.genotype_matrix(mmap=os.path.join(tmp, 'genotypes.bin'), chunk_size=chunk_size)
+                #fi
+                
+                if sparse:
+                    M = ssparse.csr_matrix(G.sparse.to_coo().T)
+                    np.save(os.path.join(tmp, 'data.npy'), M.data)
+                    np.save(os.path.join(tmp, 'indices.npy'), M.indices)
+                    np.save(os.path.join(tmp, 'indptr.npy'), M.indptr)
+                elif not os.path.exists(os.path.join(tmp, 'genotypes.bin')):
+                    np.ascontiguousarray(G.values.T, dtype=np.int8).tofile(os.path.join(tmp, 'genotypes.bin'))
+                #fi
+                np.save(os.path.join(tmp, 'samples.npy'), np.array(G.index, dtype=str))
+                np.save(os.path.join(tmp, 'identifiers.npy'), np.array(G.columns, dtype=str))
+                shape = [ len(G.columns), len(G.index) ]
+                del G
+            except:
+                cache.discard(tmp)
+                raise
+            #etry
+            
+            entry = cache.commit(key, tmp, meta={ "file" : self._vcf._file,
+                                                  "filter_stack" : [ str(f) for f in self._filter_stack ],
+                                                  "sparse" : sparse,
+                                                  "shape" : shape })
+        #fi
+        
+        meta    = cache.meta(key)
+        shape   = tuple(meta["shape"])
+        samples = np.load(os.path.join(entry, 'samples.npy'))
+        idxs    = np.load(os.path.join(entry, 'identifiers.npy'))
+        
+        if sparse:
+            M = ssparse.csr_matrix((np.load(os.path.join(entry, 'data.npy'), mmap_mode='r'),
+                                    np.load(os.path.join(entry, 'indices.npy'), mmap_mode='r'),
+                                    np.load(os.path.join(entry, 'indptr.npy'), mmap_mode='r')), shape=shape)
+            return pd.DataFrame.sparse.from_spmatrix(M.T, index=samples, columns=idxs)
+        elif shape[0] == 0:
+            return pd.DataFrame(np.zeros((shape[1], 0), dtype=np.int8), index=samples, columns=idxs)
+        #fi
+        
+        M = np.memmap(os.path.join(entry, 'genotypes.bin'), dtype=np.int8, mode='r', shape=shape)
+        return pd.DataFrame(M.T, index=samples, columns=idxs, copy=False)
     #edef
     
     @utils.decorators.class_or_instance_method
-    def summary(obj, variants=None):
+    def summary(obj, variants=None, groups=None, chunk_size=10000, n_workers=None, regions=None):
         """
         Create a summary matrix for each variant in the object
         
         ASSUMES a MONO/DIPLOID ORGANISM!
+        
+        When called on an instance, the genotypes of all variants are categorized in blocks of chunk_size
+          (variant, alt allele) rows, and counted with matrix products, for all samples and for each sample group.
+        When called with a list of variants, each variant is summarized by its own summary method.
+        
+        parameters:
+        -----------
+        variants: list of variants. Required when used as a classmethod.
+        groups: dict of name -> list of sample names (or boolean mask over samples).
+                Additionally summarize each group, in columns prefixed with '<name>_'
+        chunk_size: Integer. The number of (variant, alt allele) rows to count at a time
+        n_workers: Integer. Summarize per contig (or per region) in this many processes. See map_regions.
+        regions: list of 3-tuples (chrom, start, end). Summarize per region, in a process pool. See map_regions.
+        
+        Returns:
+        --------
+        DataFrame with a row per (variant, alt allele), and the columns:
+            RR, RA, AA: Number of diploid samples with 0, 1 and 2 copies of the alt allele
+            R, A: Number of monoploid samples with the reference/alt allele
+            O: Number of samples with a missing (or polyploid) genotype
+            AC, AN: Alt allele count, and the total number of called alleles
+            AF: Alt allele frequency (AC/AN)
+            call_rate: Fraction of samples that have a called genotype
         """
         
-        if variants is None:
-            if obj.is_instance:
-                obj.self.to_records()
-                variants = obj.self.records
-            else:
-                raise ValueError("To use this function as a classmethod, you must specify a list of variants you wish to summarize.")
-            #fi
+        if variants is not None:
+            S = [ v.summary() for v in variants ]
+            return pd.concat(S)
+        elif not obj.is_instance:
+            raise ValueError("To use this function as a classmethod, you must specify a list of variants you wish to summarize.")
         #fi
         
-        S = [ v.summary() for v in variants ]
-        return pd.concat(S)
+        self = obj.self
+        
+        if (n_workers is not None) or (regions is not None):
+            S = self.map_regions(lambda o: o.summary(groups=groups, chunk_size=chunk_size),
+                                 regions=regions, n_workers=n_workers)
+            return pd.concat(S)
+        #fi
+        
+        samples = np.array(self.samples)
+        names   = [ '' ]
+        masks   = [ np.ones(len(samples), dtype=bool) ]
+        for name, group in ({} if groups is None else groups).items():
+            group = np.asarray(group)
+            names.append('%s_' % name)
+            masks.append(group if group.dtype == bool else np.isin(samples, group))
+        #efor
+        G = np.array(masks, dtype=np.int32).T
+        
+        idxs   = []
+        blocks = []
+        block  = np.zeros((chunk_size, len(samples)), dtype=np.int8)
+        n_rows = 0
+        
+        def flush(n_rows):
+            if n_rows > 0:
+                # (rows x groups x categories) counts
+                blocks.append(np.stack([ (block[:n_rows] == k).astype(np.int32).dot(G)
+                                         for k in range(len(_SUMMARY_CODES)) ], axis=2))
+            #fi
+        #edef
+        
+        for var in self._vcf.iter_variants():
+            codes = _genotype_codes(_genotype_alleles(var), len(var.ALT))
+            for i in range(len(var.ALT)):
+                if n_rows == chunk_size:
+                    flush(n_rows)
+                    n_rows = 0
+                #fi
+                block[n_rows] = codes[i]
+                idxs.append(self.make_identifier(var, i))
+                n_rows += 1
+            #efor
+        #efor
+        flush(n_rows)
+        
+        counts = np.concatenate(blocks) if len(blocks) > 0 else np.zeros((0, len(names), len(_SUMMARY_CODES)), dtype=np.int32)
+        
+        S = {}
+        for j, name in enumerate(names):
+            RR, RA, AA, R, A, O = [ counts[:,j,k] for k in range(len(_SUMMARY_CODES)) ]
+            AC = RA + 2*AA + A
+            AN = 2*(RR + RA + AA) + R + A
+            with np.errstate(divide='ignore', invalid='ignore'):
+                AF        = AC / AN
+                call_rate = (RR + RA + AA + R + A) / G[:,j].sum()
+            #ewith
+            for col, values in zip(_SUMMARY_CODES + [ 'AC', 'AN', 'AF', 'call_rate' ],
+                                   [ RR, RA, AA, R, A, O, AC, AN, AF, call_rate ]):
+                S[name + col] = values
+            #efor
+        #efor
+        
+        return pd.DataFrame(S, index=idxs)
     #edef
     
 
+    def map_regions(self, func, regions=None, n_workers=None):
+        """
+        Apply a function to this object, restricted to each of a list of regions, in a pool of processes.
+        Each worker queries the file through its own cyvcf2 handle.
+        
+        parameters:
+        -----------
+        func: Function. Takes a VCF2 object, and returns a (picklable) result
+        regions: list of 3-tuples (chrom, start, end). Default: one region per contig in the file
+        n_workers: Integer. The number of processes to use (default: number of CPUs)
+        
+        Returns:
+        --------
+        A list of the results of func, in the order of the regions.
+        """
+        if regions is None:
+            regions = self._vcf.shards()
+        #fi
+        
+        def apply(region):
+            return func(self if region is None else self.filter(*region))
+        #edef
+        
+        return utils.py.parallel_map(apply, regions, n_workers=n_workers)
+    #edef
+
     @classmethod
     def make_identifier(cls, variant, alt_pos=0):
         """
@@ -953,7 +1386,7 @@ class VCF2(object):
         """
         Return the number of records in this VCF object.
         """
-        return len(self.records)
+        return len(self._vcf)
     #edef
     
     
@@ -984,10 +1417,17 @@ class VCF2(object):
 
     
     @classmethod
-    def merge(cls, to_merge):
+    def merge(cls, to_merge, n_workers=None):
         """
         Merge a set of VCF objects
         In general this is faster than adding multiple times
+        
+        parameters:
+        -----------
+        to_merge: list of VCF2 objects
+        n_workers: Integer. If specified, the (lazily filtered) objects are evaluated in this many processes.
+                   The records are transferred in text form, and are therefore loaded in the flexible
+                   (MyOwnVariant) representation.
         """
         samples    = to_merge[0].samples
         inst_class = to_merge[0].__class__
@@ -1003,9 +1443,17 @@ class VCF2(object):
         #efor
 
         records = []
-        for o in to_merge:
-            records.extend(o.records)
-        #efor
+        if n_workers is None:
+            for o in to_merge:
+                records.extend(o.records)
+            #efor
+        else:
+            # The objects themselves cannot be pickled, so the workers receive their index
+            lines = utils.py.parallel_map(lambda i: [ str(v) for v in to_merge[i] ], range(len(to_merge)), n_workers=n_workers)
+            for o, o_lines in zip(to_merge, lines):
+                records.extend([ o._internal_variant_representation(l) for l in o_lines ])
+            #efor
+        #fi
         
         records_obj = VCF2_records(records, samples)
         filt = VCF_filter("MERGE", ["%d objects" % len(to_merge)])
@@ -1033,7 +1481,39 @@ class VCF2_master_type(object):
     #edef
     
     def __iter__(self):
-        return self.records.__iter__()
+        return ( self._wrap(v) for v in self.iter_variants() )
+    #edef
+    
+    def iter_variants(self, regions=None):
+        """
+        Iterate over the variants, without requiring them to be wrapped as records.
+        
+        parameters:
+        regions: list of 3-tuples (chrom, start, end). Only iterate over variants in these regions, in this order.
+        """
+        if regions is None:
+            return self.records.__iter__()
+        #fi
+        return ( v for (c, s, e) in regions for test in [ _test_region(c, s, e) ] for v in self.records if test(v) )
+    #edef
+    
+    def shards(self):
+        """
+        Split the object into regions that can be processed independently (one per contig).
+        
+        Returns: list of 3-tuples (chrom, start, end)
+        """
+        return [ (c, 1, _MAX_POS) for c in dict.fromkeys([ str(v.CHROM) for v in self.records ]) ]
+    #edef
+    
+    def _wrap(self, var):
+        """
+        Wrap a raw cyvcf2 variant in the internal variant representation
+        """
+        if isinstance(var, cyvcf2.cyvcf2.Variant):
+            return self._internal_variant_representation(var)
+        #fi
+        return var
     #edef
     
     def __len__(self):
@@ -1051,6 +1531,81 @@ class VCF2_master_type(object):
     #edef
 #eclass
 
+##############################################################################
+# Variant tests shared by the eager (VCF2_records) and lazy (VCF2_cyvcf2) representations.
+# Each returns a function which takes a variant, and returns True if it should be kept.
+
+# Largest position that can be represented in a tabix index
+_MAX_POS = 2**29 - 1
+
+def _region_string(chrom, start, end):
+    return '%s:%s-%s' % (str(chrom), str(int(start)), str(int(end)))
+#edef
+
+def _test_vartype(vartypes):
+    return lambda v: v.var_type in vartypes
+#edef
+
+def _test_filter(filters):
+    def test(var):
+        var_filters = var.FILTER
+        if var_filters is None:
+            return True
+        elif isinstance(var_filters, str):
+            # cyvcf2 gives the failed filters as one ';'-separated string
+            var_filters = var_filters.split(';')
+        #fi
+        
+        return not any([f in filters for f in var_filters])
+    #edef
+    return test
+#edef
+
+def _test_region(chrom, start, end):
+    return lambda v: (str(v.CHROM) == str(chrom)) and (v.POS >= start) and (v.POS <= end)
+#edef
+
+def _test_n_alleles(n_alleles):
+    return lambda v: len(v.ALT) <= n_alleles
+#edef
+
+def _apply_samples_format(r, field, test):
+    """
+    Set the genotypes of samples which fail a test on a format field to missing.
+    
+    parameters:
+    r: BiuVariant object
+    field: string
+    test: function
+    
+    Returns: A new BiuVariant, or None if no sample has a non-reference allele anymore
+    """
+    # It is IMPERATIVE THAT THE VARIANT IS IN "MyOwnVariant" format here!!!
+    new = r.switch().copy()
+    
+    GT = r.format('GT')
+    PL = r.ploidy
+    F  = r.format(field)
+    
+    new_gt = []
+    for gt, pl, f in zip(GT, PL, F):
+        if test(f):
+            new_gt.append(gt)
+        else:
+            new_gt.append('/'.join(['.']*pl))
+        #fi
+    #efor
+    
+    new.set_format('GT', new_gt)
+    
+    for gt in new.genotypes:
+        if any([x > 0 for x in gt[:-1]]):
+            return new
+        #fi
+    #efor
+    return None
+#edef
+
 ##############################################################################
 
 class VCF2_records(VCF2_master_type):
@@ -1062,22 +1617,17 @@ class VCF2_records(VCF2_master_type):
         
     #edef
     
-    def filter_vartype(self, vartypes):
-        return VCF2_records([ v for v in self.records if v.var_type in vartypes ], self.samples,
+    def _select(self, test):
+        return VCF2_records([ v for v in self.records if test(v) ], self.samples,
                             internal_variant_representation=self._internal_variant_representation)
     #edef
+    
+    def filter_vartype(self, vartypes):
+        return self._select(_test_vartype(vartypes))
+    #edef
 
     def filter_filter(self, filters):
-        def test(var):
-            if var.FILTER is None:
-                return True
-            #fi
-            
-            return not any([f in filters for f in var.FILTER])
-        #edef
-        
-        return VCF2_records([ v for v in self.records if test(v) ], self.samples,
-                            internal_variant_representation=self._internal_variant_representation)
+        return self._select(_test_filter(filters))
     #edef
 
     def filter_samples(self, samples):
@@ -1086,15 +1636,11 @@ class VCF2_records(VCF2_master_type):
 
     def filter_region(self, chrom, start, end):
         # Quick and dirty first
-        test = lambda v: (str(v.CHROM) == str(chrom)) and (v.POS >= start) and (v.POS <= end)
-        return VCF2_records([ v for v in self.records if test(v) ], self.samples,
-                            internal_variant_representation=self._internal_variant_representation)
+        return self._select(_test_region(chrom, start, end))
     #edef
 
     def filter_n_alleles(self, n_alleles):
-        test = lambda v: len(v.ALT) <= n_alleles
-        return VCF2_records([ v for v in self.records if test(v) ], self.samples,
-                            internal_variant_representation=self._internal_variant_representation)
+        return self._select(_test_n_alleles(n_alleles))
     #edef
     
     def filter_samples_format(self, field, test):
@@ -1113,36 +1659,9 @@ class VCF2_records(VCF2_master_type):
         
         """
         
-        new_records = []
+        new_records = [ _apply_samples_format(r, field, test) for r in self.records ]
         
-        for r in self.records:
-            # It is IMPERATIVE THAT THE VARIANT IS IN "MyOwnVariant" format here!!!
-            new = r.switch().copy()
-            
-            GT = r.format('GT')
-            PL = r.ploidy
-            F  = r.format(field)
-            
-            new_gt = []
-            for gt, pl, f in zip(GT, PL, F):
-                if test(f):
-                    new_gt.append(gt)
-                else:
-                    new_gt.append('/'.join(['.']*pl))
-                #fi
-            #efor
-            
-            new.set_format('GT', new_gt)
-            
-            for gt in new.genotypes:
-                if any([x > 0 for x in gt[:-1]]):
-                    new_records.append(new)
-                    break
-                #fi
-            #efor
-        #efor
-        
-        return VCF2_records(new_records, self.samples,
+        return VCF2_records([ r for r in new_records if r is not None ], self.samples,
                             internal_variant_representation=self._internal_variant_representation)
     #edef
 
@@ -1151,17 +1670,28 @@ class VCF2_records(VCF2_master_type):
 ##############################################################################
 
 class VCF2_cyvcf2(VCF2_master_type):
-    def __init__(self, file, *pargs, **kwargs):
+    """
+    A lazy view on a cyvcf2 file.
+    
+    Filters are not evaluated when they are applied. Instead, they are compiled into a pipeline
+      which is evaluated in a single pass over the file whenever the variants are iterated.
+     * The first region filter is pushed down to a tabix query
+     * All other filters (and subsequent regions) are fused into one chain of per-variant stages
+    Records are only materialized (and cached) when the records property is accessed.
+    """
+    def __init__(self, file, *pargs, region=None, stages=None, **kwargs):
         super(VCF2_cyvcf2, self).__init__(*pargs, **kwargs)
         
-        self._vcf = cyvcf2.VCF(file, lazy=True, gts012=True, samples=self._samples)
-        self._file = file
+        self._vcf    = cyvcf2.VCF(file, lazy=True, gts012=True, samples=self._samples)
+        self._file   = file
+        self._region = region
+        self._stages = [] if stages is None else stages
     #edef
     
     @property
     def records(self):
         if self._records is None:
-            self._records = [ self._internal_variant_representation(v) for v in self._vcf ]
+            self._records = list(self.__iter__())
         #fi
         
         return self._records
@@ -1172,30 +1702,123 @@ class VCF2_cyvcf2(VCF2_master_type):
         return self._vcf.samples
     #edef
     
+    def iter_variants(self, regions=None):
+        """
+        Stream the raw cyvcf2 variants from a fresh file handle, unless records have already been loaded.
+        The region is queried through tabix, and the remaining filter stages are applied in one pass.
+        
+        parameters:
+        regions: list of 3-tuples (chrom, start, end). Query these regions (in this order) through one file handle
+                 instead. A region set by filter_region is then applied as a filter stage.
+        """
+        if self._records is not None:
+            return super(VCF2_cyvcf2, self).iter_variants(regions)
+        #fi
+        
+        vcf    = cyvcf2.VCF(self._file, lazy=True, gts012=True, samples=self._samples)
+        stages = self._stages
+        
+        if regions is not None:
+            source = ( v for (c, s, e) in regions for v in vcf(_region_string(c, s, e)) )
+            if self._region is not None:
+                region_test = _test_region(*self._region)
+                stages = [ lambda v: v if region_test(v) else None ] + stages
+            #fi
+        elif self._region is not None:
+            source = vcf(_region_string(*self._region))
+        else:
+            source = vcf
+        #fi
+        
+        if len(stages) == 0:
+            return source.__iter__()
+        #fi
+        
+        def pipeline(source, stages):
+            for var in source:
+                for stage in stages:
+                    var = stage(var)
+                    if var is None:
+                        break
+                    #fi
+                else:
+                    yield var
+                #efor
+            #efor
+        #edef
+        
+        return pipeline(source, stages)
+    #edef
+    
+    def shards(self):
+        """
+        Split the object into regions that can be processed independently.
+        This is one region per contig, or the region that was filtered on.
+        If the contigs are unknown (e.g. an unindexed file), there is one shard: None (the whole file).
+        
+        Returns: list of 3-tuples (chrom, start, end)
+        """
+        if self._records is not None:
+            return super(VCF2_cyvcf2, self).shards()
+        elif self._region is not None:
+            return [ self._region ]
+        #fi
+        
+        try:
+            seqnames = self._vcf.seqnames
+        except Exception:
+            seqnames = []
+        #etry
+        
+        if len(seqnames) == 0:
+            return [ None ]
+        #fi
+        return [ (c, 1, _MAX_POS) for c in seqnames ]
+    #edef
+    
+    def __len__(self):
+        if self._records is not None:
+            return len(self._records)
+        #fi
+        return sum(1 for v in self.iter_variants())
+    #edef
+    
+    def _add_stage(self, stage, region=None):
+        return VCF2_cyvcf2(self._file, samples=self._samples,
+                           region=self._region if region is None else region,
+                           stages=self._stages + ([] if stage is None else [stage]),
+                           internal_variant_representation=self._internal_variant_representation)
+    #edef
+    
+    def _add_test(self, test):
+        return self._add_stage(lambda v: v if test(v) else None)
+    #edef
+    
     def filter_vartype(self, vartypes):
-        return VCF2_records([ r for r in self.records], self.samples,
-                            internal_variant_representation=self._internal_variant_representation).filter_vartype(vartypes)
+        return self._add_test(_test_vartype(vartypes))
     #edef
 
     def filter_filter(self, filters):
-        return VCF2_records([ r for r in self.records], self.samples,
-                            internal_variant_representation=self._internal_variant_representation).filter_filter(filters)
+        return self._add_test(_test_filter(filters))
     #edef
 
     def filter_samples(self, samples):
-        return VCF2_cyvcf2(self._file, samples,
+        if (self._region is not None) or (len(self._stages) > 0):
+            raise Exception("Cannot filter samples after other filters have been applied. Please filter by samples first! See documentation.")
+        #fi
+        return VCF2_cyvcf2(self._file, samples=samples,
                            internal_variant_representation=self._internal_variant_representation)
     #edef
 
     def filter_region(self, chrom, start, end):
-        region = '%s:%s-%s' % (str(chrom), str(int(start)), str(int(end)))
-        return VCF2_records([ r for r in self._vcf(region) ], self.samples,
-                            internal_variant_representation=self._internal_variant_representation)
+        if self._region is None:
+            return self._add_stage(None, region=(chrom, int(start), int(end)))
+        #fi
+        return self._add_test(_test_region(chrom, start, end))
     #edef
 
     def filter_n_alleles(self, n_alleles):
-        return VCF2_records([ r for r in self.records], self.samples,
-                            internal_variant_representation=self._internal_variant_representation).filter_n_alleles(n_alleles)
+        return self._add_test(_test_n_alleles(n_alleles))
     #edef
     
     def filter_samples_format(self, field, test):
@@ -1204,14 +1827,13 @@ class VCF2_cyvcf2(VCF2_master_type):
         All samples that do not pass this filter are set to the missing genotype
         
         parameters:
-        self: VCF2_records object
+        self: VCF2_cyvcf2 object
         field: string
         test: function
         
         """
-        return VCF2_records([ r for r in self.records], self.samples,
-                            internal_variant_representation=self._internal_variant_representation).filter_samples_format(field, test)
+        return self._add_stage(lambda v: _apply_samples_format(self._wrap(v), field, test))
     #edef
 #eclass
 
-###################################################################
\ No newline at end of file
+###################################################################
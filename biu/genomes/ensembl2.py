@@ -17,14 +17,15 @@ class Ensembl2(Dataset2):
         
         if files['gff'] is not None:
             self._obj.add_file('gff3.gff', Acquire2().curl(files['gff']).gunzip())
-            self._obj.register('gff', ['gff3.gff'], lambda f: formats.GFF3(f['gff3.gff']))
+            self._obj.register('gff', ['gff3.gff'], lambda f: formats.GFF3(f['gff3.gff'], columnar=True))
         #fi
         
         if files['dna'] is not None:
             indivs = [ Acquire2().curl(f) for f in files['dna'] ]
             self._obj.add_file('genome.fa', Acquire2().merge(indivs, method='zcat'))
             self._obj.register('genome', ['genome.fa'], lambda f: formats.Fasta(f['genome.fa'], 
-                                                                                seqType=formats.Sequence.DNATYPE))
+                                                                                seqType=formats.Sequence.DNATYPE,
+                                                                                indexed=True))
         #fi
         
         if files['cds'] is not None:
@@ -2,6 +2,8 @@ from .. import utils
 
 np = utils.py.loadExternalModule("numpy")
 
+import functools
+
 #################################################################
 
 def order(arr, decreasing=False):
@@ -20,15 +22,10 @@ def pmin(*arrs):
     if len(set(lens)) != 1:
         raise Exception
     #fi
-    arr_len = lens[0]
-    
-    arrs = [ arr if hasattr(arr, '__len__') else arr*np.ones(arr_len) for arr in arrs]
-    
-    par_min = np.array([ min(v) for v in zip(*arrs) ])
-    return par_min
+    return functools.reduce(np.minimum, [ np.asarray(arr) for arr in arrs ])
 #edef
 
-def pmax(maxvalue, arr):
+def pmax(*arrs):
     """
     parallel maximum
     """
@@ -36,13 +33,7 @@ def pmax(maxvalue, arr):
     if len(set(lens)) != 1:
         raise Exception
     #fi
-    arr_len = lens[0]
-    
-    arrs = [ arr if hasattr(arr, '__len__') else arr*np.ones(arr_len) for arr in arrs]
-    
-    par_min = np.array([ max(v) for v in zip(*arrs) ])
-    return par_min
-#edef
+    return functools.reduce(np.maximum, [ np.asarray(arr) for arr in arrs ])
 #edef
 
 
@@ -50,22 +41,12 @@ def cummin(arr):
     """
     Return the cululative minimum of an array. (i.e. the next value is always the minimum of the current value and the previous value)
     """
-    #ret = reduce(lambda head, nextval: head + [ min(nextval, head[-1])], arr, [max(arr)])[1:]
-    ret = arr.copy()
-    for i in range(1, len(ret)):
-        ret[i] = min(ret[i], ret[i-1])
-    #efor
-    return np.array(ret)
+    return np.minimum.accumulate(np.asarray(arr))
 #edef
 
 def cummax(arr):
     """
     Return the cululative maximum of an array. (i.e. the next value is always the maximum of the current value and the previous value)
     """
-    #ret = reduce(lambda head, nextval: head + [ max(nextval, head[-1])], arr, [min(arr)])[1:]
-    ret = arr.copy()
-    for i in range(1, len(ret)):
-        ret[i] = max(ret[i], ret[i-1])
-    #efor
-    return np.array(ret)
-#edef
\ No newline at end of file
+    return np.maximum.accumulate(np.asarray(arr))
+#edef
@@ -301,7 +301,7 @@ def flat(df, fields=None, sep=None, ignore_unequal_rows=False):
 
 #########################################################################
 
-def corrcoef(dataframe, axis=0, method='pearson'):
+def corrcoef(dataframe, axis=0, method='pearson', **kwargs):
     """
     Calculate pearsons correlation coefficient for the columns in a dataframe.
     Returns a matrix of correlation coefficients, and estimated p-values per correlation
@@ -313,6 +313,7 @@ def corrcoef(dataframe, axis=0, method='pearson'):
           0 : rows
           1 : columns
     method=['pearson', 'spearman' ] or callable which must return (r-correlation, and p-value) tuple
+    **kwargs: Additional arguments to biu.ops.matrix.corrcoef (block_size, n_workers)
     
     returns:
     --------
@@ -322,7 +323,7 @@ def corrcoef(dataframe, axis=0, method='pearson'):
     Found at: https://stackoverflow.com/a/24547964
     """
     
-    r, p = matrix.corrcoef(dataframe.values, axis, method=method)
+    r, p = matrix.corrcoef(dataframe.values, axis, method=method, **kwargs)
     idx = dataframe.index if axis==0 else dataframe.columns
     r = pd.DataFrame(r, columns=idx, index=idx)
     p = pd.DataFrame(p, columns=idx, index=idx)
@@ -332,7 +333,7 @@ def corrcoef(dataframe, axis=0, method='pearson'):
 
 ####################################################################
 
-def corrcoef_between(dataframe1, dataframe2, axis=0, method='pearson'):
+def corrcoef_between(dataframe1, dataframe2, axis=0, method='pearson', threshold=None, **kwargs):
     """
     Calculate the correlation coefficient between columns/rows in two different matrices.
     The opposite axis must have the same dimension in the two matrices.
@@ -345,19 +346,31 @@ def corrcoef_between(dataframe1, dataframe2, axis=0, method='pearson'):
           0 : rows
           1 : columns
     method=['pearson', 'spearman' ] or callable which must return (r-correlation, and p-value) tuple
+    threshold: Only return the pairs with abs(r) >= threshold
+    **kwargs: Additional arguments to biu.ops.matrix.corrcoef_between (block_size, n_workers, out)
     
     returns:
     --------
     r: Correlation coefficients
     p: p-values
+    or, if threshold is given:
+    A pandas DataFrame with columns i, j (the labels in dataframe1 and dataframe2), r and p
     
     Modified from: https://stackoverflow.com/a/24547964
     """
     
-    r, p = matrix.corrcoef_between(dataframe1.values, dataframe2.values, axis=axis, method=method)
     idx = dataframe1.index if (axis == 0) else dataframe1.columns
     col = dataframe2.index if (axis == 0) else dataframe2.columns
 
+    if threshold is not None:
+        pairs = matrix.corrcoef_between(dataframe1.values, dataframe2.values, axis=axis, method=method, threshold=threshold, **kwargs)
+        pairs['i'] = idx[pairs.i.values]
+        pairs['j'] = col[pairs.j.values]
+        return pairs
+    #fi
+
+    r, p = matrix.corrcoef_between(dataframe1.values, dataframe2.values, axis=axis, method=method, **kwargs)
+
     r = pd.DataFrame(r, columns=col, index=idx)
     p = pd.DataFrame(p, columns=col, index=idx)
     
@@ -55,8 +55,7 @@ def group(lst, key=lambda x: x[0], value=lambda x: x):
   """
   F = {}
   for item in lst:
-    k = key(item)
-    F[k] = F.get(k, []) + [value(item)]
+    F.setdefault(key(item), []).append(value(item))
   #efor
   return F
 #edef
@@ -128,7 +128,307 @@ def multimax(A, B, *pargs):
 
 ####################################################################
 
-def corrcoef(matrix, axis=0, method='pearson'):
+def _corrcoef_prepare(matrix, masked):
+    """
+    Prepare the rows of a matrix (the variables) for the blocked correlation engine.
+    Without missing values, the rows are centered and scaled to unit norm, so that a matrix product of two blocks gives r.
+    With missing values, the rows are centered on the mean of their observed values, and missing values are set to zero.
+      The mask of observed values, and the squared values are kept, so that the pairwise sums can be computed with matrix products.
+    """
+    if not masked:
+        centered = matrix - matrix.mean(axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (centered / np.sqrt((centered * centered).sum(axis=1, keepdims=True)),)
+        #ewith
+    #fi
+    mask = ~np.isnan(matrix)
+    nobs = mask.sum(axis=1, keepdims=True)
+    means = np.where(mask, matrix, 0).sum(axis=1, keepdims=True) / np.maximum(nobs, 1)
+    centered = np.where(mask, matrix - means, 0)
+    return (centered, mask.astype(np.float64), centered * centered)
+#edef
+
+def _corrcoef_pvalues(r, nobs):
+    """
+    Two-sided p-values of pearson correlation coefficients, from the incomplete beta function.
+    nobs is the number of observations, either one for all coefficients, or one per coefficient
+    """
+    from scipy.special import betainc
+
+    df = nobs - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ts = r * r * (df / (1 - r * r))
+        p = betainc(0.5 * df, 0.5, df / (df + ts))
+    #ewith
+    # Two observations always fit perfectly (as in scipy.stats.pearsonr)
+    return np.where((df == 0) & ~np.isnan(r), 1.0, p)
+#edef
+
+def _corrcoef_tile(prep1, prep2, rows, cols, nobs):
+    """
+    Correlation coefficients and p-values between a block of rows of prepared matrix 1 and a block of rows of prepared matrix 2
+    """
+    if len(prep1) == 1:
+        r = prep1[0][rows] @ prep2[0][cols].T
+    else:
+        x, mx, xx = [ a[rows] for a in prep1 ]
+        y, my, yy = [ a[cols] for a in prep2 ]
+        nobs = mx @ my.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sx = x @ my.T
+            sy = mx @ y.T
+            sxx = xx @ my.T
+            syy = mx @ yy.T
+            vx = sxx - sx * sx / nobs
+            vy = syy - sy * sy / nobs
+            r = (x @ y.T - sx * sy / nobs) / np.sqrt(vx * vy)
+        #ewith
+        # Rows that are constant in the shared observations have no correlation
+        r[(vx <= 1e-13 * sxx) | (vy <= 1e-13 * syy) | (nobs < 2)] = np.nan
+    #fi
+    np.clip(r, -1, 1, out=r)
+    return r, _corrcoef_pvalues(r, nobs)
+#edef
+
+def _corrcoef_output(out, shape):
+    """
+    The arrays to write the correlation coefficients and p-values to
+    out: None: New arrays in memory
+         String: Memory-mapped .npy files '<out>.r.npy' and '<out>.p.npy', which can be opened later with np.load(..., mmap_mode='r')
+         Tuple: (r, p) existing arrays (e.g. np.memmap) of the right shape
+    """
+    if out is None:
+        return np.empty(shape), np.empty(shape)
+    elif isinstance(out, str):
+        return (np.lib.format.open_memmap('%s.r.npy' % out, mode='w+', dtype=np.float64, shape=shape),
+                np.lib.format.open_memmap('%s.p.npy' % out, mode='w+', dtype=np.float64, shape=shape))
+    #fi
+    r, p = out
+    if (r.shape != shape) or (p.shape != shape):
+        raise ValueError("The output arrays must have shape %s" % str(shape))
+    #fi
+    return r, p
+#edef
+
+def _corrcoef_blocked(matrix1, matrix2, block_size=1024, n_workers=1, out=None, threshold=None, symmetric=False):
+    """
+    Pearson correlation between the rows of matrix1 and the rows of matrix2, computed in tiles of block_size x block_size with matrix products.
+    Missing values (NaN) are left out per pair of rows (pairwise complete observations).
+    The tiles are computed on a pool of n_workers threads.
+
+    If threshold is given, only the pairs with abs(r) >= threshold are returned, as a DataFrame with columns i, j, r, p.
+    Otherwise, the full r and p matrices are written to the output given by out (see _corrcoef_output)
+    If symmetric, matrix1 and matrix2 are the same, and only the upper triangle of tiles is computed.
+    """
+    matrix1 = np.asarray(matrix1, dtype=np.float64)
+    matrix2 = np.asarray(matrix2, dtype=np.float64)
+    if matrix1.shape[1] != matrix2.shape[1]:
+        raise ValueError("Cannot calculate correlation along this axis.")
+    #fi
+    if (threshold is not None) and (out is not None):
+        raise ValueError("Results can either be written to an output, or filtered on a threshold, not both.")
+    #fi
+
+    masked = np.isnan(matrix1).any() or np.isnan(matrix2).any()
+    prep1 = _corrcoef_prepare(matrix1, masked)
+    prep2 = prep1 if symmetric else _corrcoef_prepare(matrix2, masked)
+    nobs = matrix1.shape[1]
+    n1, n2 = matrix1.shape[0], matrix2.shape[0]
+
+    if threshold is None:
+        r, p = _corrcoef_output(out, (n1, n2))
+    #fi
+
+    def tile(ij):
+        i, j = ij
+        rows, cols = slice(i, i + block_size), slice(j, j + block_size)
+        rt, pt = _corrcoef_tile(prep1, prep2, rows, cols, nobs)
+        if threshold is not None:
+            I, J = np.nonzero(np.abs(rt) >= threshold)
+            if symmetric:
+                keep = (I + i) < (J + j)
+                I, J = I[keep], J[keep]
+            #fi
+            return I + i, J + j, rt[I, J], pt[I, J]
+        #fi
+        r[rows, cols] = rt
+        p[rows, cols] = pt
+        if symmetric and (i != j):
+            r[cols, rows] = rt.T
+            p[cols, rows] = pt.T
+        #fi
+        return None
+    #edef
+
+    tiles = [ (i, j) for i in range(0, n1, block_size) for j in range(i if symmetric else 0, n2, block_size) ]
+    res = utils.py.parallel_map(tile, tiles, n_workers=n_workers, processes=False)
+
+    if threshold is not None:
+        I, J, R, P = [ np.concatenate(a) for a in zip(*res) ] if len(res) > 0 else [ np.zeros(0, dtype=int) ] * 2 + [ np.zeros(0) ] * 2
+        o = np.lexsort((J, I))
+        return pd.DataFrame({ 'i' : I[o], 'j' : J[o], 'r' : R[o], 'p' : P[o] })
+    #fi
+
+    if isinstance(r, np.memmap):
+        r.flush()
+        p.flush()
+    #fi
+    return r, p
+#edef
+
+def _corrcoef_patterns(matrix):
+    """
+    Group the rows of a matrix by their missing values (NaN)
+    Returns the mask of observed values of each group, the rows in each group, and the group of each row
+    """
+    mask = ~np.isnan(matrix)
+    patterns, group = np.unique(np.packbits(mask, axis=1), axis=0, return_inverse=True)
+    group = group.ravel()
+    order = np.argsort(group, kind='stable')
+    rows  = np.split(order, np.cumsum(np.bincount(group, minlength=patterns.shape[0]))[:-1])
+    return [ mask[r[0]] for r in rows ], rows, group
+#edef
+
+def _corrcoef_spearman_pairs(matrix1, matrix2, I, J):
+    """
+    Spearman correlation of the pairs of rows (matrix1[I[k]], matrix2[J[k]]), each ranked on the observations that the two rows share
+    """
+    x = matrix1[I]
+    y = matrix2[J]
+    shared = ~(np.isnan(x) | np.isnan(y))
+    nobs   = shared.sum(axis=1)
+
+    # Values that are not shared are ranked after all others, so that they do not change the ranks of the shared values.
+    # The mean rank of n values is (n+1)/2, also with ties
+    mid = ((nobs + 1) / 2)[:, np.newaxis]
+    cx  = np.where(shared, sstats.rankdata(np.where(shared, x, np.inf), axis=1) - mid, 0)
+    cy  = np.where(shared, sstats.rankdata(np.where(shared, y, np.inf), axis=1) - mid, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (cx * cy).sum(axis=1) / np.sqrt((cx * cx).sum(axis=1) * (cy * cy).sum(axis=1))
+    #ewith
+    r[nobs < 2] = np.nan
+    np.clip(r, -1, 1, out=r)
+    return r, _corrcoef_pvalues(r, nobs)
+#edef
+
+def _corrcoef_spearman(matrix1, matrix2, block_size=1024, n_workers=1, out=None, threshold=None, symmetric=False, min_group=256):
+    """
+    Spearman correlation between the rows of matrix1 and the rows of matrix2: the pearson correlation of their ranks (see _corrcoef_blocked).
+    With missing values (NaN), each pair of rows is ranked on the observations that the two rows share.
+      Rows are grouped by their missing values. When a group of rows in matrix1 and a group in matrix2 make at least min_group pairs,
+        the two groups are ranked once on their shared observations, and correlated with matrix products.
+      All other pairs are ranked pair by pair, in vectorised chunks of about block_size**2 values.
+      The cost therefore grows with the number of pairs of rows whose missing values are rare (e.g. scattered NaNs),
+        up to O(n1 * n2 * m log m) for n1 x m and n2 x m matrices where every row has different missing values.
+      The chunks and combinations are computed on a pool of n_workers threads.
+    """
+    matrix1 = np.asarray(matrix1, dtype=np.float64)
+    matrix2 = np.asarray(matrix2, dtype=np.float64)
+    if matrix1.shape[1] != matrix2.shape[1]:
+        raise ValueError("Cannot calculate correlation along this axis.")
+    #fi
+
+    if not (np.isnan(matrix1).any() or np.isnan(matrix2).any()):
+        ranks1 = sstats.rankdata(matrix1, axis=1)
+        ranks2 = ranks1 if symmetric else sstats.rankdata(matrix2, axis=1)
+        return _corrcoef_blocked(ranks1, ranks2, block_size=block_size, n_workers=n_workers, out=out, threshold=threshold, symmetric=symmetric)
+    #fi
+
+    if (threshold is not None) and (out is not None):
+        raise ValueError("Results can either be written to an output, or filtered on a threshold, not both.")
+    #fi
+
+    if threshold is None:
+        r, p = _corrcoef_output(out, (matrix1.shape[0], matrix2.shape[0]))
+    #fi
+    obs1, rows1, group1 = _corrcoef_patterns(matrix1)
+    obs2, rows2, group2 = (obs1, rows1, group1) if symmetric else _corrcoef_patterns(matrix2)
+    size1 = np.array([ len(rows) for rows in rows1 ])
+    size2 = np.array([ len(rows) for rows in rows2 ])
+
+    def result(I, J, rs, ps):
+        if threshold is not None:
+            keep = (np.abs(rs) >= threshold) & ((I < J) if symmetric else True)
+            return pd.DataFrame({ 'i' : I[keep], 'j' : J[keep], 'r' : rs[keep], 'p' : ps[keep] })
+        #fi
+        r[I, J] = rs
+        p[I, J] = ps
+        return None
+    #edef
+
+    def combination(ab):
+        a, b = ab
+        shared = obs1[a] & obs2[b]
+        I = np.repeat(rows1[a], len(rows2[b]))
+        J = np.tile(rows2[b], len(rows1[a]))
+        if shared.sum() < 2:
+            # There is no correlation between rows with fewer than two shared observations
+            return result(I, J, np.full(len(I), np.nan), np.full(len(I), np.nan))
+        #fi
+        ranks1 = sstats.rankdata(matrix1[np.ix_(rows1[a], shared)], axis=1)
+        ranks2 = sstats.rankdata(matrix2[np.ix_(rows2[b], shared)], axis=1)
+        rs, ps = _corrcoef_blocked(ranks1, ranks2, block_size=block_size)
+        return result(I, J, rs.ravel(), ps.ravel())
+    #edef
+
+    def chunk(start):
+        # The pairs of rows in small combinations of groups
+        small = (size1[group1[start:start + chunk_rows]][:, np.newaxis] * size2[group2][np.newaxis, :]) < min_group
+        I, J  = np.nonzero(small)
+        I     = I + start
+        rs, ps = _corrcoef_spearman_pairs(matrix1, matrix2, I, J)
+        return result(I, J, rs, ps)
+    #edef
+
+    large = [ (a, b) for a in np.flatnonzero(size1 * size2.max() >= min_group) for b in np.flatnonzero(size1[a] * size2 >= min_group) ]
+    chunk_rows = max(1, (block_size * block_size) // (matrix2.shape[0] * max(matrix2.shape[1], 1)))
+    tasks = [ (combination, ab) for ab in large ] + [ (chunk, start) for start in range(0, matrix1.shape[0], chunk_rows) ]
+    res = utils.py.parallel_map(lambda task: task[0](task[1]), tasks, n_workers=n_workers, processes=False)
+
+    if threshold is not None:
+        res = [ pairs for pairs in res if pairs is not None ]
+        if len(res) == 0:
+            return pd.DataFrame({ 'i' : np.zeros(0, dtype=int), 'j' : np.zeros(0, dtype=int), 'r' : np.zeros(0), 'p' : np.zeros(0) })
+        #fi
+        return pd.concat(res).sort_values(['i', 'j']).reset_index(drop=True)
+    #fi
+
+    if isinstance(r, np.memmap):
+        r.flush()
+        p.flush()
+    #fi
+    return r, p
+#edef
+
+def _corrcoef_callable(matrix1, matrix2, method, n_workers=1, symmetric=False):
+    """
+    Apply a correlation function to each pair of rows of matrix1 and matrix2.
+    The rows of matrix1 are distributed over n_workers processes.
+    """
+    rows, cols = matrix1.shape[0], matrix2.shape[0]
+
+    def row(i):
+        res = [ method(matrix1[i], matrix2[j]) for j in range(i + 1 if symmetric else 0, cols) ]
+        return [ v[0] for v in res ], [ v[1] for v in res ]
+    #edef
+
+    r = np.ones(shape=(rows, cols))
+    p = np.ones(shape=(rows, cols))
+    for (i, (r_, p_)) in enumerate(utils.py.parallel_map(row, range(rows), n_workers=n_workers)):
+        start = i + 1 if symmetric else 0
+        r[i, start:] = r_
+        p[i, start:] = p_
+        if symmetric:
+            r[start:, i] = r_
+            p[start:, i] = p_
+        #fi
+    #efor
+    return r, p
+#edef
+
+####################################################################
+
+def corrcoef(matrix, axis=0, method='pearson', block_size=1024, n_workers=1):
     """
     Calculate pearsons correlation coefficient for a numpy matrix.
     Returns a matrix of correlation coefficients, and estimated p-values per correlation
@@ -140,7 +440,13 @@ def corrcoef(matrix, axis=0, method='pearson'):
           0 : rows
           1 : columns
     method=['pearson', 'spearman' ] or callable which must return (r-correlation, and p-value) tuple
+    block_size: The number of rows/columns per block in the pearson/spearman calculation
+    n_workers: The number of threads (pearson/spearman) or processes (callable) to use
 
+    Missing values (NaN) are left out per pair of rows/columns.
+    For spearman, each pair is ranked on the observations it shares.
+      The cost is quadratic in the number of distinct patterns of missing values: with scattered NaNs,
+      most pairs are ranked separately, which is much slower than without missing values.
     
     returns:
     --------
@@ -149,63 +455,33 @@ def corrcoef(matrix, axis=0, method='pearson'):
     
     Modified from: https://stackoverflow.com/a/24547964
     """
-    
-    def _corrcoef_pearson(matrix, axis):
-        from scipy.special import betainc
 
-        if axis == 1:
-            matrix = matrix.transpose()
-        #fi
+    matrix = np.asarray(matrix)
+    if axis == 1:
+        matrix = matrix.transpose()
+    #fi
+
+    if hasattr(method, '__call__'):
+        return _corrcoef_callable(matrix, matrix, method, n_workers=n_workers, symmetric=True)
+    #fi
 
-        r = np.corrcoef(matrix)
-        rf = r[np.triu_indices(r.shape[0], 1)]
-        df = matrix.shape[1] - 2
-        ts = rf * rf * (df / (1 - rf * rf))
-        pf = betainc(0.5 * df, 0.5, df / (df + ts))
-        p = np.zeros(shape=r.shape)
-        p[np.triu_indices(p.shape[0], 1)] = pf
-        p[np.tril_indices(p.shape[0], -1)] = pf
-        p[np.diag_indices(p.shape[0])] = np.ones(p.shape[0])
-
-        return r, p
-    #edef
-    
-    def _corrcoef_loop(matrix, axis, method):
-        
-        if axis == 1:
-            matrix = matrix.transpose()
-        #fi
-        
-        rows, cols = matrix.shape[0], matrix.shape[1]
-        r = np.ones(shape=(rows, rows))
-        p = np.ones(shape=(rows, rows))
-        for i in range(rows):
-            for j in range(i+1, rows):
-                r_, p_ = method(matrix[i], matrix[j])
-                r[i, j] = r[j, i] = r_
-                p[i, j] = p[j, i] = p_
-            #efor
-        #efor
-        return r, p
-    #edef
-    
     method = method.lower()
-    
+
     if method == 'pearson':
-        return _corrcoef_pearson(matrix, axis)
+        r, p = _corrcoef_blocked(matrix, matrix, block_size=block_size, n_workers=n_workers, symmetric=True)
     elif method == 'spearman':
-        res = sstats.spearmanr(matrix, axis=1-axis)
-        return res.correlation, res.pvalue
-    elif hasattr(method, '__call__'):
-        return _corrcoef_loop(matrix, axis, method)
+        r, p = _corrcoef_spearman(matrix, matrix, block_size=block_size, n_workers=n_workers, symmetric=True)
     else:
         raise ValueError("Don't know what to do with method '%s'" % method)
     #fi
+
+    p[np.diag_indices(p.shape[0])] = np.ones(p.shape[0])
+    return r, p
 #edef
 
 ####################################################################
 
-def corrcoef_between(matrix1, matrix2, axis=0, method='pearson'):
+def corrcoef_between(matrix1, matrix2, axis=0, method='pearson', block_size=1024, n_workers=1, out=None, threshold=None):
     """
     Calculate the correlation between columns/rows in two different matrices.
     The opposite axis must have the same dimension in the two matrices.
@@ -217,67 +493,53 @@ def corrcoef_between(matrix1, matrix2, axis=0, method='pearson'):
     axis: Which axis to perform the operation on.
           0 : rows
           1 : columns
-    method=['pearson', 'spearman' ] or callable which must return (r-correlation, and p-value) tuple
+    method=['pearson', 'spearman', 'spearman_slow' ] or callable which must return (r-correlation, and p-value) tuple
+    block_size: The number of rows/columns per block in the pearson/spearman calculation
+    n_workers: The number of threads (pearson/spearman) or processes (callable) to use
+    out: pearson/spearman only. Where to write r and p to:
+         None: new arrays
+         String: memory-mapped files '<out>.r.npy' and '<out>.p.npy' (for results that do not fit in memory)
+         Tuple: (r, p) existing arrays (e.g. np.memmap) of the right shape
+    threshold: pearson/spearman only. Only return the pairs with abs(r) >= threshold
+
+    Missing values (NaN) are left out per pair of rows/columns.
+    For spearman, each pair is ranked on the observations it shares.
+      The cost is quadratic in the number of distinct patterns of missing values: with scattered NaNs,
+      most pairs are ranked separately, which is much slower than without missing values.
     
     returns:
     --------
     r: Correlation coefficients
     p: p-values
+    or, if threshold is given:
+    A pandas DataFrame with columns i, j (the row/column in matrix1 and matrix2), r and p
     
     Modified from: https://stackoverflow.com/a/24547964
     """
-    
-    # NOTE: I might want to think about concatenating the matrices for the pearson/spearman methods
-    #       and then extracting the relevant columns/rows
-    
-    def _corrcoef_between_callable(matrix1, matrix2, axis, method):
-        rows = matrix1.shape[axis]
-        cols = matrix2.shape[axis]
 
-        if matrix1.shape[1-axis] != matrix2.shape[1-axis]:
-            raise ValueError("Cannot calculate correlation along this axis.")
-        #fi
+    matrix1 = np.asarray(matrix1)
+    matrix2 = np.asarray(matrix2)
+    if axis == 1:
+        matrix1 = matrix1.transpose()
+        matrix2 = matrix2.transpose()
+    #fi
 
-        r = np.ones(shape=(rows, cols))
-        p = np.ones(shape=(rows, cols))
-        for i in range(rows):
-            dat1 = matrix1[i,:] if (axis == 0) else matrix1[:,i]
-            for j in range(cols):
-                dat2 = matrix2[j,:] if (axis == 0) else matrix2[:,j]
-                r_, p_ = method(dat1, dat2)
-                r[i, j] = r_
-                p[i, j] = p_
-            #efor
-        #efor
-        return r, p
-    #edef
-    
-    def _corrcoef_spearman(matrix1, matrix2, axis):
-        r, p = sstats.spearmanr(matrix1, matrix2, 1-axis)
-        
-        if axis == 1:
-            r = r[:matrix1.shape[axis], :][:, matrix1.shape[axis]:]
-            p = p[:matrix1.shape[axis], :][:, matrix1.shape[axis]:]
-        else:
-            r = r[:, :matrix1.shape[axis]][matrix1.shape[axis]:, :]
-            p = p[:, :matrix1.shape[axis]][matrix1.shape[axis]:, :]
-        #fi
+    if matrix1.shape[1] != matrix2.shape[1]:
+        raise ValueError("Cannot calculate correlation along this axis.")
+    #fi
 
-        return r, p
-    #edef
-        
-        
+    if hasattr(method, '__call__'):
+        return _corrcoef_callable(matrix1, matrix2, method, n_workers=n_workers)
+    #fi
 
     method = method.lower()
-    
+
     if method == 'pearson':
-        return _corrcoef_between_callable(matrix1, matrix2, axis=axis, method=sstats.pearsonr)
+        return _corrcoef_blocked(matrix1, matrix2, block_size=block_size, n_workers=n_workers, out=out, threshold=threshold)
     elif method == 'spearman':
-        return _corrcoef_spearman(matrix1, matrix2, axis)
+        return _corrcoef_spearman(matrix1, matrix2, block_size=block_size, n_workers=n_workers, out=out, threshold=threshold)
     elif method == 'spearman_slow':
-        return _corrcoef_between_callable(matrix1, matrix2, axis=axis, method=sstats.spearmanr)
-    elif hasattr(method, '__call__'):
-        return _corrcoef_between_callable(matrix1, matrix2, axis=axis, method=method)
+        return _corrcoef_callable(matrix1, matrix2, sstats.spearmanr, n_workers=n_workers)
     else:
         raise ValueError("Don't know what to do with method '%s'" % method)
     #fi
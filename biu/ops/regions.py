@@ -2,15 +2,22 @@
 A library of functions to deal with genomic regions
 """
 
+import os
+import json
+
+from .. import utils
 from . import lst
 
-def merge(regions):
+np = utils.py.loadExternalModule("numpy")
+
+def merge(regions, gap=0):
     """
     Merge genomic regions based
     parameters:
     -----------
     regions: List[3-tuples]
         A list of regions in the form of (seqid, start, end)
+    gap: Integer. Also merge regions that are at most this far apart
     
     output:
     -------
@@ -23,8 +30,8 @@ def merge(regions):
         regs = regions[seqid]
         m = [ regs[0] ]
         for seqid, start, end in regs[1:]:
-            if start <= m[-1][2]:
-                m[-1] = (seqid, m[-1][1], end)
+            if start <= m[-1][2] + gap:
+                m[-1] = (seqid, m[-1][1], max(m[-1][2], end))
             else:
                 m.append((seqid, start, end))
             #fi
@@ -32,4 +39,208 @@ def merge(regions):
         merged[seqid] = m
     #efor
     return lst.flatten(merged.values())
-#edef
\ No newline at end of file
+#edef
+
+###############################################################################
+
+class IntervalIndex(object):
+    """
+    A compact index of half-open intervals [start, end) on several seqids, for fast overlap queries.
+    
+    The index is an augmented interval list: per seqid, the intervals are stored in NumPy arrays sorted by start,
+      together with the running maximum of the ends. Intervals that contain many of the intervals that follow them
+      (e.g. long genes) are moved to separate components, so that a query scans few non-overlapping intervals.
+    All arrays are concatenated, so the index can be pickled, or saved and memory-mapped (see save and load).
+    
+    Example usage:
+    --------------
+    I = IntervalIndex(['1', '1', '2'], [0, 10, 5], [20, 15, 8])
+    region_idx, interval_idx = I.query(['1', '2'], [12, 0], [13, 6])
+    # region_idx   = [0, 0, 1]
+    # interval_idx = [0, 1, 2]
+    """
+    
+    def __init__(self, seqids, starts, ends, window=20, min_coverage=10, max_components=10):
+        """
+        Construct an interval index
+        
+        parameters:
+        -----------
+        seqids: list of seqid of each interval
+        starts: list of integer start of each interval (inclusive)
+        ends:   list of integer end of each interval (exclusive)
+        window, min_coverage: An interval is moved to a separate component if it contains at least min_coverage
+                              of the window intervals that follow it.
+        max_components: Maximum number of components per seqid
+        """
+        seqids = np.asarray([ str(s) for s in seqids ])
+        starts = np.asarray(starts, dtype=np.int64)
+        ends   = np.asarray(ends, dtype=np.int64)
+        
+        arrays = { 'starts' : [], 'ends' : [], 'maxends' : [], 'idx' : [] }
+        blocks = {}
+        offset = 0
+        
+        for seqid in sorted(set(seqids)):
+            sidx  = np.flatnonzero(seqids == seqid)
+            sidx  = sidx[np.argsort(starts[sidx], kind='stable')]
+            blocks[seqid] = []
+            for cidx in self._decompose(sidx, ends, window, min_coverage, max_components):
+                arrays['starts'].append(starts[cidx])
+                arrays['ends'].append(ends[cidx])
+                arrays['maxends'].append(np.maximum.accumulate(ends[cidx]))
+                arrays['idx'].append(cidx)
+                blocks[seqid].append((offset, offset + len(cidx)))
+                offset += len(cidx)
+            #efor
+        #efor
+        
+        self._arrays = { k : np.concatenate(v) if len(v) > 0 else np.zeros(0, dtype=np.int64)
+                         for (k, v) in arrays.items() }
+        self._blocks = blocks
+    #edef
+    
+    @staticmethod
+    def _decompose(sidx, ends, window, min_coverage, max_components):
+        """
+        Split a list of start-sorted intervals into components without long, containing intervals
+        
+        Returns: list of arrays of interval indexes
+        """
+        components = []
+        for c in range(max_components - 1):
+            n = len(sidx)
+            if n <= window:
+                break
+            #fi
+            
+            e       = ends[sidx]
+            padded  = np.concatenate([ e[1:], np.full(window, np.iinfo(np.int64).max) ])
+            covered = (np.lib.stride_tricks.sliding_window_view(padded, window)[:n] <= e[:,None]).sum(axis=1)
+            is_long = covered >= min_coverage
+            if not is_long.any():
+                break
+            #fi
+            
+            components.append(sidx[~is_long])
+            sidx = sidx[is_long]
+        #efor
+        components.append(sidx)
+        return [ c for c in components if len(c) > 0 ]
+    #edef
+    
+    @property
+    def seqids(self):
+        return list(self._blocks.keys())
+    #edef
+    
+    def __len__(self):
+        return len(self._arrays['idx'])
+    #edef
+    
+    def __contains__(self, seqid):
+        return str(seqid) in self._blocks
+    #edef
+    
+    def query(self, seqids, starts, ends):
+        """
+        Find the intervals that overlap with each of a set of query regions [start, end)
+        
+        parameters:
+        -----------
+        seqids: list of seqid of each region
+        starts: list of integer start of each region (inclusive)
+        ends:   list of integer end of each region (exclusive)
+        
+        Returns:
+        --------
+        Two integer arrays of equal length, sorted by region, and then by interval index:
+          * region_idx: index of the region
+          * interval_idx: index (in the order of construction) of an interval overlapping with that region
+        """
+        seqids = np.asarray([ str(s) for s in seqids ])
+        starts = np.asarray(starts, dtype=np.int64)
+        ends   = np.asarray(ends, dtype=np.int64)
+        
+        A = self._arrays
+        R = []
+        I = []
+        for seqid in set(seqids):
+            if seqid not in self._blocks:
+                continue
+            #fi
+            
+            ridx = np.flatnonzero(seqids == seqid)
+            qs   = starts[ridx]
+            qe   = ends[ridx]
+            
+            for (first, last) in self._blocks[seqid]:
+                # Intervals before lo end before the query, intervals from hi start after it.
+                lo = first + np.searchsorted(A['maxends'][first:last], qs, side='right')
+                hi = first + np.searchsorted(A['starts'][first:last], qe, side='left')
+                n  = np.where(qs < qe, np.maximum(hi - lo, 0), 0)
+                
+                total = n.sum()
+                if total == 0:
+                    continue
+                #fi
+                cand = np.repeat(lo, n) + (np.arange(total) - np.repeat(np.cumsum(n) - n, n))
+                keep = A['ends'][cand] > np.repeat(qs, n)
+                R.append(np.repeat(ridx, n)[keep])
+                I.append(A['idx'][cand[keep]])
+            #efor
+        #efor
+        
+        if len(R) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        #fi
+        
+        R = np.concatenate(R)
+        I = np.concatenate(I)
+        order = np.lexsort((I, R))
+        return R[order], I[order]
+    #edef
+    
+    def save(self, directory):
+        """
+        Save the index to a directory, from which it can be memory-mapped with IntervalIndex.load
+        """
+        utils.fs.mkdirp(directory)
+        for name, array in self._arrays.items():
+            np.save(os.path.join(directory, '%s.npy' % name), array)
+        #efor
+        with open(os.path.join(directory, 'blocks.json'), 'w') as ofd:
+            json.dump(self._blocks, ofd)
+        #ewith
+    #edef
+    
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Load an index that was stored with save
+        
+        parameters:
+        -----------
+        directory: String. Directory given to save
+        mmap: Boolean. Memory-map the arrays, rather than reading them
+        """
+        index = cls.__new__(cls)
+        index._arrays = { name : np.load(os.path.join(directory, '%s.npy' % name), mmap_mode='r' if mmap else None)
+                          for name in [ 'starts', 'ends', 'maxends', 'idx' ] }
+        with open(os.path.join(directory, 'blocks.json'), 'r') as ifd:
+            index._blocks = { seqid : [ tuple(b) for b in blocks ] for (seqid, blocks) in json.load(ifd).items() }
+        #ewith
+        return index
+    #edef
+    
+    def __str__(self):
+        dstr  = "IntervalIndex object\n"
+        dstr += " Intervals: %d\n" % len(self)
+        dstr += " Seqids: %d\n" % len(self._blocks)
+        return dstr
+    #edef
+    
+    def __repr__(self):
+        return str(self)
+    #edef
+#eclass
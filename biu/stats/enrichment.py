@@ -2,15 +2,19 @@ from .. import utils
 from .. import ops
 
 sstats = utils.py.loadExternalModule("scipy.stats")
+sspecial = utils.py.loadExternalModule("scipy.special")
 np     = utils.py.loadExternalModule('numpy')
+pd     = utils.py.loadExternalModule('pandas')
 
 plt = utils.py.loadExternalModule('matplotlib.pylab') 
 fc  = utils.py.loadExternalModule('fastcluster')
 sp  = utils.py.loadExternalModule('scipy')
+ssparse = utils.py.loadExternalModule('scipy.sparse')
 
 from collections import namedtuple
 
 from . import permutations
+from .p_adjust import p_adjust
 
 @utils.decorators.deprecated("setEnrichment is deprecated. Use set_enrichment instead.")
 def setEnrichment(your_set, other_set, universe):
@@ -96,8 +100,446 @@ def set_enrichment(your_set, other_set, universe):
     return resTuple(oddsratio, chi2, p, table, [[a,b],[c,d]], method)
 #edef
 
+###############################################################################
+# Batch set enrichment
+
+def _binary_search(f, d, lo, hi, idx):
+    """
+    A vectorised version of the binary search that scipy.stats.fisher_exact uses to find the other tail.
+    For each table idx[i], find x in [lo[i], hi[i]] such that f(x) <= d[i] < f(x+1), for f ascending on [lo, hi].
+    f(x, idx) evaluates the function at x for the tables idx.
+    """
+    lo, hi = lo.copy(), hi.copy()
+    res  = np.zeros(len(lo), dtype=np.int64)
+    done = np.zeros(len(lo), dtype=bool)
+    
+    while True:
+        act = np.flatnonzero(~done & (lo < hi))
+        if len(act) == 0:
+            break
+        #fi
+        mid    = lo[act] + (hi[act] - lo[act]) // 2
+        midval = f(mid, idx[act])
+        
+        below, above, equal = midval < d[act], midval > d[act], midval == d[act]
+        lo[act[below]]   = mid[below] + 1
+        hi[act[above]]   = mid[above] - 1
+        res[act[equal]]  = mid[equal]
+        done[act[equal]] = True
+    #ewhile
+    
+    rem = np.flatnonzero(~done)
+    res[rem] = np.where(f(lo[rem], idx[rem]) <= d[rem], lo[rem], lo[rem] - 1)
+    return res
+#edef
+
+def _hypergeom_logpmf(x, M, n1, n):
+    """
+    log of the hypergeometric probability of x successes in n draws from M objects of which n1 are successes.
+    """
+    def lchoose(N, k):
+        return sspecial.gammaln(N + 1) - sspecial.gammaln(k + 1) - sspecial.gammaln(N - k + 1)
+    #edef
+    
+    support = (x >= np.maximum(0, n - (M - n1))) & (x <= np.minimum(n, n1))
+    with np.errstate(invalid='ignore'):
+        logpmf = lchoose(n1, x) + lchoose(M - n1, n - x) - lchoose(M, n)
+    #ewith
+    return np.where(support, logpmf, -np.inf)
+#edef
+
+def fisher_exact_tables(a, b, c, d):
+    """
+    Two-sided Fisher's exact test of many 2x2 contingency tables [[a, b], [c, d]] at once.
+    Follows scipy.stats.fisher_exact, which tests one table at a time: the p-value sums the probabilities
+    of all tables that are at most as likely as the observed one. Like R's fisher.test, table probabilities
+    within a relative difference of 1e-7 are considered equal.
+    
+    parameters:
+    -----------
+    a, b, c, d: np.array of integers. The cells of each table
+    
+    Returns:
+    --------
+    oddsratio, p: np.arrays of odds ratios and p-values
+    """
+    a, b, c, d = [ np.asarray(x, dtype=np.int64).ravel() for x in np.broadcast_arrays(a, b, c, d) ]
+    n1, n2, n = a + b, c + d, a + c
+    M = n1 + n2
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        oddsratio = np.where((c > 0) & (b > 0), (a * d).astype(float) / (c * b), np.inf)
+    #ewith
+    p = np.ones(len(a))
+    
+    # If both values in a row or column are zero, the p-value is 1 and the odds ratio is NaN.
+    valid = (n1 > 0) & (n2 > 0) & (n > 0) & (b + d > 0)
+    oddsratio[~valid] = np.nan
+    
+    def logpmf(x, idx):
+        return _hypergeom_logpmf(x, M[idx], n1[idx], n[idx])
+    #edef
+    
+    lgamma = np.log1p(1e-7)
+    idx    = np.flatnonzero(valid)
+    mode   = ((n[idx] + 1) * (n1[idx] + 1)) // (M[idx] + 2)
+    lexact = logpmf(a[idx], idx)
+    atmode = np.abs(lexact - logpmf(mode, idx)) <= lgamma
+    
+    # Observed table below the mode: add the upper tail, unless it cannot contain a less likely table
+    low = ~atmode & (a[idx] < mode)
+    il  = idx[low]
+    pl  = sstats.hypergeom.cdf(a[il], M[il], n1[il], n[il])
+    tail = logpmf(n[il], il) <= lexact[low] + lgamma
+    guess = _binary_search(lambda x, i: -logpmf(x, i), -(lexact[low][tail] + lgamma), mode[low][tail], n[il][tail], il[tail])
+    pl[tail] += sstats.hypergeom.sf(guess, M[il[tail]], n1[il[tail]], n[il[tail]])
+    p[il] = pl
+    
+    # Observed table above the mode: add the lower tail, unless it cannot contain a less likely table
+    high = ~atmode & (a[idx] >= mode)
+    ih   = idx[high]
+    ph   = sstats.hypergeom.sf(a[ih] - 1, M[ih], n1[ih], n[ih])
+    tail = logpmf(np.zeros(len(ih), dtype=np.int64), ih) <= lexact[high] + lgamma
+    guess = _binary_search(logpmf, lexact[high][tail] + lgamma, np.zeros(tail.sum(), dtype=np.int64), mode[high][tail], ih[tail])
+    ph[tail] += sstats.hypergeom.cdf(guess, M[ih[tail]], n1[ih[tail]], n[ih[tail]])
+    p[ih] = ph
+    
+    return oddsratio, np.minimum(p, 1.0)
+#edef
+
+def chi2_tables(a, b, c, d, correction=True):
+    """
+    Chi-squared test of many 2x2 contingency tables [[a, b], [c, d]] at once.
+    Gives the same results as scipy.stats.chi2_contingency (with Yates' correction by default).
+    Tables with an expected frequency of zero get a NaN statistic and p-value.
+    
+    Returns:
+    --------
+    chi2, p: np.arrays of test statistics and p-values
+    """
+    a, b, c, d = [ np.asarray(x, dtype=float).ravel() for x in np.broadcast_arrays(a, b, c, d) ]
+    T = a + b + c + d
+    
+    observed = np.stack([ a, b, c, d ], axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = np.stack([ (a + b) * (a + c), (a + b) * (b + d), (c + d) * (a + c), (c + d) * (b + d) ], axis=1) / T[:, None]
+        if correction:
+            diff = expected - observed
+            observed = observed + np.minimum(0.5, np.abs(diff)) * np.sign(diff)
+        #fi
+        chi2 = np.sum((observed - expected)**2 / expected, axis=1)
+    #ewith
+    chi2[np.any(expected == 0, axis=1) | (T == 0)] = np.nan
+    
+    return chi2, sstats.chi2.sf(chi2, 1)
+#edef
+
+def set_enrichment_tables(a, b, c, d):
+    """
+    Test many contingency tables at once, choosing the test for each table like set_enrichment does.
+    
+    parameters:
+    -----------
+    a, b, c, d: np.array of integers. The cells of each contingency table (See set_enrichment)
+    
+    Returns:
+    --------
+    pandas.DataFrame with columns method, c2statistic, oddsratio, p
+    """
+    a, b, c, d = [ np.asarray(x, dtype=np.int64).ravel() for x in np.broadcast_arrays(a, b, c, d) ]
+    
+    # set_enrichment decides with min(min(table)), i.e. the minimum of the (lexicographically) smallest row
+    second   = (c < a) | ((c == a) & (d < b))
+    smallest = np.where(second, np.minimum(c, d), np.minimum(a, b))
+    fisher   = smallest <= 5
+    
+    oddsratio = np.zeros(len(a))
+    p         = np.zeros(len(a))
+    chi2      = np.full(len(a), np.nan)
+    
+    oddsratio[fisher], p[fisher] = fisher_exact_tables(a[fisher], b[fisher], c[fisher], d[fisher])
+    chi2[~fisher], p[~fisher]    = chi2_tables(a[~fisher], b[~fisher], c[~fisher], d[~fisher])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        oddsratio[~fisher] = np.where((c[~fisher] > 0) & (b[~fisher] > 0),
+                                      (a[~fisher] * d[~fisher]).astype(float) / (c[~fisher] * b[~fisher]), np.inf)
+    #ewith
+    
+    # Like set_enrichment, there is no chi2 statistic (None) for tables tested with fisher's exact test
+    c2statistic = chi2.astype(object)
+    c2statistic[fisher] = None
+    
+    return pd.DataFrame({ 'method' : np.where(fisher, 'fisher', 'chi2'),
+                          'c2statistic' : c2statistic,
+                          'oddsratio' : oddsratio,
+                          'p' : p })
+#edef
+
+class EnrichmentIndex(object):
+    """
+    Test the enrichment of many sets in many annotation terms at once.
+    
+    The annotation is held as a sparse (object x term) incidence matrix. For all query sets together,
+    the contingency tables are computed with sparse matrix products, and the tests are vectorised.
+    
+    example usage:
+    
+    idx = EnrichmentIndex({ 'term1' : [ 'geneA', 'geneB' ], 'term2' : [ 'geneB', 'geneC', 'geneD' ] })
+    idx.enrich({ 'up' : [ 'geneA', 'geneB' ], 'down' : [ 'geneD' ] })
+    """
+    
+    def __init__(self, annotation):
+        """
+        Initialize the index.
+        
+        parameters:
+        -----------
+        annotation: dict of term -> list of objects annotated with that term
+        """
+        terms   = list(annotation.keys())
+        pairs   = [ (o, t) for (t, term) in enumerate(terms) for o in annotation[term] ]
+        objects = list(dict.fromkeys([ o for (o, t) in pairs ]))
+        
+        self.terms   = pd.Index(terms)
+        self.objects = pd.Index(objects)
+        
+        rows = self.objects.get_indexer([ o for (o, t) in pairs ])
+        cols = np.array([ t for (o, t) in pairs ], dtype=np.int64)
+        self.matrix = ssparse.csr_matrix((np.ones(len(pairs), dtype=np.int64), (rows, cols)),
+                                         shape=(len(self.objects), len(self.terms)))
+        # Duplicate annotations count once
+        self.matrix.sum_duplicates()
+        self.matrix.data[:] = 1
+    #edef
+    
+    @classmethod
+    def from_matrix(cls, objects, terms, matrix):
+        """
+        Initialize the index from an existing (object x term) incidence matrix.
+        
+        parameters:
+        -----------
+        objects: list of object identifiers (rows of the matrix)
+        terms: list of term identifiers (columns of the matrix)
+        matrix: scipy.sparse matrix. Nonzero entries are annotations
+        """
+        index = cls({})
+        index.terms   = pd.Index(terms)
+        index.objects = pd.Index(objects)
+        index.matrix  = ssparse.csr_matrix(matrix, dtype=np.int64)
+        index.matrix.sum_duplicates()
+        index.matrix.data[:] = 1
+        return index
+    #edef
+    
+    def __len__(self):
+        return len(self.terms)
+    #edef
+    
+    def _set_matrix(self, sets):
+        """
+        The (set x object) incidence matrix of a list of sets, ignoring objects that are not annotated.
+        """
+        rows = [ i for (i, s) in enumerate(sets) for o in s ]
+        cols = self.objects.get_indexer([ o for s in sets for o in s ])
+        keep = cols >= 0
+        Q = ssparse.csr_matrix((np.ones(keep.sum(), dtype=np.int64), (np.array(rows, dtype=np.int64)[keep], cols[keep])),
+                               shape=(len(sets), len(self.objects)))
+        Q.sum_duplicates()
+        Q.data[:] = 1
+        return Q
+    #edef
+    
+    def enrich(self, your_sets, background=None, terms=None, method=None, table_values=False, **kwargs):
+        """
+        Test the enrichment of each annotation term in each of your sets.
+        
+        parameters:
+        -----------
+        your_sets: List[String] | List[List[String]] | dict[String->List[String]]
+            A set of objects, or a list/dict of sets of objects
+        background: List[String]. The universe of objects (Default: all annotated objects)
+        terms: List[String]. The terms to test in every set. Unknown terms are tested as empty terms.
+               Default: for each set, all terms that its objects are annotated with
+        method: The multiple testing correction procedure (see biu.stats.p_adjust), applied per set
+        table_values: Boolean. Also return the objects in each cell of the contingency tables (slow for many tests)
+        **kwargs: Additional arguments for biu.stats.p_adjust
+        
+        Returns:
+        --------
+        pandas.DataFrame with columns set, pathway, method, c2statistic, oddsratio, p, table (, table_values) (, q)
+        """
+        if not isinstance(your_sets, dict):
+            if (len(your_sets) == 0) or isinstance(list(your_sets)[0], str):
+                your_sets = { "set" : your_sets }
+            else:
+                your_sets = { "set_%d" % (i+1) : s for (i,s) in enumerate(your_sets) }
+            #fi
+        #fi
+        names = list(your_sets.keys())
+        sets  = [ set(your_sets[k]) for k in names ]
+        
+        if background is None:
+            universe = set(self.objects)
+            Q_bg = Q = self._set_matrix(sets)
+            M = self.matrix
+        else:
+            universe = set(background)
+            Q = self._set_matrix(sets)
+            sets = [ s & universe for s in sets ]
+            Q_bg = self._set_matrix(sets)
+            in_bg = self.objects.isin(list(universe))
+            M = ssparse.diags(in_bg.astype(np.int64), dtype=np.int64) @ self.matrix
+        #fi
+        
+        # Which (set, term) pairs to test
+        if terms is None:
+            pairs  = (Q @ self.matrix).tocoo()
+            order  = np.lexsort((pairs.col, pairs.row))
+            S, T   = pairs.row[order].astype(np.int64), pairs.col[order].astype(np.int64)
+            tnames = np.asarray(self.terms)[T]
+        else:
+            terms  = [ terms ] if isinstance(terms, str) else list(terms)
+            S      = np.repeat(np.arange(len(sets), dtype=np.int64), len(terms))
+            tnames = np.tile(np.array(terms, dtype=object), len(sets))
+            T      = self.terms.get_indexer(tnames)
+        #fi
+        
+        overlap = (Q_bg @ M).tocsr()
+        known   = T >= 0
+        a = np.zeros(len(S), dtype=np.int64)
+        K = np.zeros(len(S), dtype=np.int64)
+        if known.any():
+            a[known] = np.asarray(overlap[S[known], T[known]]).ravel()
+            K[known] = np.asarray(M.sum(axis=0)).ravel()[T[known]]
+        #fi
+        n = np.array([ len(s & universe) for s in sets ], dtype=np.int64)[S]
+        U = len(universe)
+        
+        b = K - a
+        c = n - a
+        d = U - n - b
+        
+        R = set_enrichment_tables(a, b, c, d)
+        R.insert(0, 'pathway', tnames)
+        R.insert(0, 'set', np.array(names, dtype=object)[S])
+        R['table'] = [ [[ai, bi], [ci, di]] for (ai, bi, ci, di) in zip(a.tolist(), b.tolist(), c.tolist(), d.tolist()) ]
+        
+        if table_values:
+            def values(s, t):
+                other = set(self.objects[self.matrix[:, t].nonzero()[0]]) & universe if t >= 0 else set()
+                s = s & universe
+                return [ [ s & other, other - s ], [ s - other, universe - (s | other) ] ]
+            #edef
+            R['table_values'] = [ values(sets[si], ti) for (si, ti) in zip(S, T) ]
+        #fi
+        
+        if method is not None:
+            R['q'] = np.nan
+            for (k, idx) in R.groupby('set').indices.items():
+                R.loc[R.index[idx], 'q'] = p_adjust(R.p.values[idx], method, **kwargs)
+            #efor
+        #fi
+        
+        return R
+    #edef
+    
+    def __str__(self):
+        dstr  = "EnrichmentIndex object\n"
+        dstr += " Terms: %d\n" % len(self.terms)
+        dstr += " Objects: %d\n" % len(self.objects)
+        dstr += " Annotations: %d\n" % self.matrix.nnz
+        return dstr
+    #edef
+    
+    def __repr__(self):
+        return str(self)
+    #edef
+#eclass
+
+###############################################################################
+
+GSEA_Result = namedtuple('GSEA_Result', [ 'es', 'p', 'i', 'idx'])
+
+def _gsea_es(s, M):
+    """
+    Calculate the enrichment score of a batch of memberships over the same ranking, with cumulative sums.
+    
+    parameters:
+    -----------
+    s: np.array of N (sorted) scores, already raised to the power p
+    M: np.array (k x N) of 0/1 memberships
+    
+    Returns:
+    --------
+    es: np.array of k enrichment scores
+    i:  np.array of k numbers of genes at the peak
+    """
+    N  = M.shape[1]
+    NH = M.sum(axis=1, keepdims=True)
+    W  = M * s
+    NR = W.sum(axis=1, keepdims=True)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # running[:, i-1] is the running sum over the first i genes, for i in 1..N-1
+        running = np.cumsum(W, axis=1)[:, :N-1] / NR - np.cumsum(1 - M, axis=1)[:, :N-1] / (N - NH)
+    #ewith
+    
+    # Take the last peak if the maximum is reached more than once
+    peak = (N - 2) - np.argmax(running[:, ::-1], axis=1)
+    return running[np.arange(M.shape[0]), peak], peak + 1
+#edef
+
+def _gsea_sorted(S, M, O, p, side, max_perm, min_perm, perm_thresh, rng):
+    """
+    GSEA of one membership vector M over scores S that are already sorted. O are the original indexes.
+    See gsea.
+    """
+    nt = GSEA_Result
+    
+    N  = len(S)
+    NH = sum(M)
+    
+    if NH == 0:
+        return nt(0, 1.0, N, [])
+    #fi
+    
+    if side not in [ 'left', 'right', 'both' ]:
+        raise ValueError("Unknown side: '%s'. See docstring." % side)
+    #fi
+    
+    s = S.astype(float)**p
+    es, i = _gsea_es(s, M.reshape(1, -1))
+    es, i = es[0], i[0]
+    index_i = O[np.where(M[:i] == 1)]
+    
+    def permute(k):
+        return _gsea_es(s, rng.permuted(np.tile(M, (k, 1)), axis=1))[0]
+    #edef
+    
+    perm_es = permute(min_perm)
+    perm_steps = int(np.ceil(max_perm / 10))
+    
+    nex = 0
+    while len(perm_es) < max_perm:
+        if side == 'left':
+            nex = np.sum(perm_es <= es)
+        elif side == 'right':
+            nex = np.sum(perm_es >= es)
+        else:
+            nex = min(np.sum(perm_es <= es), np.sum(perm_es >= es))
+        #fi
+        
+        if nex / len(perm_es) > perm_thresh:
+            break
+        #fi
+        
+        perm_es = np.concatenate([ perm_es, permute(perm_steps) ])
+    #ewhile
+    return nt(es, permutations.pvalue(es, perm_es, side=side), i, index_i)
+#edef
+
 def gsea(scores, membership, sort=True, sort_abs=True, p=1, side='both',
-         max_perm=1000, min_perm=100, perm_thresh=0.2, plot=None):
+         max_perm=1000, min_perm=100, perm_thresh=0.2, plot=None, seed=None):
     """
     Gene Set Enrichment Analysis.
     
@@ -121,6 +563,7 @@ def gsea(scores, membership, sort=True, sort_abs=True, p=1, side='both',
                         statistic is less than this value
     plot:        None|matplotlib.axis.
                  if not None, plot the histogram 
+    seed:        None|Integer|np.random.Generator. Seed of the random number generator for the permutations
     
     Returns:
     --------
@@ -131,71 +574,56 @@ def gsea(scores, membership, sort=True, sort_abs=True, p=1, side='both',
      idx=original_index_of_set_genes_at_peak)
     """
     
-    nt = namedtuple('GSEA_Result', [ 'es', 'p', 'i', 'idx'])
-    
     if len(scores) != len(membership):
         raise ValueError("gsea: scores and membership must be same length")
     #fi
     
-    L = zip(range(len(scores)), scores, membership)
-    L = sorted(L, key=lambda o: o[1])
+    S = np.asarray(scores)
+    O = np.argsort(S, kind='stable')
+    M = 1*np.asarray(membership)[O]
     
-    O, S, M = zip(*L)
-    S = np.array(S)
-    M = 1*np.array(M)
-    O = np.array(O)
+    return _gsea_sorted(S[O], M, O, p, side, max_perm, min_perm, perm_thresh, np.random.default_rng(seed))
+#edef
 
-    N  = len(S)
-    NH = sum(M)
+def gsea_sets(genes, scores, gene_sets, p=1, side='both', max_perm=1000, min_perm=100, perm_thresh=0.2,
+              seed=None, n_workers=1):
+    """
+    Gene Set Enrichment Analysis of many gene sets over the same ranking.
+    The ranking is sorted only once, and the gene sets can be distributed over a pool of processes.
     
-    if NH == 0:
-        return nt(0, 1.0, N, [])
+    parameters:
+    -----------
+    genes:       A list of gene identifiers
+    scores:      A list of scores, one for each gene. The SMALLEST score will be at the TOP of the list (see gsea).
+    gene_sets:   dict of set name -> list of genes in the set
+    p, side, max_perm, min_perm, perm_thresh: See gsea
+    seed:        None|Integer. Seed of the random number generators for the permutations.
+                 Each gene set gets its own generator, so results do not depend on n_workers.
+    n_workers:   Integer. Number of processes to use (None for the number of CPUs)
+    
+    Returns:
+    --------
+    pandas.DataFrame, indexed by gene set name, with columns es, p, i and idx (see gsea)
+    """
+    if len(genes) != len(scores):
+        raise ValueError("gsea_sets: genes and scores must be same length")
     #fi
     
-    def calculate_es(s, m):
-        NR = sum(s[m==1]**p)
-
-        def pmiss(i):
-            return sum(m[:i]==0) / (N - NH)
-        #edef
-        def phit(i):
-            return sum((s[:i][m[:i]==1])**p)/NR
-        #edef
-        
-        es_i = [ (i, phit(i) - pmiss(i)) for i in range(1, N) ]
-        
-        i, es = sorted(es_i, key=lambda x: x[1])[-1]
-        
-        return es, es_i, i
-    #edef
+    S = np.asarray(scores)
+    O = np.argsort(S, kind='stable')
+    G = pd.Index(np.asarray(genes)[O])
+    S = S[O]
     
-    es, es_i, i = calculate_es(S, M)
-    index_i = O[np.where(M[:i] == 1)]
+    names = list(gene_sets.keys())
+    seeds = np.random.SeedSequence(seed).spawn(len(names))
     
-    perm_es = [ calculate_es(S, np.random.choice(M, N, replace=False))[0] for i in range(min_perm) ]
-    perm_steps = int(np.ceil(max_perm / 10))
+    def run(k):
+        M = 1*G.isin(list(gene_sets[names[k]]))
+        return _gsea_sorted(S, M, O, p, side, max_perm, min_perm, perm_thresh, np.random.default_rng(seeds[k]))
+    #edef
     
-    nex = 0
-    while len(perm_es) < max_perm:
-        if side == 'left':
-            nex = len([e for e in perm_es if e <= es ])
-        elif side == 'right':
-            nex = len([e for e in perm_es if e >= es ])
-        elif side == 'both':
-            nex = min(len([e for e in perm_es if e <= es ]), 
-                      len([e for e in perm_es if e >= es ]))
-        else:
-            raise ValueError("Unknown side: '%s'. See docstring." % side)
-        #fi
-        
-        if nex / len(perm_es) > perm_thresh:
-            break
-        #fi
-        
-        perm_es.extend([ calculate_es(S, np.random.choice(M, N, replace=False))[0] for i in range(perm_steps) ])
-        
-    #ewhile
-    return nt(es, permutations.pvalue(es, perm_es, side=side), i, index_i)
+    R = utils.py.parallel_map(run, range(len(names)), n_workers=n_workers)
+    return pd.DataFrame(R, index=pd.Index(names, name='gene_set'), columns=[ 'es', 'p', 'i', 'idx' ])
 #edef
 
 ##############################################################################
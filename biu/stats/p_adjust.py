@@ -3,74 +3,230 @@ from ..ops.array import *
 
 np = utils.py.loadExternalModule("numpy")
 pd = utils.py.loadExternalModule("pandas")
+sspecial = utils.py.loadExternalModule("scipy.special")
 
-def p_adjust(p, method='fwer', n=None):
+def p_adjust(p, method='fwer', n=None, axis=None, inplace=False):
     """
     Adjust p values.
     This is a re-write of the R function p.adjust
-    
+
     Inputs:
-     - p: The array of pvalues
+     - p: The array of pvalues (list, numpy array or pandas DataFrame)
      - method: bonferroni, fwer
               holm
-              hommel (not yet implemented
+              hommel
               hochberg
               benjamini_hochberg, fdr, fdr_bh
               banjamini_yekutieli, fdr_by
-     - n: number of tests to correct for
+     - n: number of tests to correct for (default: the number of p-values that are not NaN, in each group)
+     - axis: None: adjust all p-values together.
+             Otherwise, adjust the p-values along this axis separately, e.g. axis=0 adjusts each column of a matrix, axis=1 each row
+     - inplace: Write the q-values into p, which must be a floating point numpy array (e.g. float32), rather than into a new array
 
     Outputs:
-     - Corrected q-values
-      
+     - Corrected q-values, of the same shape (and floating point type) as p.
+       Like in R, missing (NaN) p-values are not counted, and have missing q-values.
+
     """
     porig = p
 
-    
-    if isinstance(p, pd.DataFrame):
-        p = p.values.reshape(np.product(p.shape))
-    elif isinstance(p, np.ndarray) or isinstance(p, np.matrix):
-        p = p.reshape(np.product(p.shape))
+    if isinstance(p, pd.DataFrame) or isinstance(p, pd.Series):
+        p = p.values
     else:
-        p = np.array(p)
+        p = np.asarray(p)
     #fi
-    
-    if n is None:
-        n = len(p)
+    if not np.issubdtype(p.dtype, np.floating):
+        p = p.astype(np.float64)
     #fi
-    
-    methods = { 'bonferroni': bonferroni, 'fwer' : bonferroni,
-                'holm' : holm,
-                'hommel' : hommel,
-                'hochberg' : hochberg,
-                'benjamini_hochberg' : BH, "bh" : BH, 'fdr' : BH, 'fdr_bh' : BH,
-                'bejamini_yekutieli' : BY, 'by' : BY, 'fdr_by' : BY}
-    
+
+    methods = { 'bonferroni': _bonferroni, 'fwer' : _bonferroni,
+                'holm' : _holm,
+                'hommel' : _hommel,
+                'hochberg' : _hochberg,
+                'benjamini_hochberg' : _BH, "bh" : _BH, 'fdr' : _BH, 'fdr_bh' : _BH,
+                'benjamini_yekutieli' : _BY, 'bejamini_yekutieli' : _BY, 'by' : _BY, 'fdr_by' : _BY}
+
     method = method.lower()
     if method not in methods:
         method = 'fwer'
     #fi
-    
-    lp = len(p)
-    if n < lp:
-        n = lp
+
+    inplace = inplace and (p is porig) and p.flags.writeable
+    q = p if inplace else np.empty_like(p)
+
+    # The groups of p-values that are adjusted together are the rows of a matrix
+    if axis is None:
+        groups  = p.reshape(1, -1)
+        qgroups = q.reshape(1, -1)
+    else:
+        groups  = np.moveaxis(p, axis, -1)
+        groups  = groups.reshape(-1, groups.shape[-1])
+        qgroups = np.moveaxis(q, axis, -1)
+        qgroups = qgroups.reshape(-1, qgroups.shape[-1])
     #fi
-    if (n == 2) & (method == 'hommel'):
-        method = 'hochberg'
+
+    if np.shares_memory(qgroups, q):
+        _adjust(groups, n, methods[method], out=qgroups)
+    else:
+        # The reshape had to make a copy
+        qgroups = _adjust(groups, n, methods[method])
+        if axis is None:
+            q[...] = qgroups.reshape(q.shape)
+        else:
+            np.moveaxis(q, axis, -1)[...] = qgroups.reshape(np.moveaxis(q, axis, -1).shape)
+        #fi
     #fi
-    
-    q = np.ones(lp)
-    q[~np.isnan(p)] = methods[method](p[~np.isnan(p)], n)
-    
+
     if isinstance(porig, pd.DataFrame):
-        q = pd.DataFrame(q.reshape(porig.shape), columns=porig.columns, index=porig.index)
-    elif isinstance(porig, np.ndarray) or isinstance(porig, np.matrix):
-        q = q.reshape(porig.shape)
+        q = pd.DataFrame(q, columns=porig.columns, index=porig.index)
     #fi
-    
+
     return q
 #edef
-    
-    
+
+###############################################################################
+
+def _adjust(p, n, method, out=None):
+    """
+    Adjust each row of a matrix of p-values, with one of the methods below.
+    The p-values of each row are sorted (missing values last), and the method is applied to the sorted rows, all at once.
+    Inputs:
+     - p: 2D floating point array
+     - n: number of tests to correct for (at least the number of p-values in a row)
+     - method: one of _bonferroni, _holm, _hommel, _hochberg, _BH, _BY
+     - out: Array to write the q-values to (may be p)
+    Outputs:
+     - Corrected q-values
+    """
+    out = np.empty_like(p) if out is None else out
+    dtype = p.dtype
+    m = (~np.isnan(p)).sum(axis=1)
+    n = m if n is None else np.maximum(n, m)
+    if p.shape[1] == 0:
+        return out
+    #fi
+
+    if method is _bonferroni:
+        np.minimum(1, n.astype(dtype)[:, None] * p, out=out)
+        return out
+    #fi
+
+    o = np.argsort(p, axis=1, kind='stable')
+    s = np.take_along_axis(p, o, axis=1)
+    i = np.arange(1, p.shape[1] + 1, dtype=dtype)[None, :]
+
+    q = method(s, n.astype(dtype)[:, None], i, m)
+    q[i > m[:, None]] = np.nan
+    np.put_along_axis(out, o, q, axis=1)
+    return out
+#edef
+
+def _cummin_decreasing(values):
+    """
+    Cumulative minimum from the largest to the smallest p-value, ignoring the missing values at the end of each row
+    """
+    return np.fmin.accumulate(values[:, ::-1], axis=1)[:, ::-1]
+#edef
+
+def _bonferroni(s, n, i, m):
+    return np.minimum(1, n * s)
+#edef
+
+def _holm(s, n, i, m):
+    return np.minimum(1, np.fmax.accumulate((n - i + 1) * s, axis=1))
+#edef
+
+def _hochberg(s, n, i, m):
+    return np.minimum(1, _cummin_decreasing((n - i + 1) * s))
+#edef
+
+def _BH(s, n, i, m):
+    return np.minimum(1, _cummin_decreasing(n / i * s))
+#edef
+
+def _BY(s, n, i, m):
+    # The harmonic number sum(1/(1:n)), without making the sum
+    q = (sspecial.digamma(n.astype(np.float64) + 1) + np.euler_gamma).astype(s.dtype)
+    return np.minimum(1, _cummin_decreasing(q * n / i * s))
+#edef
+
+def _hommel(s, n, i, m):
+    q = np.full(s.shape, np.nan, dtype=s.dtype)
+    for row in range(s.shape[0]):
+        if m[row] > 0:
+            q[row, :m[row]] = _hommel_sorted(s[row, :m[row]], int(n[row, 0]))
+        #fi
+    #efor
+    return q
+#edef
+
+def _lower_hull(x, y):
+    """
+    The indexes of the vertices of the lower convex hull of points sorted by x.
+    Points that are not strictly below the line through their neighbours are removed, all at once, until none are left.
+    """
+    idx = np.arange(len(x))
+    while len(idx) > 2:
+        xi, yi = x[idx], y[idx]
+        cross  = (xi[1:-1] - xi[:-2]) * (yi[2:] - yi[1:-1]) - (yi[1:-1] - yi[:-2]) * (xi[2:] - xi[1:-1])
+        keep   = np.concatenate([[True], cross > 0, [True]])
+        nRemoved = len(idx) - keep.sum()
+        idx    = idx[keep]
+        if nRemoved == 0:
+            break
+        elif nRemoved < len(idx) // 100:
+            # Only a few points are removed at a time: finish with a monotone chain
+            hull = []
+            for j in idx:
+                while (len(hull) >= 2) and ((x[hull[-1]] - x[hull[-2]]) * (y[j] - y[hull[-1]]) - (y[hull[-1]] - y[hull[-2]]) * (x[j] - x[hull[-1]]) <= 0):
+                    hull.pop()
+                #ewhile
+                hull.append(j)
+            #efor
+            idx = np.array(hull)
+            break
+        #fi
+    #ewhile
+    return idx
+#edef
+
+def _hommel_sorted(p, n):
+    """
+    Hommel adjusted p-values of sorted p-values, in O(n log n).
+
+    With S_j the Simes p-value of the j largest p-values, and M_j = max(S_j, S_j+1, ... S_n),
+      the adjusted p-value of p_i is min_j max(M_j+1, j * p_i), the smallest alpha at which h(alpha) * p_i <= alpha.
+    S_j = j * min_k p_(n-j+k) / k is j times the smallest slope from the point (n-j, 0) to a point (m, p_m).
+    That point is a vertex of the lower convex hull of the points, found by binary search on the x-intercepts of the hull's edges.
+    """
+    m = len(p)
+    y = np.concatenate([ p, np.ones(n - m, dtype=p.dtype) ]).astype(np.float64)
+    x = np.arange(1, n + 1, dtype=np.float64)
+
+    hull   = _lower_hull(x, y)
+    hx, hy = x[hull], y[hull]
+
+    # The vertex with the smallest slope from (t, 0) is the first one (right of t) whose next edge line crosses zero at or after t
+    dx, dy = np.diff(hx), np.diff(hy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau = np.where(dy > 0, hx[:-1] - hy[:-1] * dx / np.where(dy > 0, dy, 1), np.where(hy[:-1] == 0, hx[:-1], -np.inf))
+    #ewith
+    t = np.arange(n, dtype=np.float64)
+    k = np.maximum(np.searchsorted(hx, t, side='right'), np.minimum(np.searchsorted(tau, t, side='left'), len(hx) - 1))
+
+    j = n - t
+    S = j * hy[k] / (hx[k] - t)      # S[t] = S_(n-t)
+    M = np.maximum.accumulate(S)      # M[t] = M_(n-t)
+    Mnext = np.concatenate([ [0], M[:-1] ])  # M_(j+1)
+
+    # min_j max(M_j+1, j * p_i) is where j * p_i crosses M_j+1 (M_j+1 / j decreases with j)
+    crossing = Mnext / j # increasing with t
+    jstar = n - np.searchsorted(crossing, p, side='right') + 1
+    q = np.minimum(jstar * p.astype(np.float64), M[n - jstar])
+    return np.maximum(q, p).astype(p.dtype)
+#edef
+
+###############################################################################
 
 def bonferroni(p, n):
     """
@@ -80,10 +236,10 @@ def bonferroni(p, n):
      - n: number of tests to correct for
     Outputs:
      - Corrected q-values
-    
+
     R code:
         bonferroni = pmin(1, n * p),"""
-    return pmin(1, n * p)
+    return _adjust(np.atleast_2d(np.asarray(p, dtype=float)), n, _bonferroni)[0]
 #edef
 
 def holm(p, n):
@@ -94,7 +250,7 @@ def holm(p, n):
      - n: number of tests to correct for
     Outputs:
      - Corrected q-values
-    
+
     R code:
         holm = {
         i <- seq_len(lp)
@@ -103,11 +259,7 @@ def holm(p, n):
         pmin(1, cummax( (n - i + 1L) * p[o] ))[ro]
         },
     """
-    lp = len(p)
-    i = np.array(list(range(lp)))+1
-    o = order(p)
-    ro = order(o)
-    return pmin(1, cummax((n - I + 1) * p[o]))[ro]
+    return _adjust(np.atleast_2d(np.asarray(p, dtype=float)), n, _holm)[0]
 #edef
 
 def hommel(p, n):
@@ -118,8 +270,8 @@ def hommel(p, n):
      - n: number of tests to correct for
     Outputs:
      - Corrected q-values
-    
-    R code:
+
+    R code (O(n^2), see _hommel_sorted for the O(n log n) algorithm that is used here):
         hommel = { ## needs n-1 >= 2 in for() below
         if(n > lp) p <- c(p, rep.int(1, n-lp))
         i <- seq_len(n)
@@ -138,7 +290,7 @@ def hommel(p, n):
         pmax(pa,p)[if(lp < n) ro[1:lp] else ro]
         }
     """
-    raise NotImplementedError
+    return _adjust(np.atleast_2d(np.asarray(p, dtype=float)), n, _hommel)[0]
 #edef
 
 def hochberg(p, n):
@@ -149,7 +301,7 @@ def hochberg(p, n):
      - n: number of tests to correct for
     Outputs:
      - Corrected q-values
-    
+
     R code:
     hochberg = {
     i <- lp:1L
@@ -158,11 +310,7 @@ def hochberg(p, n):
     pmin(1, cummin( (n - i + 1L) * p[o] ))[ro]
     }
     """
-    lp = len(p)
-    i = np.array(range(lp))[::-1] + 1
-    o = order(p, decreasing=True)
-    ro = order(o)
-    return pmin(1, cummin( (n - i + 1) * p[o] ))[ro]
+    return _adjust(np.atleast_2d(np.asarray(p, dtype=float)), n, _hochberg)[0]
 #edef
 
 def BH(p, n):
@@ -173,7 +321,7 @@ def BH(p, n):
      - n: number of tests to correct for
     Outputs:
      - Corrected q-values
-    
+
     R code:
     BH = {
     i <- lp:1L
@@ -182,11 +330,7 @@ def BH(p, n):
     pmin(1, cummin( n / i * p[o] ))[ro]
     }
     """
-    lp = len(p)
-    i = np.array(range(lp))[::-1] + 1
-    o = order(p, decreasing=True)
-    ro = order(o)
-    return pmin(1, cummin( n / i * p[o] ))[ro]
+    return _adjust(np.atleast_2d(np.asarray(p, dtype=float)), n, _BH)[0]
 #edef
 
 def BY(p, n):
@@ -197,7 +341,7 @@ def BY(p, n):
      - n: number of tests to correct for
     Outputs:
      - Corrected q-values
-    
+
     R code:
     BY = {
     i <- lp:1L
@@ -207,9 +351,5 @@ def BY(p, n):
     pmin(1, cummin(q * n / i * p[o]))[ro]
     }
     """
-    lp = len(p)
-    i = np.array(range(lp))[::-1] + 1
-    o = order(p, decreasing=True)
-    ro = order(o)
-    return pmin(1, cummin(q * n / i * p[o]))[ro]
-#edef
\ No newline at end of file
+    return _adjust(np.atleast_2d(np.asarray(p, dtype=float)), n, _BY)[0]
+#edef
@@ -4,13 +4,15 @@ from .. import math
 from math import ceil
 
 np     = utils.py.loadExternalModule("numpy")
+pd     = utils.py.loadExternalModule("pandas")
+patsy  = utils.py.loadExternalModule("patsy")
 linalg = utils.py.loadExternalModule("scipy.linalg")
 sm     = utils.py.loadExternalModule('statsmodels.api') # For some reason I need to import this before I can import the line below...
 smf    = utils.py.loadExternalModule('statsmodels.formula', 'api')
 
 ###############################################################################
 
-def lowess(x, y, f=2. / 3., iter=3, function=False):
+def lowess(x, y, f=2. / 3., iter=3, function=False, delta=0, dtype=np.float64):
     """lowess(x, y, f=2./3., iter=3) -> yest
 
     Lowess smoother: Robust locally weighted regression.
@@ -38,32 +40,89 @@ def lowess(x, y, f=2. / 3., iter=3, function=False):
     # License: BSD (3-clause)
 
     function : Return a piece wise linearly interpolated function of the lowess curve.
+    delta : Like in R's lowess, the curve is only fitted at points that are more than delta apart,
+            and linearly interpolated in between. e.g. 0.01 * (max(x) - min(x)) makes large inputs much faster.
+            With delta=0, the curve is fitted at every point.
+    dtype : The floating point type of the computation (e.g. np.float32 to halve the memory that is used)
+
+    The points are sorted by x, so that the neighbours of each point (the r = ceil(f * n) nearest points) are a window
+    of the sorted points. This takes O(n * r) time, and the weights are computed in blocks of points, in limited memory.
     """
+    x = np.asarray(x, dtype=dtype)
+    y = np.asarray(y, dtype=dtype)
     n = len(x)
-    r = int(ceil(f * n))
-    h = [np.sort(np.abs(x - x[i]))[r] for i in range(n)]
-    w = np.clip(np.abs((x[:, None] - x[None, :]) / h), 0.0, 1.0)
-    w = (1 - w ** 3) ** 3
-    yest = np.zeros(n)
-    delta = np.ones(n)
+    r = min(int(ceil(f * n)), n - 1)
+
+    order = np.argsort(x, kind='stable')
+    xs, ys = x[order], y[order]
+
+    # The points at which the curve is fitted
+    if delta > 0:
+        fit  = [ 0 ]
+        while fit[-1] < n - 1:
+            last = fit[-1]
+            fit.append(max(last + 1, int(np.searchsorted(xs, xs[last] + delta, side='right')) - 1))
+        #ewhile
+        fit = np.array(fit)
+    else:
+        fit = np.arange(n)
+    #fi
+    xf = xs[fit]
+
+    # h: the distance to the r-th nearest neighbour.
+    # It is the smallest max distance in a window of r+1 consecutive sorted points, found where the window is centered on the point.
+    sums  = xs[:n-r] + xs[r:]
+    start = np.searchsorted(sums, 2 * xf, side='left')
+    h     = np.full(len(fit), np.inf, dtype=dtype)
+    for lo in [ start - 1, start ]:
+        lo = np.clip(lo, 0, n - r - 1)
+        h  = np.minimum(h, np.maximum(xf - xs[lo], xs[lo + r] - xf))
+    #efor
+
+    # The points with a non-zero weight: closer than h (or identical, if h is zero)
+    left  = np.where(h > 0, np.searchsorted(xs, xf - h, side='right'), np.searchsorted(xs, xf, side='left'))
+    right = np.where(h > 0, np.searchsorted(xs, xf + h, side='left'),  np.searchsorted(xs, xf, side='right'))
+    scale = np.where(h > 0, h, 1)
+    width = int((right - left).max()) if n > 0 else 0
+    block = max(1, (1 << 22) // max(width, 1))
+
+    yest   = np.zeros(n, dtype=dtype)
+    robust = np.ones(n, dtype=dtype)
     for iteration in range(iter):
-        for i in range(n):
-            weights = delta * w[:, i]
-            b = np.array([np.sum(weights * y), np.sum(weights * y * x)])
-            A = np.array([[np.sum(weights), np.sum(weights * x)],
-                          [np.sum(weights * x), np.sum(weights * x * x)]])
-            beta = linalg.solve(A, b)
-            yest[i] = beta[0] + beta[1] * x[i]
+        yfit = np.zeros(len(fit), dtype=dtype)
+        for b in range(0, len(fit), block):
+            sel   = slice(b, b + block)
+            idx   = left[sel, None] + np.arange(width)[None, :]
+            valid = idx < right[sel, None]
+            idx   = np.minimum(idx, n - 1)
+
+            dx = xs[idx] - xf[sel, None]
+            w  = np.clip(np.abs(dx) / scale[sel, None], 0.0, 1.0)
+            w  = ((1 - w ** 3) ** 3) * robust[idx] * valid
+            yw = ys[idx]
+
+            # Weighted linear regression, with x centered on the fitted point, so that the estimate is the intercept
+            s0, s1, s2 = w.sum(axis=1), (w * dx).sum(axis=1), (w * dx * dx).sum(axis=1)
+            t0, t1     = (w * yw).sum(axis=1), (w * dx * yw).sum(axis=1)
+            det        = s0 * s2 - s1 * s1
+            linear     = det > np.finfo(dtype).eps * s0 * s2
+            mean       = np.where(s0 > 0, t0 / np.where(s0 > 0, s0, 1), ys[fit[sel]])
+            yfit[sel]  = np.where(linear, (s2 * t0 - s1 * t1) / np.where(linear, det, 1), mean)
         #efor
 
+        yest[order] = yfit if delta <= 0 else np.interp(xs, xf, yfit)
+
         residuals = y - yest
         s = np.median(np.abs(residuals))
-        delta = np.clip(residuals / (6.0 * s), -1, 1)
-        delta = (1 - delta ** 2) ** 2
+        if s == 0:
+            break # A perfect fit
+        #fi
+        robust = np.clip(residuals / (6.0 * s), -1, 1)
+        robust = ((1 - robust ** 2) ** 2)[order]
     #efor
 
     if function:
-        x, yest = zip(*sorted(zip(x, yest), key=lambda x: x[0])) 
+        x, yest = xs, yest[order]
         return lambda position: math.interpolation.linearInterpolation(x, yest, position, isSorted=True)
     #fi
 
@@ -72,11 +131,12 @@ def lowess(x, y, f=2. / 3., iter=3, function=False):
 
 ###############################################################################
 
-def linear_residuals(formula, Y, covariates, intercept=True):
+def linear_residuals(formula, Y, covariates, intercept=True, chunk_size=2000, n_workers=1):
     """
     Regress out a set of covariates from a set of measurements.
     For each column in Y_columns, regress out the variables in covariates, given the formula.
-    (These are done independently per measurement...)
+    (These are done independently per measurement, but solved together:
+     the design matrix is built once, and all measurements with the same missing values share one decomposition of it.)
 
     Inputs:
         formula:    R style formula string (i.e. ~ 0 + cov1 + cov2)
@@ -89,15 +149,12 @@ def linear_residuals(formula, Y, covariates, intercept=True):
                     Columns of value (e.g. BMI) Columns are covariates, and rows are sample
                     The index must correspond to that in Y_columns
         intercept:  If no formula is specified, then add an intercept/bias/mean term to the generated formula.
+        chunk_size: Number of columns of Y that are converted and solved at a time, to limit the memory that is used.
+        n_workers:  Number of threads that solve chunks at the same time.
     Output:
         Y_resids
+        Samples with a missing measurement or covariate have a missing residual (as with statsmodels' ols).
     """
-    
-    column_rename = { c: 'meas_%d' % (i+1) for i,c in enumerate(Y.columns) }
-    column_dename = {v: k for k, v in column_rename.items()}
-
-    resids = Y.copy().rename(columns=column_rename)
-    data   = covariates.join(resids)
 
     if formula is None:
         formula = "~ %s%s" % ( ('' if intercept else '0 + '), ' + '.join(covariates.columns))
@@ -113,13 +170,47 @@ def linear_residuals(formula, Y, covariates, intercept=True):
         #fi
     #efor
 
-    for i, gene in enumerate(resids.columns):
-        gene_formula = "%s ~ %s" % (gene, formula)
-        resids[gene] = smf.ols(formula=gene_formula, data=data).fit().resid
-        print('\r(%d) [ %s ~ %s ]%s' % (i+1, column_dename[gene], formula, ' '*50), end="")
-    #efor
-    
-    resids = resids.rename(columns=column_dename)
+    # The design matrix, for the samples in Y. Samples with missing covariates are dropped by patsy, and have no row.
+    X = patsy.dmatrix(formula, covariates, return_type='dataframe', NA_action='drop')
+    X = X.reindex(Y.index).values
+    present = ~np.isnan(X).any(axis=1)
+
+    projections = {}
+    def _projection(rows):
+        # An orthonormal basis of the columns of X for these samples. Like statsmodels (pinv), rank deficient designs are allowed.
+        key = rows.tobytes()
+        if key not in projections:
+            U, S, _ = np.linalg.svd(X[rows], full_matrices=False)
+            tol = S.max() * max(X.shape) * np.finfo(float).eps if len(S) > 0 else 0
+            projections[key] = U[:, S > tol]
+        #fi
+        return projections[key]
+    #edef
+
+    def _solve(columns):
+        values = Y.iloc[:, columns].to_numpy(dtype=float, copy=True)
+        mask   = ~np.isnan(values) & present[:, None]
+        resids = np.full(values.shape, np.nan)
+
+        # Columns with the same missing values are solved together
+        patterns, group = np.unique(np.packbits(mask, axis=0).T, axis=0, return_inverse=True)
+        for g in range(patterns.shape[0]):
+            cols = np.flatnonzero(group.ravel() == g)
+            rows = mask[:, cols[0]]
+            if not rows.any():
+                continue
+            #fi
+            U   = _projection(rows)
+            Yg  = values[np.ix_(rows, cols)]
+            resids[np.ix_(rows, cols)] = Yg - U @ (U.T @ Yg)
+        #efor
+        utils.msg.dbm("Regressed [ ~ %s ] out of %d measurements" % (formula, len(columns)))
+        return resids
+    #edef
+
+    chunks = [ np.arange(i, min(i + chunk_size, Y.shape[1])) for i in range(0, Y.shape[1], chunk_size) ]
+    resids = utils.py.parallel_map(_solve, chunks, n_workers=n_workers, processes=False)
+    resids = np.concatenate(resids, axis=1) if len(resids) > 0 else np.zeros((Y.shape[0], 0))
 
-    return resids
+    return pd.DataFrame(resids, index=Y.index, columns=Y.columns)
 #edef
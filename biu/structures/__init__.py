@@ -4,6 +4,7 @@ from .dataset2 import Dataset2_test
 
 from .fileManager import FileManager
 from .dataset import Dataset
+from .diskCache import DiskCache
 
 #from . import resourceManager
 #from .lazyObject import LazyObject
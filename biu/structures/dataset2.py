@@ -4,6 +4,9 @@ from .. import utils
 import os
 import pathlib
 
+np = utils.py.loadExternalModule("numpy")
+pd = utils.py.loadExternalModule("pandas")
+
 class DataObjects(object):
     """
     An object that manages the lazy loading of objects and their file dependencies
@@ -106,20 +109,22 @@ class DataObjects(object):
         return self.files[name]
     #edef
     
-    def _acquire_files(self, files):
+    def _acquire_files(self, files, n_workers=None):
         """
         Perform the acquisition pipeline for the files specified.
+        Independent files are acquired at the same time (see utils.Acquire2.acquire_many)
         parameters:
         -----------
         files: List of strings
+        n_workers: Integer. Number of files that are acquired at the same time (default: settings.getDownloadWorkers())
         """
-        for f in files:
-            if f in self.acquired_files:
-                continue
-            #fi
-
-            self.files[f].acquire()
-        #efor
+        files = [ f for f in files if f not in self.acquired_files ]
+        if len(files) == 0:
+            return
+        #fi
+        
+        utils.Acquire2.acquire_many([ self.files[f] for f in files ], n_workers=n_workers)
+        self.acquired_files.extend(files)
     #edef
     
     def register(self, name, required_files, load_func):
@@ -301,6 +306,57 @@ class Dataset2(object):
         object.__setattr__(self, '_str_funcs', [])
     #edef
     
+    def acquire_files(self, files=None, n_workers=None):
+        """
+        Acquire the files of this dataset, so that they are available before any object is loaded.
+        Independent files are downloaded and processed at the same time.
+        
+        Parameters:
+        -----------
+        files:     List of strings. The names of the files to acquire (default: all files)
+        n_workers: Integer. Number of files that are acquired at the same time (default: settings.getDownloadWorkers())
+        """
+        self._obj._acquire_files(list(self._obj.files.keys()) if files is None else files, n_workers=n_workers)
+    #edef
+    
+    def _who_has_many_per_chrom(self, variants, *pargs, **kwargs):
+        """
+        who_has_many for datasets with a VCF2 object per chromosome, registered as 'vcf_<chrom>'.
+        The variants of each chromosome are looked up in the VCF2 object of that chromosome.
+        
+        Parameters:
+        -----------
+        variants: DataFrame with columns chrom, pos, ref, alt. The variants to look up
+        *pargs, **kwargs: See additional arguments for VCF2.who_has_many
+        
+        Returns:
+        --------
+        Boolean DataFrame of variants x samples (in the order of the input), indexed by variant identifier.
+        """
+        chroms = variants.chrom.astype(str).values
+        
+        if len(chroms) == 0:
+            vcfs    = [ name for name in self._obj.registered if name.startswith('vcf_') ]
+            samples = self._obj[vcfs[0]].samples if len(vcfs) > 0 else []
+            return pd.DataFrame(np.zeros((0, len(samples)), dtype=bool), columns=samples)
+        #fi
+        
+        rows = []
+        res  = []
+        for chrom in pd.unique(chroms):
+            oname = "vcf_%s" % chrom
+            
+            if oname not in self._obj:
+                raise AttributeError("Could not find chromosome '%s'" % chrom)
+            #fi
+            
+            rows.append(np.flatnonzero(chroms == chrom))
+            res.append(self._obj[oname].who_has_many(variants[chroms == chrom], *pargs, **kwargs))
+        #efor
+        
+        return pd.concat(res).iloc[np.argsort(np.concatenate(rows), kind='stable')]
+    #edef
+    
     def _add_str_func(self, fun):
         """
         Add a function that is evaluated and printed when a string representation is made.
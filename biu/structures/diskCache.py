@@ -0,0 +1,239 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+from .. import utils
+from ..config import settings as settings
+
+#############################################################################
+
+class DiskCache(object):
+  """
+  A directory of cached entries, with least-recently-used eviction by total size on disk.
+
+  Each entry is a directory (named by its key) containing whatever files the user writes into it,
+    e.g. numpy arrays that can later be memory-mapped, and a metadata file.
+  Entries are written to a temporary directory, and only appear in the cache once they are committed,
+    so an interrupted computation never leaves an incomplete entry behind.
+
+  Example usage:
+  --------------
+
+  cache = DiskCache("my_arrays")
+  key   = cache.key("input.tsv", os.path.getmtime("input.tsv"), "parameters")
+  entry = cache.lookup(key)
+  if entry is None:
+    tmp = cache.new_entry()
+    np.save(os.path.join(tmp, "values.npy"), compute_values())
+    entry = cache.commit(key, tmp, meta={"description": "values"})
+  #fi
+  values = np.load(os.path.join(entry, "values.npy"), mmap_mode='r')
+  """
+
+  _meta_file = "meta.json"
+
+  def __init__(self, name, where=None, max_size=None):
+    """
+    Initialize a DiskCache object
+    parameters:
+    -----------
+    name:     String. Name of the cache (a subdirectory of where)
+    where:    String. Directory of caches (default: settings.getCacheDir())
+    max_size: Integer. Maximum size of the cache in bytes (default: settings.getCacheMaxSize())
+    """
+    if where is None:
+      where = settings.getCacheDir()
+    #fi
+    self._where    = os.path.join(os.path.abspath(where), name)
+    self._max_size = max_size
+  #edef
+
+  #############################################################################
+
+  @property
+  def where(self):
+    return self._where
+  #edef
+
+  @property
+  def max_size(self):
+    return settings.getCacheMaxSize() if self._max_size is None else self._max_size
+  #edef
+
+  @staticmethod
+  def key(*parts):
+    """
+    Make a cache key from the string representations of several parts
+    """
+    return hashlib.sha1('\x00'.join([ str(p) for p in parts ]).encode('utf-8')).hexdigest()
+  #edef
+
+  @staticmethod
+  def file_key(file_name):
+    """
+    Identify the current state of a file (its location, size and modification time), without reading it.
+    """
+    stat = os.stat(file_name)
+    return '%s:%d:%d' % (os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+  #edef
+
+  #############################################################################
+
+  def _entry(self, key):
+    return os.path.join(self._where, key)
+  #edef
+
+  def __contains__(self, key):
+    return os.path.exists(os.path.join(self._entry(key), self._meta_file))
+  #edef
+
+  def lookup(self, key):
+    """
+    Find an entry in the cache, and mark it as recently used.
+    Returns: The directory of the entry, or None if it is not in the cache
+    """
+    if key not in self:
+      return None
+    #fi
+    entry = self._entry(key)
+    os.utime(os.path.join(entry, self._meta_file))
+    return entry
+  #edef
+
+  def meta(self, key):
+    """
+    Returns: The metadata dictionary that was stored with an entry
+    """
+    with open(os.path.join(self._entry(key), self._meta_file), 'r') as ifd:
+      return json.load(ifd)
+    #ewith
+  #edef
+
+  def new_entry(self):
+    """
+    Returns: A temporary directory in which the files of a new entry can be written
+    """
+    utils.fs.mkdirp(self._where)
+    return tempfile.mkdtemp(prefix='.tmp_', dir=self._where)
+  #edef
+
+  def commit(self, key, tmp, meta=None):
+    """
+    Add a written entry to the cache, and evict old entries if the cache is too large.
+    If the entry is already in the cache (e.g. built at the same time by another process), tmp is discarded and the existing entry is used.
+    parameters:
+    -----------
+    key:  String. The key of the entry
+    tmp:  String. The temporary directory given by new_entry()
+    meta: Dictionary. JSON serializable metadata to store with the entry
+
+    Returns: The directory of the entry
+    """
+    entry = self._entry(key)
+    if key in self:
+      self.discard(tmp)
+      return entry
+    #fi
+
+    with open(os.path.join(tmp, self._meta_file), 'w') as ofd:
+      json.dump({} if meta is None else meta, ofd)
+    #ewith
+
+    try:
+      os.rename(tmp, entry)
+    except OSError:
+      # A concurrent builder committed the same entry first
+      if key not in self:
+        raise
+      #fi
+      self.discard(tmp)
+      return entry
+    #etry
+
+    self.evict(keep=[key])
+    return entry
+  #edef
+
+  def discard(self, tmp):
+    """
+    Remove an uncommitted entry
+    """
+    shutil.rmtree(tmp, ignore_errors=True)
+  #edef
+
+  #############################################################################
+
+  def entries(self):
+    """
+    Returns: List of (key, size in bytes, last use time) for each entry, least recently used first
+    """
+    if not os.path.isdir(self._where):
+      return []
+    #fi
+
+    E = []
+    for key in os.listdir(self._where):
+      if key.startswith('.') or (key not in self):
+        continue
+      #fi
+      entry = self._entry(key)
+      size  = sum([ os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry) ])
+      E.append((key, size, os.path.getmtime(os.path.join(entry, self._meta_file))))
+    #efor
+    return sorted(E, key=lambda e: e[2])
+  #edef
+
+  def size(self):
+    """
+    Returns: The total size of the cache in bytes
+    """
+    return sum([ e[1] for e in self.entries() ])
+  #edef
+
+  def evict(self, max_size=None, keep=[]):
+    """
+    Remove the least recently used entries until the cache is at most max_size bytes
+    parameters:
+    -----------
+    max_size: Integer. Default is the maximum size of this cache
+    keep: List of keys that should not be removed
+    """
+    max_size = self.max_size if max_size is None else max_size
+    E = self.entries()
+    total = sum([ e[1] for e in E ])
+    for (key, size, used) in E:
+      if total <= max_size:
+        break
+      elif key in keep:
+        continue
+      #fi
+      utils.dbm("Evicting '%s' from cache '%s'" % (key, self._where))
+      shutil.rmtree(self._entry(key), ignore_errors=True)
+      total -= size
+    #efor
+  #edef
+
+  def clear(self):
+    """
+    Remove all entries from the cache
+    """
+    self.evict(max_size=0)
+  #edef
+
+  #############################################################################
+
+  def __str__(self):
+    dstr  = "DiskCache object\n"
+    dstr += " Where: %s\n" % self._where
+    dstr += " Entries: %d\n" % len(self.entries())
+    dstr += " Size: %d / %d bytes\n" % (self.size(), self.max_size)
+    return dstr
+  #edef
+
+  def __repr__(self):
+    return str(self)
+  #edef
+
+#eclass
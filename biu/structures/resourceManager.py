@@ -86,6 +86,7 @@ class TabixTSVResourceManager(ResourceManager):
     ResourceManager.__init__(self, fmObject, [ tsvFile, tabixFile ], **kwargs)
     if self._initialized:
       self._resource = tabix.open(self._fmObject.getFileName(tsvFile))
+      self._table    = formats.Tabix(self._fmObject.getFileName(tsvFile), fieldNames=fieldNames, tbiFile=self._fmObject.getFileName(tabixFile))
       if fieldNames is not None:
         self._namedtuple = namedtuple("tabixTsv", fieldNames)
       #fi
@@ -93,6 +94,13 @@ class TabixTSVResourceManager(ResourceManager):
     #fi
   #edef
 
+  def queryTable(self, regions, **kwargs):
+    """
+    Query many regions at once into a pandas DataFrame. See formats.Tabix.queryTable
+    """
+    return self._table.queryTable(regions, **kwargs)
+  #edef
+
   def query(self, seqid, start, end, pandas=False, namedtuple=False, tabixIter=True):
     res = utils.tabixQueryWrapper(self._resource, seqid, start, end)
     if pandas:
@@ -126,10 +134,10 @@ class VCFResourceManager(ResourceManager, formats.VCF):
 ###############################################################################
 
 class GFF3ResourceManager(ResourceManager, formats.GFF3):
-  def __init__(self, fmObject, gff3File, **kwargs):
+  def __init__(self, fmObject, gff3File, columnar=True, **kwargs):
     ResourceManager.__init__(self, fmObject, [ gff3File ])
     if self._initialized:
-      formats.GFF3.__init__(self, self._fmObject.getFileName(gff3File), **kwargs)
+      formats.GFF3.__init__(self, self._fmObject.getFileName(gff3File), columnar=columnar, **kwargs)
     #fi
   #edef
 
@@ -11,6 +11,10 @@ import os
 from collections import namedtuple
 import hashlib
 import ftplib
+import time
+import http.client
+import urllib.request
+import urllib.error
 
 ###############################################################################
 
@@ -277,6 +281,7 @@ class Acquire2(object):
      * touch: create local file
      * code:  create local file from python function
      * curl:  from the web. 
+     * download: from the web (HTTP/HTTPS/FTP), resumable and with an optional checksum
      * wget:  from the web. Note: doesn't work on mac os...
      * ftp:   from the web via FTP
      * lftp:  from the web via LFTP
@@ -312,6 +317,10 @@ class Acquire2(object):
     
     file_path = a.acquire().path
     
+    Several pipelines can be run at the same time:
+    
+    outputs = Acquire2.acquire_many([ a, Acquire2().download("https://example.org/data.tsv.gz") ])
+    
     """
     
     AcquireStep = AcquireStep
@@ -413,6 +422,92 @@ class Acquire2(object):
         return output
     #edef
     
+    @staticmethod
+    def acquire_many(acquire_objects, n_workers=None, processes=False):
+        """
+        Run several acquire pipelines at the same time.
+        
+        Pipelines that share a step (e.g. two files selected from the same archive) depend on each other,
+        and are run one after the other by the same worker, so that no step is performed twice at the same time.
+        Independent pipelines are run concurrently.
+        
+        parameters:
+        -----------
+        acquire_objects: List of Acquire2 objects
+        n_workers: Integer. Number of pipelines that are run at the same time (default: settings.getDownloadWorkers())
+        processes: Boolean. Use a pool of processes rather than threads.
+                   Threads are enough for downloads, processes are useful when steps are python functions (e.g. func, code)
+        
+        returns:
+        A list with the output AcquireFile object of each pipeline.
+        """
+        acquire_objects = list(acquire_objects)
+        n_workers = settings.getDownloadWorkers() if n_workers is None else n_workers
+        
+        # Group the pipelines that share a step output
+        group = list(range(len(acquire_objects)))
+        def _find(i):
+            while group[i] != i:
+                group[i] = group[group[i]]
+                i = group[i]
+            #ewhile
+            return i
+        #edef
+        
+        owner = {}
+        for (i, ao) in enumerate(acquire_objects):
+            for step in ao.steps:
+                j = owner.setdefault(step.provis(ao.where).path, i)
+                group[_find(i)] = _find(j)
+            #efor
+        #efor
+        
+        groups = {}
+        for i in range(len(acquire_objects)):
+            groups.setdefault(_find(i), []).append(i)
+        #efor
+        groups = list(groups.values())
+        
+        def _acquire_group(members):
+            outputs = []
+            for i in members:
+                outputs.append(acquire_objects[i].acquire())
+                msg.dbm("Acquired '%s'" % outputs[-1].path)
+            #efor
+            return outputs
+        #edef
+        
+        outputs = [ None ] * len(acquire_objects)
+        for (members, group_outputs) in zip(groups, py.parallel_map(_acquire_group, groups, n_workers=n_workers, processes=processes)):
+            for (i, output) in zip(members, group_outputs):
+                outputs[i] = output
+            #efor
+        #efor
+        return outputs
+    #edef
+    
+    @staticmethod
+    def checksum(path, algorithm='md5', chunk_size=1 << 20):
+        """
+        Compute the checksum of a file.
+        
+        parameters:
+        -----------
+        path: String. The file
+        algorithm: String. A hashlib algorithm, e.g. md5, sha1, sha256
+        
+        returns:
+        The hexadecimal digest of the file
+        """
+        digest = hashlib.new(algorithm)
+        with open(path, 'rb') as ifd:
+            for chunk in iter(lambda: ifd.read(chunk_size), b''):
+                digest.update(chunk)
+            #efor
+        #ewith
+        return digest.hexdigest()
+    #edef
+    
     def __str__(self):
         dstr = "Acquire object.\n"
         dstr += ' Re-do steps: %s\n' % ('yes' if self.redo else 'no')
@@ -610,6 +705,99 @@ class Acquire2(object):
         return self.add_step(step)
     #edef
     
+    def download(self, url, ext=None, checksum=None, headers=None, chunk_size=1 << 20, retries=5, timeout=60):
+        """
+        download: Download a file with python (urllib)
+        The file is downloaded in chunks to a partial file (output + '.part').
+        If the download is interrupted, it is resumed from where it stopped with an HTTP range request,
+          also when the pipeline is run again later. Servers that do not support ranges restart the download.
+        Progress is reported with debug messages.
+        
+        Inputs: url: String. The URL to retrieve (http, https or ftp)
+                ext: Optionally specify a file extension
+                checksum: String. The expected checksum of the file, as 'algorithm:hexdigest', e.g. 'sha256:9f86d0...'.
+                          A hexdigest without algorithm is taken to be an md5 checksum.
+                          If the checksum does not match, the downloaded file is removed and the step fails.
+                headers: Dictionary. Additional HTTP headers
+                chunk_size: Integer. Number of bytes that are read at a time
+                retries: Integer. Number of times an interrupted download is resumed
+                timeout: Number. Seconds to wait for the server
+        Output: Acquire object
+        """
+        ext         = '' if ext is None else ('.' + ext)
+        dl_hash     = ops.lst.hash([ 'download', url ]) + ext
+        output_file = AcquireFile(dirname=None, basename=dl_hash)
+        
+        if checksum is not None:
+            algorithm, expected = checksum.split(':', 1) if ':' in checksum else ('md5', checksum)
+            hashlib.new(algorithm) # Fail now for unknown algorithms
+        #fi
+        
+        def _download(output, url):
+            partial  = output + '.part'
+            reported = 0
+            attempt  = 0
+            while True:
+                have    = os.path.getsize(partial) if os.path.exists(partial) else 0
+                request = urllib.request.Request(url, headers={} if headers is None else dict(headers))
+                if have > 0:
+                    request.add_header('Range', 'bytes=%d-' % have)
+                #fi
+                try:
+                    with urllib.request.urlopen(request, timeout=timeout) as response:
+                        resumed = (have > 0) and (getattr(response, 'status', None) == 206)
+                        if not resumed:
+                            have = 0
+                        #fi
+                        length = response.headers.get('Content-Length')
+                        total  = (have + int(length)) if length is not None else None
+                        done   = have
+                        with open(partial, 'ab' if resumed else 'wb') as ofd:
+                            for chunk in iter(lambda: response.read(chunk_size), b''):
+                                ofd.write(chunk)
+                                done += len(chunk)
+                                if time.time() - reported > 5:
+                                    reported = time.time()
+                                    msg.dbm("Downloading %s: %.1f%s MB" % (url, done / 2**20, '' if total is None else ('/%.1f' % (total / 2**20))))
+                                #fi
+                            #efor
+                        #ewith
+                        if (total is not None) and (done < total):
+                            raise http.client.IncompleteRead(b'', total - done)
+                        #fi
+                    #ewith
+                    break
+                except (http.client.HTTPException, OSError) as e:
+                    code = e.code if isinstance(e, urllib.error.HTTPError) else None
+                    if (code == 416) and (have > 0):
+                        break # Nothing left to download
+                    #fi
+                    attempt += 1
+                    if (attempt > retries) or ((code is not None) and (code < 500)):
+                        msg.error("Could not download '%s': %s" % (url, str(e)))
+                        return self.STATUS_FAILURE
+                    #fi
+                    msg.warning("Download of '%s' interrupted (%s). Resuming." % (url, str(e)))
+                    time.sleep(min(2 ** attempt, 60))
+                #etry
+            #ewhile
+            
+            if checksum is not None:
+                observed = self.checksum(partial, algorithm)
+                if observed.lower() != expected.lower():
+                    msg.error("Checksum mismatch for '%s': expected %s, got %s" % (url, expected, observed))
+                    os.remove(partial)
+                    return self.STATUS_FAILURE
+                #fi
+            #fi
+            os.replace(partial, output)
+            return self.STATUS_SUCCESS
+        #edef
+        
+        step = AcquireStep("Download(%s)" % url, [], output_file, lambda i, o: _download(o, url))
+        return self.add_step(step)
+    #edef
+    
     def _ftp(self, server, location, username=None, password=None, ext=None):
         """
         ftp: Download a file with FTP
@@ -1,7 +1,10 @@
+import os
 import types
 import importlib
 import importlib.machinery
 import inspect
+import multiprocessing
+import concurrent.futures
 
 from . import msgUtils as msg
 from ..config import settings
@@ -93,3 +96,58 @@ def source(obj):
     return inspect.getsource(obj)
   #fi
 #edef
+
+###############################################################################
+
+_parallel_func = None
+
+def _parallel_init(func):
+  global _parallel_func
+  _parallel_func = func
+#edef
+
+def _parallel_call(item):
+  return _parallel_func(item)
+#edef
+
+def parallel_map(func, items, n_workers=None, processes=True):
+  """
+  Apply a function to each item in a list, using a pool of workers.
+  Inputs:
+    func: Function to apply to each item.
+          When forking is available, func is inherited by the worker processes, and need not be picklable.
+          The items and the results are always transferred by pickling.
+    items: List of items
+    n_workers: Integer. Number of workers (default: number of CPUs). If 1, the items are processed serially in this process.
+    processes: Boolean. Use a pool of processes (True) or of threads (False)
+  Output:
+    List of results, in the same order as the items (regardless of the order in which they finish).
+
+  NOTE: Worker processes cannot start a process pool themselves.
+  """
+  items = list(items)
+  if n_workers is None:
+    n_workers = os.cpu_count() or 1
+  #fi
+  n_workers = min(n_workers, len(items))
+
+  if n_workers <= 1:
+    return [ func(item) for item in items ]
+  #fi
+
+  if not processes:
+    with concurrent.futures.ThreadPoolExecutor(n_workers) as pool:
+      return list(pool.map(func, items))
+    #ewith
+  #fi
+
+  if 'fork' in multiprocessing.get_all_start_methods():
+    ctx = multiprocessing.get_context('fork')
+  else:
+    ctx = multiprocessing.get_context()
+  #fi
+
+  with ctx.Pool(n_workers, initializer=_parallel_init, initargs=(func,)) as pool:
+    return pool.map(_parallel_call, items, chunksize=1)
+  #ewith
+#edef
@@ -0,0 +1,81 @@
+# Shared fixtures for the tests
+
+import gzip
+import zlib
+import struct
+
+import pytest
+
+###############################################################################
+
+def _bgzf_block(data):
+    """
+    Compress data into one BGZF block
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    header     = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, 18 + len(compressed) + 8 - 1)
+    return header + compressed + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+#edef
+
+def _write_tabix(path, blocks, colSeq=1, colBeg=2, colEnd=3, zeroBased=True, meta='#'):
+    """
+    Write a BGZF compressed table, with a block per string in blocks, and a tabix index (path + '.tbi') with only a linear index.
+    Blocks may end in the middle of a line, like in real files.
+    """
+    blocks  = [ b.encode() for b in blocks ]
+    offsets = []
+    with open(path, 'wb') as ofd:
+        for block in blocks:
+            offsets.append(ofd.tell())
+            ofd.write(_bgzf_block(block))
+        #efor
+        ofd.write(_bgzf_block(b''))
+    #ewith
+
+    # The virtual offset of each line start
+    names  = []
+    linear = {}
+    text   = b''.join(blocks)
+    ends   = [ sum(len(b) for b in blocks[:i+1]) for i in range(len(blocks)) ]
+    start  = 0
+    for line in text.split(b'\n')[:-1]:
+        k = next(i for (i, e) in enumerate(ends) if e > start)
+        voffset = (offsets[k] << 16) | (start - (ends[k] - len(blocks[k])))
+        start  += len(line) + 1
+        if line[:1] == meta.encode():
+            continue
+        #fi
+        fields = line.decode().split('\t')
+        seqid  = fields[colSeq-1]
+        beg    = int(fields[colBeg-1]) - (0 if zeroBased else 1)
+        end    = int(fields[colEnd-1]) if colEnd > 0 else beg + 1
+        if seqid not in linear:
+            names.append(seqid)
+            linear[seqid] = {}
+        #fi
+        for window in range(beg >> 14, ((max(end, beg + 1) - 1) >> 14) + 1):
+            linear[seqid].setdefault(window, voffset)
+        #efor
+    #efor
+
+    nm  = b''.join([ n.encode() + b'\x00' for n in names ])
+    tbi = struct.pack('<4s8i', b'TBI\x01', len(names), 0x10000 if zeroBased else 0, colSeq, colBeg, colEnd, ord(meta), 0, len(nm)) + nm
+    for name in names:
+        windows = linear[name]
+        tbi += struct.pack('<ii', 0, max(windows) + 1)
+        tbi += b''.join([ struct.pack('<Q', windows.get(w, 0)) for w in range(max(windows) + 1) ])
+    #efor
+    with gzip.open(path + '.tbi', 'wb') as ofd:
+        ofd.write(tbi)
+    #ewith
+    return path
+#edef
+
+@pytest.fixture
+def write_tabix():
+    """
+    A function to write a BGZF compressed, tabix indexed table from a list of (uncompressed) BGZF blocks. See _write_tabix
+    """
+    return _write_tabix
+#edef
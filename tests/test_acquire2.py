@@ -0,0 +1,162 @@
+# Tests for biu.utils.Acquire2 downloads, against a local HTTP server
+
+import os
+import re
+import hashlib
+import threading
+import http.server
+
+import pytest
+
+from biu.utils import acquire2
+
+###############################################################################
+
+CONTENT = bytes(range(256)) * 1024
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves CONTENT at /file and /drop, with support for Range requests (206).
+    The first request for /drop is cut off halfway through the content.
+    Everything else is a 404.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('Range')))
+
+        if self.path not in [ '/file', '/drop' ]:
+            self.send_error(404)
+            return
+        #fi
+
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range') or '')
+        if match is not None:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(CONTENT) - 1, len(CONTENT)))
+        else:
+            self.send_response(200)
+        #fi
+        body = CONTENT[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if (self.path == '/drop') and (len([ r for r in server.requests if r[0] == '/drop' ]) == 1):
+            # Drop the connection halfway through
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        #fi
+        self.wfile.write(body)
+    #edef
+
+    def log_message(self, *pargs):
+        pass
+    #edef
+#eclass
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.requests = []
+    httpd.url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+#edef
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    Do not wait between retries, but record the waits
+    """
+    waits = []
+    monkeypatch.setattr(acquire2.time, 'sleep', waits.append)
+    return waits
+#edef
+
+###############################################################################
+
+def test_download(server, tmp_path, sleeps):
+    a = acquire2.Acquire2(where=str(tmp_path)).download(server.url + '/file')
+    with open(a.acquire().path, 'rb') as ifd:
+        assert ifd.read() == CONTENT
+    #ewith
+    assert sleeps == []
+#edef
+
+def test_download_resumes_after_dropped_connection(server, tmp_path, sleeps):
+    a = acquire2.Acquire2(where=str(tmp_path)).download(server.url + '/drop', chunk_size=4096)
+    path = a.acquire().path
+
+    with open(path, 'rb') as ifd:
+        assert ifd.read() == CONTENT
+    #ewith
+    assert not os.path.exists(path + '.part')
+
+    requests = [ r for r in server.requests if r[0] == '/drop' ]
+    assert len(requests) == 2
+    assert requests[0][1] is None
+    assert requests[1][1] == 'bytes=%d-' % (len(CONTENT) // 2)
+    assert len(sleeps) == 1
+#edef
+
+def test_download_404_fails_without_retries(server, tmp_path, sleeps):
+    a = acquire2.Acquire2(where=str(tmp_path)).download(server.url + '/missing', retries=3)
+    with pytest.raises(RuntimeError):
+        a.acquire()
+    #ewith
+
+    assert len(server.requests) == 1
+    assert sleeps == []
+    assert not os.path.exists(a.path)
+#edef
+
+def test_download_checksum(server, tmp_path, sleeps):
+    good = 'sha256:%s' % hashlib.sha256(CONTENT).hexdigest()
+    a = acquire2.Acquire2(where=str(tmp_path / 'good')).download(server.url + '/file', checksum=good)
+    with open(a.acquire().path, 'rb') as ifd:
+        assert ifd.read() == CONTENT
+    #ewith
+
+    bad = acquire2.Acquire2(where=str(tmp_path / 'bad')).download(server.url + '/file', checksum='0' * 32)
+    with pytest.raises(RuntimeError):
+        bad.acquire()
+    #ewith
+    assert not os.path.exists(bad.path)
+    assert not os.path.exists(bad.path + '.part')
+#edef
+
+def test_acquire_many_groups_shared_steps(server, tmp_path, sleeps, monkeypatch):
+    groups = []
+    parallel_map = acquire2.py.parallel_map
+    def record(func, items, *pargs, **kwargs):
+        groups.extend(items)
+        return parallel_map(func, items, *pargs, **kwargs)
+    #edef
+    monkeypatch.setattr(acquire2.py, 'parallel_map', record)
+
+    shared = acquire2.Acquire2(where=str(tmp_path)).download(server.url + '/file')
+    a = shared.finalize(str(tmp_path / 'a.bin'))
+    b = shared.finalize(str(tmp_path / 'b.bin'))
+    c = acquire2.Acquire2(where=str(tmp_path)).download(server.url + '/drop')
+
+    outputs = acquire2.Acquire2.acquire_many([ a, c, b ], n_workers=3)
+
+    assert sorted(groups) == [ [0, 2], [1] ]
+    assert [ o.path for o in outputs ] == [ a.path, c.path, b.path ]
+    for o in outputs:
+        with open(o.path, 'rb') as ifd:
+            assert ifd.read() == CONTENT
+        #ewith
+    #efor
+
+    # The shared download is done only once
+    assert len([ r for r in server.requests if r[0] == '/file' ]) == 1
+#edef
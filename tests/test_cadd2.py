@@ -0,0 +1,48 @@
+# Tests for biu.db.CADD2, on a small local CADD table
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from biu.db import cadd2
+
+###############################################################################
+
+# The first block ends right after the chromosome of the first record of chromosome 2
+BLOCKS = [ "1\t100\tA\tC\t0.1\t1.0\n1\t100\tA\tG\t0.2\t2.0\n1\t101\tC\tT\t0.3\t3.0\n1\t102\tG\tA\t0.4\t4.0\n2\t",
+           "200\tT\tA\t0.5\t5.0\n2\t201\tA\tG\t0.6\t6.0\n" ]
+
+@pytest.fixture
+def cadd(tmp_path, write_tabix):
+    path = write_tabix(str(tmp_path / 'scores.tsv.bgz'), BLOCKS, colSeq=1, colBeg=2, colEnd=2, zeroBased=False)
+    return cadd2.CADD2(where=str(tmp_path), download_where=str(tmp_path),
+                       local_files={ 'scores.tsv.bgz' : path, 'scores.tsv.bgz.tbi' : path + '.tbi' })
+#edef
+
+def test_query_table(cadd):
+    table = cadd.query_table([ ('1', 99, 102), ('2', 199, 201) ])
+    assert table.pos.dtype == np.int64
+    assert table.pos.tolist() == [ 100, 100, 101, 102, 200, 201 ]
+    assert table.phred.tolist() == [ 1.0, 2.0, 3.0, 4.0, 5.0, 6.0 ]
+#edef
+
+def test_query_regions_keeps_chromosomes(cadd):
+    res = cadd.query_regions([ (1, 99, 100), ('1', 101, 102), ('chr2', 200) ])
+    assert res == { (1, 100, 'C') : 1.0, (1, 100, 'G') : 2.0, ('1', 102, 'A') : 4.0, ('chr2', 200, 'A') : 5.0 }
+#edef
+
+def test_score(cadd):
+    variants = pd.DataFrame({ 'chrom' : [ '2', 1, 'chr1', '1' ], 'pos' : [ 201, 100, 102, 103 ],
+                              'ref'   : [ 'A', 'A', 'G', 'T' ], 'alt' : [ 'G', 'G', 'A', 'C' ] })
+    scored = cadd.score(variants)
+    assert scored.phred.tolist()[:3] == [ 6.0, 2.0, 4.0 ]
+    assert np.isnan(scored.phred.values[3])
+    assert scored.rawscore.tolist()[:3] == [ 0.6, 0.2, 0.4 ]
+#edef
+
+def test_regions_thresh(cadd):
+    thresholds = cadd.regions_thresh([ ('1', 99, 102), ('2', 199, 201), ('2', 300, 400) ], percentile=50, per_region=True)
+    assert thresholds[:2].tolist() == [ 2.5, 5.5 ]
+    assert np.isnan(thresholds[2])
+    assert cadd.regions_thresh([ ('1', 99, 102), ('2', 199, 201) ], percentile=50) == 3.5
+#edef
@@ -0,0 +1,45 @@
+# Tests for biu.ops.matrix correlations with missing values
+
+import numpy as np
+import scipy.stats
+
+from biu.ops import matrix
+
+###############################################################################
+
+def _spearman(x, y):
+    shared = ~(np.isnan(x) | np.isnan(y))
+    if shared.sum() < 2:
+        return np.nan
+    #fi
+    return scipy.stats.spearmanr(x[shared], y[shared])[0]
+#edef
+
+def _data(seed=0):
+    # Scattered NaNs: nearly every row has its own missingness pattern, with one large group of complete rows
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(60, 20))
+    X[:, 5:] += X[:, :1]
+    X[:, :3] = np.round(X[:, :3])
+    X[20:][rng.random((40, 20)) < 0.15] = np.nan
+    return X
+#edef
+
+def test_spearman_many_missingness_patterns():
+    X = _data()
+    r, p = matrix.corrcoef(X, method='spearman')
+    expected = np.array([ [ _spearman(x, y) for y in X ] for x in X ])
+    np.testing.assert_allclose(r, expected, atol=1e-12)
+    assert np.isfinite(p[~np.isnan(expected)]).all()
+#edef
+
+def test_spearman_between_threshold():
+    X = _data(1)
+    r, p  = matrix.corrcoef_between(X, X[:30], method='spearman')
+    pairs = matrix.corrcoef_between(X, X[:30], method='spearman', threshold=0.5)
+    I, J  = np.nonzero(np.abs(r) >= 0.5)
+    assert pairs.i.tolist() == I.tolist()
+    assert pairs.j.tolist() == J.tolist()
+    np.testing.assert_allclose(pairs.r.values, r[I, J])
+    np.testing.assert_allclose(pairs.p.values, p[I, J])
+#edef
@@ -0,0 +1,35 @@
+# Tests for biu.formats.tabixUtils.Tabix.queryTable
+
+import numpy as np
+
+from biu.formats import tabixUtils
+
+###############################################################################
+
+FIELDS = [ 'chrom', 'start', 'end', 'name' ]
+
+# The first block ends right after the chromosome of the first record of chromosome 2
+BLOCKS = [ "1\t10\t20\ta\n1\t30\t40\tb\n2\t5\t15\tc\n2\t",
+           "50\t60\td\n2\t70\t80\te\n" ]
+
+def test_queryTable(tmp_path, write_tabix):
+    path = write_tabix(str(tmp_path / 'table.bed.bgz'), [ ''.join(BLOCKS) ])
+    table = tabixUtils.Tabix(path, fieldNames=FIELDS).queryTable([ ('1', 0, 100), ('2', 55, 75) ])
+    assert table.name.tolist() == [ 'a', 'b', 'd', 'e' ]
+#edef
+
+def test_queryTable_chromosome_change_at_block_boundary(tmp_path, write_tabix):
+    path = write_tabix(str(tmp_path / 'table.bed.bgz'), BLOCKS)
+    tbx  = tabixUtils.Tabix(path, fieldNames=FIELDS)
+
+    table = tbx.queryTable([ ('1', 0, 100) ])
+    assert table.name.tolist() == [ 'a', 'b' ]
+    assert table.end.dtype == np.int64
+
+    table = tbx.queryTable([ ('1', 0, 100) ], dtype={ 'start' : np.int64, 'end' : np.int64 })
+    assert table.end.tolist() == [ 20, 40 ]
+
+    table = tbx.queryTable([ ('1', 0, 100), ('2', 0, 100) ], dtype={ 'start' : np.int64, 'end' : np.int64 })
+    assert table.name.tolist() == [ 'a', 'b', 'c', 'd', 'e' ]
+    assert table.start.tolist() == [ 10, 30, 5, 50, 70 ]
+#edef